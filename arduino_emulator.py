@@ -0,0 +1,366 @@
+"""
+Emulated Arduino on a pseudo-terminal, for measuring the senders without hardware (Linux and macOS).
+
+The emulator speaks the raw protocol of the sketch: every note is 3 bytes (pitch, duration high byte, duration
+low byte) and is answered with a 0x06 ACK byte. With framed=True it speaks the framed protocol of
+serial_protocol.py instead. Every note is recorded with the time its last byte would have arrived over a real
+link, so the timing error of a sender can be measured against the song.
+
+    python arduino_emulator.py                  # Runs an emulator, start the GUI with ARDUINO_PORT=<printed port>
+    python arduino_emulator.py --song song.mid  # Measures every sender against the song
+    python arduino_emulator.py --song song.mid --devices 3  # Plays the song split by pitch over three emulators
+"""
+import argparse
+import os
+import random
+import select
+import threading
+import time
+import tty
+from collections import deque, namedtuple
+
+from serial_protocol import MSG_BATCH, MSG_CHORD, UNKNOWN_SEQ, FrameDecoder, decode_batch, decode_chord, \
+    encode_ack, encode_nak
+
+ACK = b'\x06'
+NOTE_SIZE = 3
+DEFAULT_BAUD_RATE = 9600
+DEFAULT_PROCESSING_DELAY = 0.002  # Seconds the sketch needs for a note before it answers
+
+ReceivedNote = namedtuple('ReceivedNote', ['time_ns', 'pitch', 'duration_ms'])
+
+
+class ArduinoEmulator:
+    """
+    Pretends to be an Arduino on the slave side of a pty. Host writes never block on a pty, so the baud rate is
+    applied on the emulator side: each byte is only handled once a real link would have delivered it, and replies
+    are paced the same way.
+    """
+
+    def __init__(self, baud_rate=DEFAULT_BAUD_RATE, processing_delay=DEFAULT_PROCESSING_DELAY, loss_rate=0.0,
+                 framed=False, seed=0):
+        """
+        :param baud_rate: Link speed to emulate, None for no throttling.
+        :param processing_delay: Seconds between a complete note or frame and its reply.
+        :param loss_rate: Share of the received bytes that are dropped, as on a noisy line.
+        :param framed: Speak the framed protocol instead of raw 3-byte notes.
+        """
+        self.byte_time_ns = int(10 * 1e9 / baud_rate) if baud_rate else 0  # Start bit, 8 data bits, stop bit
+        self.processing_delay_ns = int(processing_delay * 1e9)
+        self.loss_rate = loss_rate
+        self.framed = framed
+        self.random = random.Random(seed)
+        self.port = None
+        self.notes = []
+        self.stats = {'bytes': 0, 'lost_bytes': 0, 'notes': 0, 'acks': 0, 'naks': 0, 'duplicates': 0}
+        self._master = self._slave = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._line_free_ns = 0  # When the host -> Arduino direction is idle again
+        self._raw_buffer = bytearray()
+        self._decoder = FrameDecoder()
+        self._seen_seqs = deque(maxlen=UNKNOWN_SEQ // 2)  # Retransmits of these are acknowledged, not played again
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        # No echo or newline translation, the protocol is binary
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._run, name='arduino-emulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset(self):
+        """Forgets the recorded notes and any half-received note, e.g. between two measured senders."""
+        self.notes = []
+        self._raw_buffer.clear()
+        self._decoder.buffer.clear()
+        for key in self.stats:
+            self.stats[key] = 0
+
+    def _run(self):
+        while not self._stopping.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            for byte in data:
+                self._receive(byte)
+
+    def _receive(self, byte):
+        # The byte arrives one byte time after the previous one, or after now if the line was idle
+        arrival_ns = max(time.monotonic_ns(), self._line_free_ns) + self.byte_time_ns
+        self._line_free_ns = arrival_ns
+        self.stats['bytes'] += 1
+        if self.loss_rate and self.random.random() < self.loss_rate:
+            self.stats['lost_bytes'] += 1
+            return
+
+        if not self.framed:
+            self._raw_buffer.append(byte)
+            if len(self._raw_buffer) == NOTE_SIZE:
+                pitch, high, low = self._raw_buffer
+                self._raw_buffer.clear()
+                self._play(arrival_ns, [(pitch, (high << 8) | low)])
+                self.stats['acks'] += 1
+                self._reply(arrival_ns, ACK)
+            return
+
+        crc_errors = self._decoder.crc_errors
+        for frame in self._decoder.feed(bytes([byte])):
+            if frame.seq not in self._seen_seqs:
+                self._seen_seqs.append(frame.seq)
+                if frame.msg_type == MSG_CHORD:
+                    self._play(arrival_ns, decode_chord(frame.payload))
+                elif frame.msg_type == MSG_BATCH:
+                    self._play(arrival_ns, decode_batch(frame.payload))
+            else:
+                self.stats['duplicates'] += 1
+            self.stats['acks'] += 1
+            self._reply(arrival_ns, encode_ack(frame.seq))
+        if self._decoder.crc_errors > crc_errors:
+            self.stats['naks'] += 1
+            self._reply(arrival_ns, encode_nak())
+
+    def _play(self, arrival_ns, notes):
+        # Waiting until the link would have delivered the note, so the recorded time is the one a real board sees
+        delay_ns = arrival_ns - time.monotonic_ns()
+        if delay_ns > 0:
+            time.sleep(delay_ns / 1e9)
+        for pitch, duration in notes:
+            self.notes.append(ReceivedNote(arrival_ns, pitch, duration))
+        self.stats['notes'] += len(notes)
+
+    def _reply(self, arrival_ns, data):
+        ready_ns = arrival_ns + self.processing_delay_ns + len(data) * self.byte_time_ns
+        delay_ns = ready_ns - time.monotonic_ns()
+        if delay_ns > 0:
+            time.sleep(delay_ns / 1e9)
+        os.write(self._master, data)
+
+
+def timing_report(expected, received):
+    """
+    Compares received notes with the (time_ms, pitch, ...) events of the song.
+    Notes are paired per pitch in order, and both sides are measured from their first paired note, so the time
+    the sender needed to start does not count as error.
+    """
+    pending = {}
+    for event in expected:
+        pending.setdefault(event[1], deque()).append(event[0])
+
+    pairs = []
+    for note in received:
+        if pending.get(note.pitch):
+            pairs.append((note.time_ns, pending[note.pitch].popleft()))
+    if not pairs:
+        return {'notes': len(received), 'matched': 0, 'mean_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+
+    first_ns, first_ms = min(pairs)
+    errors = sorted(abs((time_ns - first_ns) / 1e6 - (time_ms - first_ms)) for time_ns, time_ms in pairs)
+    return {
+        'notes': len(received),
+        'matched': len(pairs),
+        'mean_ms': sum(errors) / len(errors),
+        'p95_ms': errors[min(len(errors) - 1, int(len(errors) * 0.95))],
+        'max_ms': errors[-1],
+    }
+
+
+def arrival_times(expected, received):
+    """Pairs received notes with the song's events per pitch in order. Returns {event: arrival time in ns}."""
+    pending = {}
+    for event in expected:
+        pending.setdefault(event[1], deque()).append(event)
+    arrivals = {}
+    for note in received:
+        if pending.get(note.pitch):
+            arrivals[pending[note.pitch].popleft()] = note.time_ns
+    return arrivals
+
+
+def alignment_report(expected, received_per_board):
+    """
+    How far apart the boards play notes that start together in the song: for every onset that is split over
+    several boards, the spread between the earliest and the latest arrival.
+    """
+    onsets = {}
+    for board, received in enumerate(received_per_board):
+        for event, time_ns in arrival_times(expected, received).items():
+            onsets.setdefault(event[0], {}).setdefault(board, time_ns)
+    spreads = sorted((max(boards.values()) - min(boards.values())) / 1e6
+                     for boards in onsets.values() if len(boards) > 1)
+    if not spreads:
+        return {'split_chords': 0, 'mean_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+    return {
+        'split_chords': len(spreads),
+        'mean_ms': sum(spreads) / len(spreads),
+        'p95_ms': spreads[min(len(spreads) - 1, int(len(spreads) * 0.95))],
+        'max_ms': spreads[-1],
+    }
+
+
+def measure_sharded(song, emulators):
+    """
+    Plays the song split by pitch over several emulators at once (see multi_device.py), with the scheduled sender
+    of progress_bar.py on every board, and prints the timing of every board and the alignment between them.
+    """
+    from mido import MidiFile
+
+    import progress_bar
+    from lookahead_streamer import note_events_ms
+    from multi_device import ShardedPlayback, even_shards, split_events
+
+    mf = MidiFile(song)
+    expected = note_events_ms(mf)
+    pitches = [event[1] for event in expected] or [60]
+    shards = even_shards([emulator.port for emulator in emulators], min(pitches), max(pitches))
+    senders = {}
+    for shard, emulator in zip(shards, emulators):
+        senders[shard.port] = progress_bar.WorkerThread(song, port=shard.port)
+        senders[shard.port].use_framing = emulator.framed
+
+    def play(shard, part):
+        senders[shard.port].send_midi_to_arduino_updated_timing(part)
+
+    start_time = time.perf_counter()
+    ShardedPlayback(shards).play_midi(mf, play)
+    elapsed = time.perf_counter() - start_time
+
+    print(f"\n{len(expected)} notes in {song} over {len(emulators)} boards in {elapsed:.1f}s")
+    print(f"{'board':<24} {'pitches':>8} {'notes':>6} {'mean ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for shard, emulator, part in zip(shards, emulators, split_events(expected, shards)):
+        report = timing_report(part, emulator.notes)
+        print(f"{shard.port:<24} {f'{shard.min_pitch}-{shard.max_pitch}':>8} {report['notes']:>6} "
+              f"{report['mean_ms']:>8.1f} {report['p95_ms']:>8.1f} {report['max_ms']:>8.1f}")
+    alignment = alignment_report(expected, [emulator.notes for emulator in emulators])
+    print(f"Chords split over several boards: {alignment['split_chords']}, spread between boards "
+          f"mean {alignment['mean_ms']:.1f} ms, 95th percentile {alignment['p95_ms']:.1f} ms, "
+          f"max {alignment['max_ms']:.1f} ms")
+    return alignment
+
+
+def measure_senders(song, emulator, sender_names=None):
+    """Plays the song with every sender of progress_bar.py against the emulator and prints throughput and timing."""
+    from mido import MidiFile
+
+    import progress_bar
+    import serial_connection
+    from lookahead_streamer import note_events_ms
+
+    serial_connection.DEFAULT_PORT = emulator.port
+    connection = serial_connection.get_connection()
+    worker = progress_bar.WorkerThread(song)
+    worker.use_framing = emulator.framed
+    mf = MidiFile(song)
+    expected = note_events_ms(mf)
+
+    senders = {
+        'send_midi_to_arduino': lambda: progress_bar.send_midi_to_arduino(mf),
+        'send_midi_to_arduino_updated': lambda: progress_bar.send_midi_to_arduino_updated(mf),
+        'send_midi_to_arduino_bulk': lambda: progress_bar.send_midi_to_arduino_bulk(mf),
+        'send_midi_to_arduino_updated_timing': lambda: worker.send_midi_to_arduino_updated_timing(mf),
+        'send_midi_to_arduino_batch': lambda: worker.send_midi_to_arduino_batch(mf),
+    }
+    if emulator.framed:
+        # The module-level senders only speak the raw protocol
+        senders = {name: senders[name] for name in ('send_midi_to_arduino_updated_timing', 'send_midi_to_arduino_batch')}
+
+    results = {}
+    for name in sender_names or senders:
+        # Letting late replies of the previous sender arrive, then dropping them
+        time.sleep(0.5)
+        connection.reset_input_buffer()
+        emulator.reset()
+
+        # With the reader thread running, as in WorkerThread.run, so replies are timed when they arrive
+        with worker.session():
+            start_time = time.perf_counter()
+            senders[name]()
+            elapsed = time.perf_counter() - start_time
+
+        report = timing_report(expected, emulator.notes)
+        report['notes_per_s'] = report['notes'] / elapsed if elapsed else 0.0
+        report['seconds'] = elapsed
+        results[name] = report
+
+    print(f"\n{len(expected)} notes in {song}, {'framed' if emulator.framed else 'raw'} protocol")
+    print(f"{'sender':<38} {'notes':>6} {'notes/s':>8} {'mean ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for name, report in results.items():
+        print(f"{name:<38} {report['notes']:>6} {report['notes_per_s']:>8.1f} {report['mean_ms']:>8.1f} "
+              f"{report['p95_ms']:>8.1f} {report['max_ms']:>8.1f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulated Arduino on a pseudo-terminal.")
+    parser.add_argument('--song', help="MIDI file to play with every sender; without it the emulator just runs")
+    parser.add_argument('--senders', nargs='+', help="Only measure these senders")
+    parser.add_argument('--baud', type=int, default=DEFAULT_BAUD_RATE, help="Emulated baud rate, 0 for unlimited")
+    parser.add_argument('--delay', type=float, default=DEFAULT_PROCESSING_DELAY,
+                        help="Seconds of processing before each reply")
+    parser.add_argument('--loss', type=float, default=0.0, help="Share of received bytes to drop (0-1)")
+    parser.add_argument('--framed', action='store_true', help="Speak the framed protocol")
+    parser.add_argument('--devices', type=int, default=1,
+                        help="Number of emulated boards; with --song the song is split over them by pitch")
+    args = parser.parse_args()
+
+    if args.devices > 1:
+        emulators = [ArduinoEmulator(args.baud or None, args.delay, args.loss, args.framed, seed=index).start()
+                     for index in range(args.devices)]
+        try:
+            if args.song:
+                measure_sharded(args.song, emulators)
+                return
+            from multi_device import SHARDS_VARIABLE, even_shards
+
+            # C4 to C5, the range the songs are fitted to
+            shards = even_shards([emulator.port for emulator in emulators], 60, 72)
+            spec = ','.join(f"{shard.port}:{shard.min_pitch}-{shard.max_pitch}" for shard in shards)
+            print(f"Emulated Arduinos, press Ctrl+C to stop. Start the GUI with {SHARDS_VARIABLE}={spec}")
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for emulator in emulators:
+                emulator.stop()
+        return
+
+    with ArduinoEmulator(args.baud or None, args.delay, args.loss, args.framed) as emulator:
+        if args.song:
+            measure_senders(args.song, emulator, args.senders)
+            return
+
+        print(f"Emulated Arduino on {emulator.port}, press Ctrl+C to stop")
+        reported = 0
+        try:
+            while True:
+                time.sleep(1)
+                if emulator.stats['notes'] != reported:
+                    reported = emulator.stats['notes']
+                    print(f"{reported} notes received, {emulator.stats['lost_bytes']} bytes lost")
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import os
+import threading
+
+import numpy as np
+
+AUDIO_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.midi_player', 'audio')
+MAX_AUDIO_CACHE_BYTES = 1024 * 1024 * 1024  # 1 GB, about 3 hours of audio at the Basic Pitch rate
+
+
+class AudioCache:
+    """
+    On-disk cache of decoded and resampled audio, so a song is only decoded once even when it is transcribed again
+    with other inference parameters. Every entry is a <file hash>_<sample rate>.npy file of mono float32 samples,
+    which is memory-mapped when read instead of loaded. File modification times are used as the LRU order.
+    """
+
+    def __init__(self, cache_dir=AUDIO_CACHE_DIR, max_bytes=MAX_AUDIO_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, audio_hash, sample_rate):
+        return os.path.join(self.cache_dir, f"{audio_hash}_{sample_rate}.npy")
+
+    def get(self, audio_hash, sample_rate):
+        """Returns the samples as a read-only memory-mapped array, or None if they are not cached."""
+        path = self._path(audio_hash, sample_rate)
+        try:
+            audio = np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except Exception as e:
+            print(f"Ignoring unreadable audio cache entry {os.path.basename(path)}: {e}")
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Marking the entry as recently used
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+        return audio
+
+    def put(self, audio_hash, sample_rate, audio):
+        path = self._path(audio_hash, sample_rate)
+        # Writing to a temporary file first so a crash never leaves a half-written entry behind
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, np.ascontiguousarray(audio, dtype=np.float32))
+        os.replace(path + '.tmp', path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until the cache fits into max_bytes, never the one just written."""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.npy'):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    # Windows does not delete files that are still memory-mapped
+                    print(f"Could not evict audio cache entry {os.path.basename(path)}: {e}")
+                    continue
+                total_size -= size
+                print(f"Evicted audio cache entry {os.path.basename(path)}")
+
+
+_default_cache = None
+
+
+def get_audio_cache():
+    """Returns the process-wide decoded-audio cache."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = AudioCache()
+    return _default_cache
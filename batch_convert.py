@@ -0,0 +1,143 @@
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import note_table
+from model_registry import get_model, print_model_stats
+from transcription import INFERENCE_PARAMS, load_audio, transcribe_audio
+from transcription_cache import cache_key, get_cache, hash_file
+
+
+def collect_mp3_files(paths):
+    """Expands the given files and folders into a sorted list of MP3 files."""
+    mp3_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith('.mp3'):
+                    mp3_files.append(os.path.join(path, name))
+        elif os.path.isfile(path) and path.lower().endswith('.mp3'):
+            mp3_files.append(path)
+        else:
+            print(f"Skipping {path}: not an MP3 file or folder")
+    return mp3_files
+
+
+def prepare_input(input_file, cache):
+    """Looks the file up in the transcription cache and only decodes the MP3 on a miss."""
+    audio_hash = hash_file(input_file)
+    key = cache_key(input_file, INFERENCE_PARAMS, audio_hash=audio_hash)
+    cached = cache.get(key)
+    if cached is not None:
+        return key, cached, None
+    return key, None, load_audio(input_file, audio_hash)
+
+
+def convert_one(input_file, prepared, output_dir, cache, fit_options):
+    """
+    Transcribes one decoded file and writes its _basic_pitch.mid and adjusted_music.mid.
+    Each input file gets its own subfolder so the adjusted_music.mid files do not overwrite each other.
+    """
+    name = os.path.splitext(os.path.basename(input_file))[0]
+    file_output_dir = os.path.join(output_dir, name)
+    os.makedirs(file_output_dir, exist_ok=True)
+
+    key, cached, audio = prepared
+    if cached is not None:
+        print(f"Using cached transcription for {input_file}")
+        midi_data, note_events = cached
+    else:
+        _, midi_data, note_events = transcribe_audio(audio, get_model(), **INFERENCE_PARAMS)
+        cache.put(key, midi_data, note_events)
+
+    midi_data.write(os.path.join(file_output_dir, name + "_basic_pitch.mid"))
+
+    # Fitted from the note events in memory, as WorkerThread.process does, instead of parsing the MIDI file again
+    fitted = note_table.fit_to_octave_range(note_table.from_note_events(note_events), **fit_options)
+    output_file = os.path.join(file_output_dir, 'adjusted_music.mid')
+    note_table.write_midi(fitted, output_file)
+    return output_file
+
+
+def batch_convert(input_files, output_dir, decode_workers=2, prefetch=4, **fit_options):
+    """
+    Converts many MP3 files with a single loaded model. Files found in the transcription cache are not decoded.
+    Decoding runs in a thread pool and stays up to `prefetch` files ahead of inference.
+    :param input_files: List of MP3 files.
+    :param output_dir: Directory in which a subfolder is created for every file.
+    :param decode_workers: Number of threads decoding MP3 files.
+    :param prefetch: Number of files decoded ahead of the one being transcribed.
+    :return: List of per-file status dicts.
+    """
+    cache = get_cache()
+    report = []
+
+    with ThreadPoolExecutor(max_workers=decode_workers) as pool:
+        pending = [pool.submit(prepare_input, path, cache) for path in input_files[:prefetch]]
+
+        for i, input_file in enumerate(input_files):
+            print(f"[{i + 1}/{len(input_files)}] {input_file}")
+            status = {'file': input_file, 'status': 'ok', 'output': '', 'seconds': 0.0, 'error': ''}
+            start_time = time.perf_counter()
+
+            # Keeping the decoder pool `prefetch` files ahead of inference
+            if i + prefetch < len(input_files):
+                pending.append(pool.submit(prepare_input, input_files[i + prefetch], cache))
+
+            try:
+                prepared = pending[i].result()
+                status['output'] = convert_one(input_file, prepared, output_dir, cache, fit_options)
+            except Exception as e:
+                print(f"Failed to convert {input_file}: {e}")
+                status['status'] = 'failed'
+                status['error'] = str(e)
+            finally:
+                pending[i] = None  # Releasing the decoded audio once it is used
+                prepared = None
+
+            status['seconds'] = round(time.perf_counter() - start_time, 3)
+            report.append(status)
+
+    return report
+
+
+def write_report(report, report_file):
+    with open(report_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['file', 'status', 'output', 'seconds', 'error'])
+        writer.writeheader()
+        writer.writerows(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert many MP3 files to fitted MIDI files in one pass.")
+    parser.add_argument('inputs', nargs='+', help="MP3 files and/or folders containing MP3 files")
+    parser.add_argument('-o', '--output-dir', required=True, help="Directory for the generated MIDI files")
+    parser.add_argument('--decode-workers', type=int, default=2, help="Number of MP3 decoding threads")
+    parser.add_argument('--prefetch', type=int, default=4, help="Number of files decoded ahead of inference")
+    parser.add_argument('--min-note', default='C4')
+    parser.add_argument('--max-note', default='C5')
+    args = parser.parse_args()
+
+    input_files = collect_mp3_files(args.inputs)
+    if not input_files:
+        print("No MP3 files found.")
+        return
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report = batch_convert(input_files, args.output_dir, args.decode_workers, max(1, args.prefetch),
+                           min_note=args.min_note, max_note=args.max_note)
+
+    report_file = os.path.join(args.output_dir, 'batch_report.csv')
+    write_report(report, report_file)
+
+    failed = [r for r in report if r['status'] != 'ok']
+    print(f"Converted {len(report) - len(failed)}/{len(report)} files. Report written to {report_file}")
+    for r in failed:
+        print(f"  FAILED {r['file']}: {r['error']}")
+    print_model_stats()
+
+
+if __name__ == '__main__':
+    main()
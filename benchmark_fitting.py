@@ -0,0 +1,218 @@
+import argparse
+import contextlib
+import copy
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import note_table
+import servo_allocator
+from measure_startup import git_revision
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fitting_baseline.json')
+DEFAULT_SIZES = (1000, 10000, 50000, 200000)
+# music21 needs seconds for a few thousand notes, larger scores are only run with the note table
+DEFAULT_MUSIC21_MAX_NOTES = 10000
+# Differences below these are noise, whatever the relative change
+NOISE_FLOOR_SECONDS = 0.002
+NOISE_FLOOR_BYTES = 64 * 1024
+
+
+def generate_note_events(note_count, chord_density=0.3, overlap_rate=0.2, repeat_rate=0.1, seed=0):
+    """
+    Synthetic Basic Pitch note events (start_s, end_s, pitch, amplitude, pitch_bends) for benchmarking.
+    :param chord_density: Share of the onsets that are chords (2 to 4 notes) instead of single notes.
+    :param overlap_rate: Share of the onsets that keep sounding past the next onset.
+    :param repeat_rate: Share of the chords that repeat the pitches of the previous chord.
+    """
+    rng = random.Random(seed)
+    events = []
+    start = 0.0
+    previous_chord = None
+    while len(events) < note_count:
+        step = rng.choice((0.125, 0.25, 0.375, 0.5))  # Whole grid steps at 120 BPM
+        if rng.random() < chord_density:
+            if previous_chord and rng.random() < repeat_rate:
+                pitches = previous_chord
+            else:
+                pitches = rng.sample(range(36, 97), rng.randint(2, 4))
+            previous_chord = pitches
+        else:
+            # Three octaves around the playable one, so transposition and sharp removal have work to do
+            pitches = [rng.randint(36, 96)]
+
+        if rng.random() < overlap_rate:
+            duration = step * rng.uniform(1.5, 3.0)
+        else:
+            duration = step * rng.uniform(0.5, 1.0)
+        for pitch in pitches[:note_count - len(events)]:
+            events.append((start, start + duration, pitch, rng.uniform(0.2, 1.0), []))
+        start += step
+    return events
+
+
+def measure(stage, prepare, repeat):
+    """
+    Runs stage(*prepare()) repeat times for the fastest time, then once more under tracemalloc for the peak memory.
+    Preparing the input is never measured. Timing runs without tracemalloc, which slows allocations down.
+    """
+    best = None
+    for _ in range(repeat):
+        args = prepare()
+        start_time = time.perf_counter()
+        stage(*args)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+
+    args = prepare()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    stage(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def table_stages(note_events):
+    """(name, stage, prepare) of the note table pipeline, each stage fed with the output of the previous one."""
+    table = note_table.from_note_events(note_events)
+    transposed = note_table.transpose_to_octave(table)
+    unique = note_table.remove_repeating_chords(transposed)
+    shifted = note_table.shift_overlapping_notes(unique)
+    fitted = note_table.fit_to_octave_range(table)
+    return [
+        ('from_note_events', note_table.from_note_events, lambda: (note_events,)),
+        ('transpose_to_octave', note_table.transpose_to_octave, lambda: (table,)),
+        ('remove_repeating_chords', note_table.remove_repeating_chords, lambda: (transposed,)),
+        ('shift_overlapping_notes', note_table.shift_overlapping_notes, lambda: (unique,)),
+        ('remove_sharps', note_table.remove_sharps, lambda: (shifted,)),
+        ('fit_to_octave_range', note_table.fit_to_octave_range, lambda: (table,)),
+        ('allocate_table', servo_allocator.allocate_table, lambda: (fitted,)),
+    ]
+
+
+def music21_stages(note_events, work_dir):
+    """
+    (name, stage, prepare) of the music21 functions in midi_processing.py. They change the score in place, so every
+    run gets its own copy of the input.
+    """
+    from music21 import converter
+
+    import midi_processing
+    from refit import get_parsed_cache
+
+    midi_path = os.path.join(work_dir, 'input.mid')
+    output_path = os.path.join(work_dir, 'output.mid')
+    note_table.write_midi(note_table.from_note_events(note_events), midi_path)
+
+    def uncached_midi():
+        # fit_midi_to_octave_range parses with music21 and then fits a note table. Parsed files are kept in
+        # memory, so the cache is cleared to measure the parse every time.
+        get_parsed_cache().clear()
+        return midi_path, output_path
+
+    score = converter.parse(midi_path)
+    transposed = copy.deepcopy(score)
+    midi_processing.transpose_to_octave(transposed)
+    unique = midi_processing.remove_repeating_chords(transposed)
+    shifted = midi_processing.shift_overlapping_notes(copy.deepcopy(unique))
+    return [
+        ('transpose_to_octave', midi_processing.transpose_to_octave, lambda: (copy.deepcopy(score),)),
+        ('remove_repeating_chords', midi_processing.remove_repeating_chords, lambda: (copy.deepcopy(transposed),)),
+        ('shift_overlapping_notes', midi_processing.shift_overlapping_notes, lambda: (copy.deepcopy(unique),)),
+        ('remove_sharps', midi_processing.remove_sharps, lambda: (copy.deepcopy(shifted),)),
+        ('fit_score_to_octave_range', midi_processing.fit_score_to_octave_range, lambda: (copy.deepcopy(score),)),
+        ('parse_and_fit_table', midi_processing.fit_midi_to_octave_range, uncached_midi),
+    ]
+
+
+def run_benchmarks(sizes, chord_density, overlap_rate, repeat, music21_max_notes):
+    """:return: {'<implementation>/<stage>/<notes>': {'seconds': ..., 'peak_bytes': ...}}"""
+    results = {}
+    for size in sizes:
+        note_events = generate_note_events(size, chord_density, overlap_rate)
+        with tempfile.TemporaryDirectory(prefix='benchmark_fitting_') as work_dir:
+            groups = [('table', table_stages(note_events))]
+            if size <= music21_max_notes:
+                groups.append(('music21', music21_stages(note_events, work_dir)))
+
+            for implementation, stages in groups:
+                for name, stage, prepare in stages:
+                    # remove_sharps prints every note it removes
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                        seconds, peak = measure(stage, prepare, repeat)
+                    key = f"{implementation}/{name}/{size}"
+                    results[key] = {'seconds': seconds, 'peak_bytes': peak}
+                    print(f"{key:<48} {seconds * 1000:10.2f} ms {peak / 2 ** 20:10.2f} MiB")
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """Returns a message for every stage that got slower or bigger than the baseline by more than the threshold."""
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        if (result['seconds'] > reference['seconds'] * (1 + threshold)
+                and result['seconds'] - reference['seconds'] > NOISE_FLOOR_SECONDS):
+            regressions.append(f"{key}: {reference['seconds'] * 1000:.2f} ms -> {result['seconds'] * 1000:.2f} ms")
+        if (result['peak_bytes'] > reference['peak_bytes'] * (1 + threshold)
+                and result['peak_bytes'] - reference['peak_bytes'] > NOISE_FLOOR_BYTES):
+            regressions.append(f"{key}: {reference['peak_bytes'] / 2 ** 20:.2f} MiB -> "
+                               f"{result['peak_bytes'] / 2 ** 20:.2f} MiB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures time and peak memory of every stage of the MIDI fitting "
+                                                 "pipeline on synthetic songs.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help="Note counts to measure")
+    parser.add_argument('--chord-density', type=float, default=0.3, help="Share of onsets that are chords (0-1)")
+    parser.add_argument('--overlap-rate', type=float, default=0.2,
+                        help="Share of onsets that overlap the next one (0-1)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per stage, the fastest one counts")
+    parser.add_argument('--music21-max-notes', type=int, default=DEFAULT_MUSIC21_MAX_NOTES,
+                        help="Largest song to also run through the music21 functions")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="Fail if a stage is this much slower or bigger than the baseline (0.25 = 25%%)")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="Baseline file to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="Store the results as the new baseline")
+    args = parser.parse_args()
+
+    print(f"Chord density {args.chord_density:.0%}, overlap rate {args.overlap_rate:.0%}, "
+          f"best of {args.repeat} run(s)")
+    results = run_benchmarks(args.sizes, args.chord_density, args.overlap_rate, args.repeat,
+                             args.music21_max_notes)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'revision': git_revision(),
+                'results': results,
+            }, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(results, baseline['results'], args.threshold)
+    if regressions:
+        print(f"Regressions against the baseline of {baseline['revision']}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print(f"No stage regressed by more than {args.threshold:.0%} against the baseline of {baseline['revision']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import heapq
+import random
+import time
+
+from flow_control import SlidingWindowSender
+from serial_protocol import FrameDecoder, FrameEncoder, chunk_notes, encode_ack, encode_nak, send_frame, \
+    MAX_CHORD_NOTES
+
+BAUD_RATE = 9600
+BYTE_TIME = 10 / BAUD_RATE  # Start bit, 8 data bits and stop bit
+PROCESSING_TIME = 0.002  # Time the Arduino needs to handle a note or frame before it answers
+
+
+class SimulatedArduino:
+    """
+    Serial port stand-in with the timing of a 9600 baud link: bytes take BYTE_TIME each in both directions and the
+    Arduino answers PROCESSING_TIME after a note or frame has arrived.
+    In 'raw' mode every 3-byte note is answered with a 0x06 byte, in 'framed' mode every frame with an ACK frame.
+    With a loss rate, that share of the frames arrives corrupted (answered with a NAK) or not at all.
+    """
+
+    def __init__(self, mode='framed', loss_rate=0.0, timeout=1, seed=0):
+        self.mode = mode
+        self.loss_rate = loss_rate
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.line_free = 0.0  # When the host -> Arduino direction is idle again
+        self.replies = []  # Heap of (time the byte can be read, sequence, byte)
+        self.reply_count = 0
+        self.raw_buffer = bytearray()
+        self.decoder = FrameDecoder()
+
+    def write(self, data):
+        now = time.monotonic()
+        self.line_free = max(now, self.line_free) + len(data) * BYTE_TIME
+        arrival = self.line_free
+
+        if self.mode == 'raw':
+            self.raw_buffer += data
+            while len(self.raw_buffer) >= 3:
+                del self.raw_buffer[:3]
+                self._reply(arrival, b'\x06')
+            return
+
+        for frame in self.decoder.feed(data):
+            chance = self.random.random()
+            if chance < self.loss_rate / 2:
+                continue  # Lost on the line
+            if chance < self.loss_rate:
+                self._reply(arrival, encode_nak(frame.seq))
+            else:
+                self._reply(arrival, encode_ack(frame.seq))
+
+    def _reply(self, arrival, data):
+        ready = arrival + PROCESSING_TIME
+        for byte in data:
+            ready += BYTE_TIME
+            heapq.heappush(self.replies, (ready, self.reply_count, byte))
+            self.reply_count += 1
+
+    @property
+    def in_waiting(self):
+        now = time.monotonic()
+        return sum(1 for ready, _, _ in self.replies if ready <= now)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + self.timeout
+        data = bytearray()
+        while len(data) < size:
+            now = time.monotonic()
+            if self.replies and self.replies[0][0] <= now:
+                data.append(heapq.heappop(self.replies)[2])
+                continue
+            if data or now >= deadline:
+                break
+            next_ready = self.replies[0][0] if self.replies else deadline
+            time.sleep(max(0.0, min(next_ready, deadline) - now))
+        return bytes(data)
+
+
+def make_chords(count, seed=0):
+    """Chords of one to three notes, the usual output of the fitting stage."""
+    rng = random.Random(seed)
+    return [[(rng.randint(60, 72), 200) for _ in range(rng.randint(1, 3))] for _ in range(count)]
+
+
+def stop_and_wait_raw(port, chords):
+    """The current send_chord_to_arduino loop: one write and a 50 ms pause per note, then one ACK per chord."""
+    for notes in chords:
+        for pitch, duration in notes:
+            port.write(bytes([pitch, duration >> 8, duration & 0xFF]))
+            time.sleep(0.05)
+        start_time = time.time()
+        while time.time() - start_time < 2:
+            if port.read() == b'\x06':
+                break
+    return {}
+
+
+def stop_and_wait_framed(port, chords):
+    """One CHORD frame per chord, waiting for its ACK before the next one."""
+    encoder, decoder = FrameEncoder(), FrameDecoder()
+    failed = 0
+    for notes in chords:
+        for chunk in chunk_notes(notes, MAX_CHORD_NOTES):
+            seq, frame = encoder.chord(chunk)
+            if not send_frame(port, frame, seq, decoder, timeout=0.5):
+                failed += 1
+    return {'failed': failed}
+
+
+def sliding_window(port, chords, window_size):
+    encoder = FrameEncoder()
+    sender = SlidingWindowSender(port, window_size=window_size, retransmit_timeout=0.5)
+    for notes in chords:
+        for chunk in chunk_notes(notes, MAX_CHORD_NOTES):
+            sender.submit(*encoder.chord(chunk))
+        sender.poll()
+    sender.flush()
+    return sender.stats
+
+
+def run(name, sender, mode, chords, loss_rate):
+    port = SimulatedArduino(mode, loss_rate)
+    note_count = sum(len(notes) for notes in chords)
+    start_time = time.perf_counter()
+    stats = sender(port, chords)
+    elapsed = time.perf_counter() - start_time
+    print(f"{name:<28} {note_count / elapsed:8.1f} notes/s  ({elapsed:.2f}s)  {stats or ''}")
+    return note_count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares stop-and-wait sending with the sliding window sender "
+                                                 "over a simulated 9600 baud Arduino link.")
+    parser.add_argument('--chords', type=int, default=60, help="Number of chords to send")
+    parser.add_argument('--loss', type=float, default=0.0, help="Share of frames lost or corrupted (0-1)")
+    parser.add_argument('--windows', type=int, nargs='+', default=[4, 8], help="Window sizes to measure")
+    args = parser.parse_args()
+
+    chords = make_chords(args.chords)
+    print(f"{sum(len(notes) for notes in chords)} notes in {len(chords)} chords, {args.loss:.0%} frame loss")
+
+    baseline = run("stop-and-wait (current)", stop_and_wait_raw, 'raw', chords, 0.0)
+    run("stop-and-wait, framed", stop_and_wait_framed, 'framed', chords, args.loss)
+    for window_size in args.windows:
+        rate = run(f"sliding window of {window_size}",
+                   lambda port, c, w=window_size: sliding_window(port, c, w), 'framed', chords, args.loss)
+        print(f"{'':<28} {rate / baseline:8.1f}x the current loop")
+
+
+if __name__ == '__main__':
+    main()
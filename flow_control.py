@@ -0,0 +1,134 @@
+import time
+
+from link_telemetry import LinkTelemetry
+from serial_protocol import MSG_ACK, MSG_NAK, UNKNOWN_SEQ, FrameDecoder
+
+DEFAULT_WINDOW_SIZE = 8
+# Must stay below half of the sequence number space, so an old ACK is never mistaken for a new frame
+MAX_WINDOW_SIZE = UNKNOWN_SEQ // 2
+DEFAULT_RETRANSMIT_TIMEOUT = 1.0
+# How often a blocking poll checks for replies, instead of blocking in read past a retransmit deadline
+POLL_INTERVAL = 0.001
+
+
+class SlidingWindowSender:
+    """
+    Keeps up to window_size frames in flight instead of waiting for the ACK of every frame before sending the next.
+    Every frame is acknowledged on its own (selective repeat), so only frames that were NAKed or whose ACK did
+    not arrive within retransmit_timeout are sent again.
+    """
+
+    def __init__(self, port, window_size=DEFAULT_WINDOW_SIZE, retransmit_timeout=DEFAULT_RETRANSMIT_TIMEOUT,
+                 max_retries=3, decoder=None, telemetry=None, io=None):
+        """
+        :param port: An open serial.Serial (or anything with write, read and in_waiting).
+        :param decoder: FrameDecoder of the port. Shared with other senders on the same port, if there are any.
+        :param telemetry: LinkTelemetry of the port, for round trips, NAKs, timeouts and retries.
+        :param io: SerialIOEngine of the port. While it runs, replies come from its reader thread instead of
+            being read here, and blocking polls wait on it instead of checking the port every POLL_INTERVAL.
+        """
+        if not 1 <= window_size <= MAX_WINDOW_SIZE:
+            raise ValueError(f"Window size must be between 1 and {MAX_WINDOW_SIZE}")
+        self.port = port
+        self.window_size = window_size
+        self.retransmit_timeout = retransmit_timeout
+        self.max_retries = max_retries
+        self.decoder = decoder or FrameDecoder()
+        self.telemetry = telemetry or LinkTelemetry()
+        self.io = io
+        self.in_flight = {}  # seq -> [frame, last send time, attempts]
+        self.stats = {'sent': 0, 'acked': 0, 'retransmitted': 0, 'failed': 0}
+
+    def submit(self, seq, frame):
+        """Sends a frame, first waiting for a free slot in the window if it is full."""
+        while len(self.in_flight) >= self.window_size:
+            self.poll(block=True)
+        self._transmit(seq, frame, attempts=1)
+        self.stats['sent'] += 1
+
+    def _transmit(self, seq, frame, attempts):
+        self.port.write(frame)
+        self.in_flight[seq] = [frame, time.monotonic(), attempts]
+
+    def poll(self, block=False):
+        """
+        Handles the replies that have arrived so far and retransmits timed out frames.
+        :param block: If nothing has arrived yet, wait for a reply or until the next retransmission is due.
+        """
+        if self.io is not None and self.io.running:
+            for reply in self.io.next_replies(self._time_to_retransmit() if block else 0):
+                self._handle_reply(reply)
+        else:
+            waiting = self.port.in_waiting
+            if block and not waiting:
+                waiting = self._wait_for_reply()
+            if waiting:
+                for reply in self.decoder.feed(self.port.read(waiting), time.monotonic_ns()):
+                    self._handle_reply(reply)
+
+        now = time.monotonic()
+        for seq, (frame, sent_at, attempts) in list(self.in_flight.items()):
+            if now - sent_at >= self.retransmit_timeout:
+                self._retry(seq, frame, attempts, "ACK timeout")
+
+    def _time_to_retransmit(self):
+        """Seconds until the oldest frame in flight is due for retransmission, at least POLL_INTERVAL."""
+        oldest = min((sent_at for _, sent_at, _ in self.in_flight.values()), default=time.monotonic())
+        return max(oldest + self.retransmit_timeout - time.monotonic(), POLL_INTERVAL)
+
+    def _wait_for_reply(self):
+        """Waits until reply bytes arrive or the oldest frame in flight is due for retransmission."""
+        deadline = time.monotonic() + self._time_to_retransmit()
+        while time.monotonic() < deadline:
+            waiting = self.port.in_waiting
+            if waiting:
+                return waiting
+            time.sleep(POLL_INTERVAL)
+        return self.port.in_waiting
+
+    def _handle_reply(self, reply):
+        seq = reply.payload[0] if reply.payload else reply.seq
+        if reply.msg_type == MSG_ACK:
+            entry = self.in_flight.pop(seq, None)
+            if entry is not None:
+                self.stats['acked'] += 1
+                _, sent_at, attempts = entry
+                if attempts == 1:
+                    # The ACK of a retransmitted frame may belong to any of its copies, so only first sends are timed.
+                    # Timed from the arrival of the reply, which may be handled a whole chord later.
+                    received_ns = reply.received_ns if reply.received_ns is not None else time.monotonic_ns()
+                    self.telemetry.record_ack(received_ns - int(sent_at * 1e9))
+        elif reply.msg_type == MSG_NAK:
+            self.telemetry.count('naks')
+            if seq == UNKNOWN_SEQ:
+                # The Arduino could not tell which frame was damaged, so the oldest unacknowledged one is resent
+                if not self.in_flight:
+                    return
+                seq = min(self.in_flight, key=lambda s: self.in_flight[s][1])
+            if seq in self.in_flight:
+                frame, _, attempts = self.in_flight[seq]
+                self._retry(seq, frame, attempts, "NAK")
+
+    def _retry(self, seq, frame, attempts, reason):
+        if reason == "ACK timeout":
+            self.telemetry.count('timeouts')
+        if attempts >= self.max_retries:
+            print(f"Frame {seq} was not acknowledged after {attempts} attempts ({reason}), giving up")
+            del self.in_flight[seq]
+            self.stats['failed'] += 1
+            self.telemetry.count('failures')
+            return
+        print(f"{reason} for frame {seq}, retransmitting ({attempts}/{self.max_retries})")
+        self._transmit(seq, frame, attempts + 1)
+        self.stats['retransmitted'] += 1
+        self.telemetry.count('retries')
+
+    def flush(self, timeout=None):
+        """
+        Waits until every frame in flight is acknowledged or has run out of retries.
+        :return: True if nothing is left in flight.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.in_flight and (deadline is None or time.monotonic() < deadline):
+            self.poll(block=True)
+        return not self.in_flight
@@ -0,0 +1,111 @@
+import time
+from bisect import bisect_right
+
+# Bucket upper bounds in microseconds: four buckets per power of two from 1 µs up to about 17 s,
+# so every recorded value is off by at most 25% and recording is one bisect and one increment
+BUCKET_BOUNDS_US = sorted({(1 << octave) + step * (1 << octave) // 4 for octave in range(25) for step in range(4)})
+
+
+class Histogram:
+    """Latency histogram with logarithmic buckets. Count, mean, min and max are exact, percentiles approximate."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_US) + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+
+    def record(self, duration_ns):
+        self.counts[bisect_right(BUCKET_BOUNDS_US, duration_ns // 1000)] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        if self.min_ns is None or duration_ns < self.min_ns:
+            self.min_ns = duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of the values, in milliseconds."""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                bound_us = BUCKET_BOUNDS_US[index] if index < len(BUCKET_BOUNDS_US) else self.max_ns // 1000
+                return min(bound_us / 1000, self.max_ns / 1e6)
+        return self.max_ns / 1e6
+
+    def summary(self):
+        if not self.count:
+            return "no samples"
+        return (f"{self.count} samples, mean {self.total_ns / self.count / 1e6:.2f} ms, "
+                f"min {self.min_ns / 1e6:.2f} ms, median {self.percentile(0.5):.2f} ms, "
+                f"95th percentile {self.percentile(0.95):.2f} ms, 99th percentile {self.percentile(0.99):.2f} ms, "
+                f"max {self.max_ns / 1e6:.2f} ms")
+
+    def bars(self, width=40):
+        """Text bar chart of the non-empty buckets."""
+        peak = max(self.counts)
+        lines = []
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            bound = f"<{BUCKET_BOUNDS_US[index] / 1000:.3g} ms" if index < len(BUCKET_BOUNDS_US) else "more"
+            lines.append(f"  {bound:>12} {'#' * max(1, count * width // peak):<{width}} {count}")
+        return '\n'.join(lines)
+
+
+class LinkTelemetry:
+    """
+    Counters and histograms for one serial link, kept in memory and printed at the end of a song.
+    Write time is how long port.write blocked (USB and driver), the ACK round trip runs from the last write of a
+    note or frame to its ACK (link and firmware); a round trip much larger than the write time points at the board.
+    """
+
+    COUNTERS = ('writes', 'bytes_out', 'bytes_in', 'acks', 'naks', 'retries', 'timeouts', 'failures')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.write_time = Histogram()
+        self.ack_round_trip = Histogram()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.start_ns = time.perf_counter_ns()
+
+    def record_write(self, byte_count, duration_ns):
+        self.counters['writes'] += 1
+        self.counters['bytes_out'] += byte_count
+        self.write_time.record(duration_ns)
+
+    def record_read(self, byte_count):
+        self.counters['bytes_in'] += byte_count
+
+    def record_ack(self, round_trip_ns):
+        self.counters['acks'] += 1
+        self.ack_round_trip.record(round_trip_ns)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def report(self, histograms=False):
+        elapsed = (time.perf_counter_ns() - self.start_ns) / 1e9
+        counters = self.counters
+        lines = [
+            f"Serial link over {elapsed:.1f}s: {counters['bytes_out']} bytes out "
+            f"({counters['bytes_out'] / elapsed if elapsed else 0:.0f} B/s), {counters['bytes_in']} bytes in, "
+            f"{counters['writes']} writes",
+            f"  {counters['acks']} ACKs, {counters['naks']} NAKs, {counters['retries']} retries, "
+            f"{counters['timeouts']} timeouts, {counters['failures']} failures",
+            f"  Write time: {self.write_time.summary()}",
+            f"  ACK round trip: {self.ack_round_trip.summary()}",
+        ]
+        if histograms:
+            for name, histogram in (('Write time', self.write_time), ('ACK round trip', self.ack_round_trip)):
+                if histogram.count:
+                    lines.append(f"  {name} histogram:")
+                    lines.append(histogram.bars())
+        return '\n'.join(lines)
@@ -0,0 +1,206 @@
+import threading
+import time
+
+from timeline import note_lengths
+from serial_protocol import MSG_EVENTS, MSG_START, MSG_STATUS, FrameDecoder, FrameEncoder, decode_status, \
+    encode_frame, encode_sync, pack_events, send_frame
+
+DEFAULT_LOOKAHEAD_MS = 3000  # How far ahead of the playhead the Arduino's buffer is kept filled
+REFILL_INTERVAL = 0.25  # Seconds between buffer status checks
+STATUS_TIMEOUT = 1.0
+MAX_MISSED_STATUS = 10  # Playback is abandoned after this many unanswered status requests in a row
+MAX_FAILED_SENDS = 10  # Or after this many EVENTS frames in a row that were not acknowledged
+CLOCK_SYNC_INTERVAL = 2.0  # Seconds between SYNC frames when several boards play one song
+MAX_CLOCK_SKEW_MS = 5  # A board whose playhead is further off than this gets a SYNC right away
+
+
+def note_events_ms(mf, min_note_duration=0):
+    """
+    Returns (time_ms, pitch, duration_ms) for every note of a mido MidiFile, sorted by time.
+    Durations come from the matching note_off, so the Arduino gets the real note length.
+    """
+    events = [(start_ns // 1_000_000, pitch, max(length_ns // 1_000_000, min_note_duration))
+              for (start_ns, pitch), lengths in note_lengths(mf).items() for length_ns in lengths]
+    events.sort(key=lambda event: (event[0], event[1]))
+    return events
+
+
+class LookaheadStreamer:
+    """
+    Plays a song from the Arduino's own clock: the events are stored in a ring buffer on the Arduino,
+    which the host keeps topped up lookahead_ms ahead of the playhead. Host timing (slow writes, prints, a busy
+    GUI) only delays the refills, and as long as the buffer does not run empty it never reaches the servos.
+    Songs of any length can be played, since the buffer only ever holds the next few seconds.
+    """
+
+    def __init__(self, port, encoder=None, decoder=None, lookahead_ms=DEFAULT_LOOKAHEAD_MS,
+                 refill_interval=REFILL_INTERVAL, telemetry=None, io=None, start_barrier=None,
+                 clock_sync_interval=None):
+        """
+        :param start_barrier: threading.Barrier shared by the streamers of all boards playing the song. Each one
+            fills its buffer and waits at the barrier, so all clocks are started together.
+        :param clock_sync_interval: Seconds between SYNC frames that set the Arduino's clock to the host's,
+            None to let the Arduino's clock run free.
+        """
+        self.port = port
+        self.encoder = encoder or FrameEncoder()
+        self.decoder = decoder or FrameDecoder()
+        self.telemetry = telemetry
+        self.io = io  # SerialIOEngine of the port, replies come from its reader thread while it runs
+        self.lookahead_ms = lookahead_ms
+        self.refill_interval = refill_interval
+        self.start_barrier = start_barrier
+        self.clock_sync_interval = clock_sync_interval
+        self.start_ns = None  # Host time the Arduino's clock was started
+        self.last_sync_ns = None
+        self.status_round_trip_ns = 0
+        self.failed_sends = 0  # EVENTS frames in a row that were not acknowledged
+        self.stats = {'frames': 0, 'events': 0, 'underruns': 0, 'min_lead_ms': None, 'syncs': 0,
+                      'max_skew_ms': 0}
+
+    def request_status(self, timeout=STATUS_TIMEOUT):
+        """Asks the Arduino for its playhead and buffer fill. Returns a Status, or None if it did not answer."""
+        start_ns = time.monotonic_ns()
+        status = self._request_status(timeout)
+        if status is not None:
+            self.status_round_trip_ns = time.monotonic_ns() - start_ns
+            if self.start_ns is not None:
+                # The playhead was read about halfway through the round trip
+                host_ms = (start_ns + self.status_round_trip_ns // 2 - self.start_ns) / 1e6
+                skew_ms = abs(status.playhead_ms - host_ms)
+                self.stats['max_skew_ms'] = max(self.stats['max_skew_ms'], round(skew_ms))
+                if self.clock_sync_interval is not None and skew_ms > MAX_CLOCK_SKEW_MS:
+                    self.last_sync_ns = None  # Sync on the next check instead of waiting for the interval
+        return status
+
+    def _request_status(self, timeout):
+        if self.io is not None and self.io.running:
+            self.io.discard(MSG_STATUS)  # Late replies to earlier requests would report an old playhead
+        self.port.write(encode_frame(MSG_STATUS, self.encoder.next_seq()))
+        if self.io is not None and self.io.running:
+            reply = self.io.wait_for_message(MSG_STATUS, timeout)
+            return decode_status(reply.payload) if reply is not None else None
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            data = self.port.read(self.port.in_waiting or 1)
+            if not data:
+                continue
+            for reply in self.decoder.feed(data):
+                if reply.msg_type == MSG_STATUS:
+                    return decode_status(reply.payload)
+        return None
+
+    def sync_clock(self):
+        """
+        Sets the Arduino's clock to the host's song time, plus half the last status round trip for the time the
+        frame takes to arrive. Keeps boards that were started together from drifting apart.
+        :return: True if the Arduino acknowledged the SYNC frame.
+        """
+        self.last_sync_ns = time.monotonic_ns()
+        song_ms = (self.last_sync_ns - self.start_ns + self.status_round_trip_ns // 2) // 1_000_000
+        seq = self.encoder.next_seq()
+        if not send_frame(self.port, encode_sync(seq, song_ms), seq, self.decoder, telemetry=self.telemetry,
+                          io=self.io):
+            print("Arduino did not acknowledge the clock sync")
+            return False
+        self.stats['syncs'] += 1
+        return True
+
+    def _sync_due(self):
+        if self.clock_sync_interval is None:
+            return False
+        return self.last_sync_ns is None or time.monotonic_ns() - self.last_sync_ns >= self.clock_sync_interval * 1e9
+
+    def send_events(self, first_index, events):
+        """
+        Sends events starting at the given stream index in one EVENTS frame.
+        :return: Number of events that fit into the frame and were acknowledged, 0 if the frame was not.
+        """
+        payload, count = pack_events(first_index, events)
+        seq = self.encoder.next_seq()
+        if not send_frame(self.port, encode_frame(MSG_EVENTS, seq, payload), seq, self.decoder,
+                          telemetry=self.telemetry, io=self.io):
+            self.failed_sends += 1
+            return 0
+        self.failed_sends = 0
+        self.stats['frames'] += 1
+        self.stats['events'] += count
+        return count
+
+    def fill(self, events, index, free, horizon_ms):
+        """Sends events from index on until the buffer is full or the next event is past the horizon."""
+        while free > 0 and index < len(events) and events[index][0] <= horizon_ms:
+            end = index
+            while end < len(events) and end - index < free and events[end][0] <= horizon_ms:
+                end += 1
+            sent = self.send_events(index, events[index:end])
+            if not sent:
+                break
+            index += sent
+            free -= sent
+        return index
+
+    def play(self, events):
+        """
+        Streams (time_ms, pitch, duration_ms) events to the Arduino and returns once the last note has played.
+        :return: True if the whole song was sent.
+        """
+        status = self.request_status()
+        if status is None:
+            print("Arduino did not report its buffer state, is the ring buffer firmware installed?")
+            if self.start_barrier is not None:
+                self.start_barrier.abort()  # The other boards would wait for this one forever
+            return False
+        print(f"Arduino buffer holds {status.capacity} events, keeping {self.lookahead_ms} ms ahead of the playhead")
+
+        # Filling the buffer before the clock starts, so the first notes are never late
+        index = self.fill(events, 0, status.capacity - status.buffered, self.lookahead_ms)
+        if self.start_barrier is not None:
+            try:
+                self.start_barrier.wait()
+            except threading.BrokenBarrierError:
+                print("Another board failed before playback started")
+                return False
+        seq = self.encoder.next_seq()
+        self.start_ns = time.monotonic_ns()
+        if not send_frame(self.port, encode_frame(MSG_START, seq), seq, self.decoder, telemetry=self.telemetry,
+                          io=self.io):
+            print("Arduino did not acknowledge the start of playback")
+            return False
+        self.last_sync_ns = time.monotonic_ns()
+
+        song_end_ms = max((time_ms + duration for time_ms, _, duration in events), default=0)
+        playhead_ms = 0
+        missed = 0
+        while index < len(events) or playhead_ms < song_end_ms:
+            time.sleep(self.refill_interval)
+            status = self.request_status()
+            if status is None:
+                missed += 1
+                if missed >= MAX_MISSED_STATUS:
+                    print("Arduino stopped answering, giving up")
+                    return False
+                print("No buffer status from Arduino, retrying...")
+                continue
+            missed = 0
+            playhead_ms = status.playhead_ms
+            if self._sync_due():
+                self.sync_clock()
+
+            if index < len(events):
+                lead_ms = events[index - 1][0] - playhead_ms if index else 0
+                if self.stats['min_lead_ms'] is None or lead_ms < self.stats['min_lead_ms']:
+                    self.stats['min_lead_ms'] = lead_ms
+                if status.buffered == 0 and events[index][0] < playhead_ms:
+                    self.stats['underruns'] += 1
+                    print(f"Arduino buffer ran empty at {playhead_ms} ms, notes will be late")
+                index = self.fill(events, index, status.capacity - status.buffered, playhead_ms + self.lookahead_ms)
+                if self.failed_sends >= MAX_FAILED_SENDS:
+                    print("Arduino keeps rejecting the events, giving up")
+                    return False
+
+        print(f"Streamed {self.stats['events']} events in {self.stats['frames']} frames, "
+              f"{self.stats['underruns']} underrun(s), smallest lead {self.stats['min_lead_ms']} ms")
+        if self.clock_sync_interval is not None:
+            print(f"{self.stats['syncs']} clock sync(s), largest skew {self.stats['max_skew_ms']} ms")
+        return index == len(events)
@@ -0,0 +1,113 @@
+import argparse
+import csv
+import datetime
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that must not be imported before the window is shown
+HEAVY_MODULES = ('tensorflow', 'basic_pitch', 'librosa', 'music21')
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_times.csv')
+
+# Runs in a fresh interpreter: builds the window, lets Qt show it and reports which heavy modules got loaded
+PROBE = """
+import sys
+from PyQt5.QtWidgets import QApplication
+app = QApplication(sys.argv)
+import {app_module}
+window = {app_module}.MP3ToMIDIApp()
+window.show()
+app.processEvents()
+print('SHOWN', ','.join(name for name in {heavy_modules!r} if name in sys.modules), flush=True)
+"""
+
+
+def measure_once(app_module, offscreen=False):
+    """
+    Starts the GUI in a new process and returns (seconds until the window was shown, loaded heavy modules).
+    The time includes interpreter startup, like launching the app from a shortcut.
+    """
+    env = dict(os.environ)
+    if offscreen:
+        env['QT_QPA_PLATFORM'] = 'offscreen'
+
+    code = PROBE.format(app_module=app_module, heavy_modules=HEAVY_MODULES)
+    start_time = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, text=True, env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        for line in process.stdout:
+            if line.startswith('SHOWN'):
+                elapsed = time.perf_counter() - start_time
+                loaded = line.split(maxsplit=1)[1].strip() if len(line.split()) > 1 else ''
+                return elapsed, [name for name in loaded.split(',') if name]
+    finally:
+        process.kill()
+        process.wait()
+    raise RuntimeError(f"{app_module} exited before its window was shown")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def append_result(row, results_file=RESULTS_FILE):
+    """Appends one measurement to the CSV file, so startup time can be followed from release to release."""
+    new_file = not os.path.exists(results_file)
+    with open(results_file, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(row))
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the time from launching the GUI until its window is shown.")
+    parser.add_argument('--app', default='progress_bar', help="GUI module to start (progress_bar or midi_testing)")
+    parser.add_argument('--runs', type=int, default=5, help="Number of cold starts to measure")
+    parser.add_argument('--budget', type=float, default=1.0, help="Fail if the median startup takes longer (seconds)")
+    parser.add_argument('--offscreen', action='store_true', help="Use Qt's offscreen platform (no display needed)")
+    parser.add_argument('--no-save', action='store_true', help=f"Do not append the result to {RESULTS_FILE}")
+    args = parser.parse_args()
+
+    times = []
+    heavy_loaded = set()
+    for run in range(args.runs):
+        elapsed, loaded = measure_once(args.app, args.offscreen)
+        times.append(elapsed)
+        heavy_loaded.update(loaded)
+        print(f"Run {run + 1}/{args.runs}: window shown after {elapsed:.3f}s")
+
+    median = statistics.median(times)
+    print(f"{args.app}: median {median:.3f}s, min {min(times):.3f}s, max {max(times):.3f}s")
+
+    if not args.no_save:
+        append_result({
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'app': args.app,
+            'runs': args.runs,
+            'median_s': round(median, 4),
+            'min_s': round(min(times), 4),
+            'max_s': round(max(times), 4),
+            'heavy_modules': ' '.join(sorted(heavy_loaded)),
+        })
+
+    failed = False
+    if heavy_loaded:
+        print(f"Heavy modules were imported before the window was shown: {', '.join(sorted(heavy_loaded))}")
+        failed = True
+    if median > args.budget:
+        print(f"Startup took longer than the {args.budget:.2f}s budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+from music21 import note, chord, midi, stream
+
+import note_table
+from overlap_engine import cascade_shift
+from refit import get_parsed_cache
+from tracing import span
+
+
+def fit_midi_to_octave_range(midi_file, output_file, min_note='C4', max_note='C5', gap_duration=0.2,
+                             tempo_factor=2.5, duration_extension=0.5):
+    """
+    Fits the notes of a MIDI file into the playable octave range and writes the result to output_file.
+    The fitting itself runs on a note table (see note_table.py) instead of music21 objects. The parsed file is kept
+    in memory, so fitting it again with other limits does not parse it again (see refit.py).
+    :param midi_file: Path to the MIDI file produced by Basic Pitch.
+    :param output_file: Path of the adjusted MIDI file to write.
+    """
+    table = get_parsed_cache().get(midi_file)
+    with span('fit'):
+        fitted = note_table.fit_to_octave_range(table, min_note, max_note)
+    with span('write MIDI'):
+        note_table.write_midi(fitted, output_file)
+    return output_file
+
+
+def fit_notes_to_octave_range(note_events, min_note='C4', max_note='C5', gap_duration=0.2, tempo_factor=2.5,
+                              duration_extension=0.5, midi_tempo=120):
+    """
+    Fits Basic Pitch note events (as returned by basic_pitch.inference.predict) without going through a MIDI file
+    or music21.
+    :return: The fitted note table.
+    """
+    table = note_table.from_note_events(note_events, midi_tempo)
+    return note_table.fit_to_octave_range(table, min_note, max_note)
+
+
+def fit_score_to_octave_range(score, min_note='C4', max_note='C5', gap_duration=0.2, tempo_factor=2.5,
+                              duration_extension=0.5, shift_overlaps=False):
+    """
+    music21 version of the fitting pipeline, kept as the reference for the note table version.
+    :param shift_overlaps: Shift overlapping notes. Off by default, since the old shift never changed the score.
+    """
+    transpose_to_octave(score, min_note, max_note)
+
+    # Remove repeating chords
+    unique_score = remove_repeating_chords(score)
+
+    # Shift overlapping notes instead of cutting them off
+    smooth_score = shift_overlapping_notes(unique_score) if shift_overlaps else unique_score
+
+    # Removing sharp notes
+    remove_sharps(smooth_score)
+    return smooth_score
+
+
+def export_midi(score, output_file):
+    """Writes a music21 stream to a MIDI file."""
+    mf = midi.translate.music21ObjectToMidiFile(score)
+    mf.open(output_file, 'wb')
+    mf.write()
+    mf.close()
+    return output_file
+
+
+def transpose_to_octave(score, min_note='C4', max_note='C5'):
+    lower_pitch = note.Pitch(min_note)
+    upper_pitch = note.Pitch(max_note)
+    original_notes = []
+
+    for element in score.flat.notesAndRests:
+        if isinstance(element, note.Note):
+            if element.pitch < lower_pitch:
+                # Transpose up to the nearest note within the octave range
+                transposition = 12  # One octave up
+                element.pitch = element.pitch.transpose(transposition)
+            elif element.pitch > upper_pitch:
+                # Transpose down to the nearest note within the octave range
+                transposition = -12  # One octave down
+                element.pitch = element.pitch.transpose(transposition)
+            else:
+                original_notes.append(element)  # Keep original notes
+        elif isinstance(element, chord.Chord):
+            new_pitches = []
+            for pitch in element.pitches:
+                if pitch < lower_pitch:
+                    pitch = pitch.transpose('P8')  # Transpose up
+                elif pitch > upper_pitch:
+                    pitch = pitch.transpose('-P8')  # Transpose down
+                else:
+                    original_notes.append(note.Note(pitch))  # Keep original notes
+                new_pitches.append(pitch)  # Always add the transposed pitch
+            element.pitches = new_pitches
+
+    return original_notes
+
+
+def remove_repeating_chords(score):
+    """Remove consecutive repeating chords."""
+    unique_chords = []
+    prev_chord = None
+
+    for element in score.flat.notesAndRests:
+        if isinstance(element, chord.Chord):
+            chord_pitches = sorted([p.midi for p in element.pitches])  # Use sorted MIDI values to compare
+            if chord_pitches != prev_chord:
+                unique_chords.append(element)
+                prev_chord = chord_pitches
+        else:
+            unique_chords.append(element)
+
+    return stream.Stream(unique_chords)
+
+
+def remove_sharps(score):
+    """Remove all sharp notes from the score."""
+    notes_to_remove = []
+
+    print("Identifying sharp notes to remove...")
+    for element in score.flatten().notesAndRests:
+        if isinstance(element, note.Note):
+            if '#' in element.nameWithOctave:
+                notes_to_remove.append(element)
+                print(f"Found sharp note: {element.nameWithOctave}")
+        elif isinstance(element, chord.Chord):
+            # Remove pitches from chord that are sharps
+            new_pitches = [pitch for pitch in element.pitches if '#' not in pitch.nameWithOctave]
+            if len(new_pitches) != len(element.pitches):
+                chord_pitches = ', '.join(p.nameWithOctave for p in element.pitches)
+                print(f"Chord {chord_pitches} had sharps and is being modified.")
+            element.pitches = new_pitches
+
+            # If no pitches remain in the chord, mark it for removal
+            if not element.pitches:
+                notes_to_remove.append(element)
+                print(f"Chord {chord_pitches} has no remaining pitches and will be removed.")
+
+    # Remove sharp notes from the score
+    for note_to_remove in notes_to_remove:
+        if isinstance(note_to_remove, note.Note):
+            print(f"Removing note: {note_to_remove.nameWithOctave}")
+        else:
+            print(f"Removing chord with pitches: {', '.join(p.nameWithOctave for p in note_to_remove.pitches)}")
+    remove_elements(score, notes_to_remove)
+
+
+def remove_elements(score, elements):
+    """
+    Removes many elements from a stream at once.
+    Stream.remove looks every element up on its own, so removing thousands of notes one by one is quadratic;
+    a flat stream is instead rebuilt in a single pass without the removed elements.
+    """
+    remove_ids = {id(element) for element in elements}
+    if not remove_ids:
+        return
+    if not score.isFlat:
+        # Only the top level of a nested stream, like Stream.remove without recurse
+        score.remove([element for element in score if id(element) in remove_ids])
+        return
+
+    kept = stream.Stream()
+    for element in score.elements:
+        if id(element) in remove_ids:
+            element.sites.remove(score)
+            element.activeSite = None
+        elif score.elementOffset(element, returnSpecial=True) == 'highestTime':
+            kept.coreStoreAtEnd(element)
+        else:
+            kept.coreInsert(score.elementOffset(element), element)
+    kept.coreElementsChanged()
+    score.elements = kept
+
+
+def shift_overlapping_notes(score):
+    """
+    Shift overlapping notes instead of cutting them off.
+    Every note or chord that starts before the previous one ends is moved to the end of the previous one,
+    so the shifts cascade; a rest between two elements stops the cascade.
+    :return: A flat stream with the shifted offsets.
+    """
+    flat = score.flatten()
+    elements = list(flat.notesAndRests)
+    if not elements:
+        return flat
+
+    is_sounding = [isinstance(element, (note.Note, chord.Chord)) for element in elements]
+    breaks = [True] + [not (previous and current) for previous, current in zip(is_sounding, is_sounding[1:])]
+    onsets = [flat.elementOffset(element) for element in elements]
+    durations = [element.quarterLength for element in elements]
+
+    for element, onset, new_onset in zip(elements, onsets, cascade_shift(onsets, durations, breaks).tolist()):
+        if new_onset != onset:
+            flat.coreSetElementOffset(element, new_onset)
+    flat.coreElementsChanged()
+    return flat
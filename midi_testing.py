@@ -1,13 +1,14 @@
 import sys
 import os
-import time
 import serial
-from PyQt5.QtCore import Qt, QMimeData, QUrl
+from PyQt5.QtCore import Qt, QMimeData, QTimer, QUrl
 from PyQt5.QtGui import QDragEnterEvent, QDropEvent
 from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QVBoxLayout, QWidget, QPushButton, QFileDialog
-from basic_pitch import ICASSP_2022_MODEL_PATH
-from basic_pitch.inference import predict_and_save, Model
-from music21 import converter, note, chord, midi, stream
+
+import note_table
+from model_registry import preload_in_background, print_model_stats
+
+# basic_pitch (TensorFlow) and music21 are imported where they are used, so the window opens without waiting for them
 
 # Arduino configuration
 # arduino_port = 'COM3'
@@ -15,7 +16,7 @@ from music21 import converter, note, chord, midi, stream
 #
 # # Initializing Arduino connection
 # arduino = serial.Serial(arduino_port, baud_rate)
-time.sleep(2)  # Waiting for connection to establish
+# time.sleep(2)  # Waiting for connection to establish
 
 # atexit.register(lambda: arduino.close() if arduino.is_open else None)
 
@@ -129,6 +130,7 @@ class MP3ToMIDIApp(QMainWindow):
         self.show_message("Converting MP3 to MIDI...")
         # Converting MP3 to MIDI
         midi_file = self.convert_mp3_to_midi(self.input_file, self.output_dir)
+        print_model_stats()
 
         self.show_message("Fitting MIDI notes to octave range...")
         # Fitting MIDI notes to octave range and send to Arduino
@@ -139,42 +141,25 @@ class MP3ToMIDIApp(QMainWindow):
         print("MIDI notes sent to Arduino")
 
     @staticmethod
-    def convert_mp3_to_midi(input_dir, output_dir):
-        basic_pitch_model = Model(ICASSP_2022_MODEL_PATH)
-        # Generalizing the output MIDI file name based on the input filename
-        midi_filename = os.path.splitext(os.path.basename(input_dir))[0] + "_basic_pitch.mid"
-
-        predict_and_save(
-            audio_path_list=[input_dir],
-            output_directory=output_dir,
-            model_or_model_path=ICASSP_2022_MODEL_PATH,
-            save_midi=True,
-            save_model_outputs=True,
-            sonify_midi=True,
-            save_notes=True
-        )
-        return os.path.join(output_dir, midi_filename)
+    def convert_mp3_to_midi(input_dir, output_dir, **inference_params):
+        from transcription import transcribe_and_save
+
+        # Reusing the model loaded by an earlier conversion, if any, and the decoded audio of an earlier run
+        return transcribe_and_save(input_dir, output_dir, save_model_outputs=True, sonify_midi=True, save_notes=True,
+                                   **inference_params)
 
     @staticmethod
     def fit_midi_to_octave_range(midi_file, output_file, min_note='C4', max_note='C5', gap_duration=0.2, tempo_factor=2.5, duration_extension=0.5):
-        # Loading the MIDI file
-        score = converter.parse(midi_file)
-
-        # Transposing to the specified octave range
-        original_notes = transpose_to_octave(score, min_note, max_note)
+        from refit import Refitter
 
-        # Moving sharps up to their next natural note
-        move_sharps_up(score)
-
-        # Smooth the notes and add gaps
-        smooth_score = smooth_notes_and_add_gaps(score, tempo_factor, duration_extension, gap_duration, original_notes)
+        # Transposing to the specified octave range, moving sharps up to their next natural note, then smoothing the
+        # notes and adding gaps. The parsed file stays in memory, so another try with other values skips music21.
+        table = Refitter.for_midi_file(midi_file).refit(min_note=min_note, max_note=max_note,
+                                                        gap_duration=gap_duration, tempo_factor=tempo_factor,
+                                                        duration_extension=duration_extension, smooth_timing=True)
 
         # Saving the transposed score to a new MIDI file
-        mf = midi.translate.music21ObjectToMidiFile(smooth_score)
-        mf.open(output_file, 'wb')
-        mf.write()
-        mf.close()
-        return output_file
+        return note_table.write_midi(table, output_file)
 
     def midi_to_arduino(self, midi_file):
         print("Sending to arduino!")
@@ -190,6 +175,8 @@ class MP3ToMIDIApp(QMainWindow):
 # MIDI processing functions
 def transpose_to_octave(score, min_note='C4', max_note='C5'):
     """Transpose notes and chords to fit within the specified octave range more efficiently."""
+    from music21 import chord, note
+
     lower_pitch = note.Pitch(min_note)
     upper_pitch = note.Pitch(max_note)
     original_notes = []
@@ -217,6 +204,8 @@ def transpose_to_octave(score, min_note='C4', max_note='C5'):
 
 def move_sharps_up(score):
     """Move sharp notes up to their next natural counterpart."""
+    from music21 import chord, note
+
     for element in score.flat.notesAndRests:
         if isinstance(element, note.Note) and '#' in element.nameWithOctave:
             new_pitch = element.pitch.transpose(1)
@@ -234,6 +223,8 @@ def move_sharps_up(score):
 
 def smooth_notes_and_add_gaps(score, tempo_factor, duration_extension, gap_duration, original_notes):
     """Adjust note durations and offsets to avoid overlaps and ensure smooth flow."""
+    from music21 import chord, note, stream
+
     active_notes = {}
     modified_elements = []
 
@@ -281,6 +272,7 @@ if __name__ == '__main__':
         app = QApplication(sys.argv)
         ex = MP3ToMIDIApp()
         ex.show()
+        QTimer.singleShot(0, preload_in_background)
         sys.exit(app.exec_())
     # finally:
         # if arduino.is_open:
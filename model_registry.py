@@ -0,0 +1,90 @@
+import threading
+import time
+
+# basic_pitch (and with it TensorFlow) is only imported when a model is needed, so importing the registry is cheap
+# Process-wide cache of loaded Basic Pitch models, keyed by model path
+_models = {}
+_lock = threading.Lock()
+_stats = {
+    'loads': 0,
+    'hits': 0,
+    'load_time': 0.0,  # Total seconds spent loading models from disk
+}
+
+
+def default_model_path():
+    from basic_pitch import ICASSP_2022_MODEL_PATH
+    return ICASSP_2022_MODEL_PATH
+
+
+def get_model(model_path=None):
+    """
+    Returns the loaded Basic Pitch model for the given path, loading it only the first time.
+    The same model object is shared by every conversion in the process.
+    :param model_path: Path to the saved Basic Pitch model, the default ICASSP 2022 model if None.
+    """
+    from basic_pitch.inference import Model
+
+    model_path = model_path or default_model_path()
+    key = str(model_path)
+    with _lock:
+        model = _models.get(key)
+        if model is not None:
+            _stats['hits'] += 1
+            return model
+
+        print(f"Loading Basic Pitch model from {key}...")
+        start_time = time.perf_counter()
+        model = Model(model_path)
+        load_time = time.perf_counter() - start_time
+
+        _models[key] = model
+        _stats['loads'] += 1
+        _stats['load_time'] += load_time
+        print(f"Model loaded in {load_time:.2f}s")
+        return model
+
+
+def is_loaded(model_path=None):
+    with _lock:
+        return str(model_path or default_model_path()) in _models
+
+
+def model_stats():
+    """Returns a copy of the load count, cache hit count and total load time of the registry."""
+    with _lock:
+        stats = dict(_stats)
+    requests = stats['loads'] + stats['hits']
+    stats['hit_rate'] = stats['hits'] / requests if requests else 0.0
+    return stats
+
+
+def print_model_stats():
+    stats = model_stats()
+    print(f"Model registry: {stats['loads']} load(s) in {stats['load_time']:.2f}s, "
+          f"{stats['hits']} cache hit(s) ({stats['hit_rate']:.0%} hit rate)")
+
+
+def preload_in_background(on_done=None):
+    """
+    Imports the transcription and fitting modules and loads the default model on a daemon thread,
+    so the first conversion does not wait for TensorFlow and music21 while the window stays responsive.
+    :param on_done: Called on the preload thread with the elapsed seconds once everything is loaded.
+    """
+    def preload():
+        start_time = time.perf_counter()
+        try:
+            import midi_processing  # noqa: F401 (music21)
+            import streaming  # noqa: F401 (basic_pitch, librosa)
+            get_model()
+        except Exception as e:
+            print(f"Preloading failed, modules will be loaded on first use: {e}")
+            return
+        elapsed = time.perf_counter() - start_time
+        print(f"Preloaded transcription and fitting modules in {elapsed:.2f}s")
+        if on_done is not None:
+            on_done(elapsed)
+
+    thread = threading.Thread(target=preload, name='preload', daemon=True)
+    thread.start()
+    return thread
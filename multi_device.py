@@ -0,0 +1,189 @@
+"""
+Plays one song on several Arduinos at once, each driving the servos of its own pitch range.
+
+One board at 9600 baud only takes a few dozen notes per second. With the song split by pitch, every board gets
+only its share of the notes over its own serial link:
+
+    ARDUINO_SHARDS=COM13:C4-F4,COM14:F#4-C5 python progress_bar.py
+
+Every board is played by its own thread with any of the senders, and all of them start at the same moment:
+senders that use PlaybackScheduler count their deadlines from that shared start, so a chord split over two boards
+is sent to both at the same time. Boards that play from their own buffer (USE_DEVICE_BUFFER) are started together
+and then kept in step with SYNC frames, see LookaheadStreamer.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+
+from mido import MidiFile, MidiTrack
+
+from note_table import note_name_to_midi
+from playback_scheduler import shared_start
+from serial_connection import get_connection
+
+SHARDS_VARIABLE = 'ARDUINO_SHARDS'
+START_LEAD = 0.2  # Seconds between agreeing on the start and the first note, so every thread is waiting by then
+
+DeviceShard = namedtuple('DeviceShard', ['port', 'min_pitch', 'max_pitch'])
+
+
+def parse_pitch(text):
+    """Accepts a MIDI number ('60') or a note name ('C4', 'F#4')."""
+    text = text.strip()
+    return int(text) if text.isdigit() else note_name_to_midi(text)
+
+
+def parse_shards(spec):
+    """
+    Parses 'port:lowest-highest' entries separated by commas, e.g. 'COM13:C4-F4,COM14:F#4-C5' or '/dev/ttyUSB0:60-65'.
+    Both ends of a range are included. Ranges may not overlap, since every note has to go to exactly one board.
+    :return: List of DeviceShard, empty for an empty spec.
+    """
+    shards = []
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        # Ports can contain colons themselves (e.g. on macOS), the range is after the last one
+        port, separator, pitch_range = entry.rpartition(':')
+        lowest, dash, highest = pitch_range.partition('-')
+        if not separator or not port or not dash:
+            raise ValueError(f"Expected port:lowest-highest, got {entry!r}")
+        shard = DeviceShard(port, parse_pitch(lowest), parse_pitch(highest))
+        if shard.min_pitch > shard.max_pitch:
+            raise ValueError(f"Empty pitch range in {entry!r}")
+        shards.append(shard)
+
+    ordered = sorted(shards, key=lambda s: s.min_pitch)
+    for previous, shard in zip(ordered, ordered[1:]):
+        if shard.min_pitch <= previous.max_pitch:
+            raise ValueError(f"Pitch ranges of {previous.port} and {shard.port} overlap")
+    if len({shard.port for shard in shards}) < len(shards):
+        raise ValueError("Every port can only be given once")
+    return shards
+
+
+def shards_from_environment():
+    return parse_shards(os.environ.get(SHARDS_VARIABLE, ''))
+
+
+def even_shards(ports, min_pitch, max_pitch):
+    """Splits a pitch range into equal parts, one per port. Handy for emulated boards."""
+    count = len(ports)
+    size = max_pitch - min_pitch + 1
+    return [DeviceShard(port, min_pitch + size * index // count, min_pitch + size * (index + 1) // count - 1)
+            for index, port in enumerate(ports)]
+
+
+def shard_index(shards, pitch):
+    """Index of the shard that plays the pitch, or None if no board has it."""
+    for index, shard in enumerate(shards):
+        if shard.min_pitch <= pitch <= shard.max_pitch:
+            return index
+    return None
+
+
+def split_midi_file(mf, shards):
+    """
+    Returns one mido MidiFile per shard with only the notes of its pitch range. Tempo changes and all other
+    non-note messages go to every part, and delta times are recomputed so every note keeps its time in the song.
+    Notes outside every range are dropped.
+    """
+    parts = [MidiFile(type=mf.type, ticks_per_beat=mf.ticks_per_beat) for _ in shards]
+    dropped = 0
+    for track in mf.tracks:
+        part_tracks = [MidiTrack() for _ in shards]
+        last_ticks = [0] * len(shards)
+        tick = 0
+        for msg in track:
+            tick += msg.time
+            if hasattr(msg, 'note'):
+                index = shard_index(shards, msg.note)
+                if index is None:
+                    if msg.type == 'note_on' and msg.velocity > 0:
+                        dropped += 1
+                    continue
+                targets = (index,)
+            else:
+                targets = range(len(shards))
+            for index in targets:
+                part_tracks[index].append(msg.copy(time=tick - last_ticks[index]))
+                last_ticks[index] = tick
+        for part, part_track in zip(parts, part_tracks):
+            part.tracks.append(part_track)
+    if dropped:
+        print(f"{dropped} note(s) are outside the pitch range of every board and were dropped")
+    return parts
+
+
+def split_events(events, shards):
+    """Splits (time_ms, pitch, ...) events by pitch, one list per shard, dropping pitches no board has."""
+    parts = [[] for _ in shards]
+    for event in events:
+        index = shard_index(shards, event[1])
+        if index is not None:
+            parts[index].append(event)
+    return parts
+
+
+class ShardedPlayback:
+    """
+    Plays the parts of a song on their boards in parallel, one thread per board.
+    Every thread first opens its port, so the slow first connect of one board cannot delay the others. Once all are
+    connected, a start time START_LEAD ahead is chosen and every part begins playing at exactly that moment.
+    Later calls of play keep that start time, so the segments of a streamed song are played on one clock.
+    """
+
+    def __init__(self, shards, start_lead=START_LEAD):
+        self.shards = shards
+        self.start_lead = start_lead
+        self.start_ns = None
+        self.errors = []
+        self._barrier = threading.Barrier(len(shards), action=self._choose_start)
+
+    def _choose_start(self):
+        if self.start_ns is None:
+            self.start_ns = time.monotonic_ns() + int(self.start_lead * 1e9)
+
+    def _play_part(self, shard, part, play, synchronized_start):
+        try:
+            get_connection(shard.port)
+            self._barrier.wait()
+            if synchronized_start:
+                remaining = self.start_ns - time.monotonic_ns()
+                if remaining > 0:
+                    time.sleep(remaining / 1e9)
+            with shared_start(self.start_ns if synchronized_start else None):
+                play(shard, part)
+        except threading.BrokenBarrierError:
+            print(f"Not playing on {shard.port}, another board failed to connect")
+        except Exception as e:
+            print(f"Playback on {shard.port} failed: {e}")
+            self._barrier.abort()  # The other boards would wait for this one forever
+            self.errors.append(e)
+
+    def play(self, parts, play, synchronized_start=True):
+        """
+        :param parts: One part of the song per shard, e.g. from split_midi_file.
+        :param play: play(shard, part) sends a part to its board, e.g. with one of the senders of progress_bar.py
+            and port=shard.port.
+        :param synchronized_start: Whether to wait for the shared start time before calling play. Senders that
+            start their boards themselves (LookaheadStreamer with a start_barrier) pass False.
+        :return: True if every part was played without an error.
+        """
+        self.errors = []
+        self._barrier.reset()  # An earlier segment may have aborted it
+        threads = [threading.Thread(target=self._play_part, args=(shard, part, play, synchronized_start),
+                                    name=f"shard-{shard.port}", daemon=True)
+                   for shard, part in zip(self.shards, parts)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return not self.errors
+
+    def play_midi(self, mf, play, synchronized_start=True):
+        """Splits a mido MidiFile by pitch and plays it, see play."""
+        parts = split_midi_file(mf, self.shards)
+        for shard, part in zip(self.shards, parts):
+            notes = sum(1 for track in part.tracks for msg in track if msg.type == 'note_on' and msg.velocity > 0)
+            print(f"{shard.port}: {notes} notes in pitches {shard.min_pitch}-{shard.max_pitch}")
+        return self.play(parts, play, synchronized_start)
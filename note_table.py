@@ -0,0 +1,400 @@
+import sys
+import time
+
+import numpy as np
+from mido import MetaMessage, Message, MidiFile, MidiTrack
+
+from overlap_engine import cascade_shift, resolve_pitch_overlaps
+
+# One row per sounding pitch. Offsets and durations are in quarter notes, like music21 offsets.
+# Chord rows share a chord id, single notes and rests have chord id -1.
+NOTE_DTYPE = np.dtype([
+    ('onset', 'f8'),
+    ('duration', 'f8'),
+    ('pitch', 'i2'),
+    ('velocity', 'i2'),
+    ('chord', 'i4'),
+    ('tie', 'i1'),
+])
+
+# Tie types of notes split at barlines by the music21 MIDI parser
+TIE_NONE, TIE_START, TIE_CONTINUE, TIE_STOP = 0, 1, 2, 3
+_TIE_TYPES = {'start': TIE_START, 'continue': TIE_CONTINUE, 'stop': TIE_STOP}
+
+REST = -1  # Pitch value of rest rows
+DEFAULT_VELOCITY = 90  # Velocity music21 writes for notes without a volume
+TICKS_PER_QUARTER = 10080  # Same resolution music21 uses when writing MIDI files
+
+# music21 spells MIDI pitches with sharps only for C#, F# and G# (3 and 10 become E- and B-),
+# so these are the pitch classes the '#' in element.nameWithOctave checks actually matched
+SHARP_PITCH_CLASSES = np.array([1, 6, 8])
+
+# Grid used to snap note offsets, the same divisors music21 uses when it parses a MIDI file
+QUANTIZE_DIVISORS = (4, 3)
+
+_STEPS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+
+def note_name_to_midi(name):
+    """Converts a note name such as 'C4', 'F#3' or 'B-2' to its MIDI number, without music21."""
+    step = _STEPS[name[0].upper()]
+    rest = name[1:]
+    alter = 0
+    while rest and rest[0] in '#-b':
+        alter += 1 if rest[0] == '#' else -1
+        rest = rest[1:]
+    octave = int(rest) if rest else 4
+    return (octave + 1) * 12 + step + alter
+
+
+def quantize_offset(quarter_length):
+    """Snaps a value in quarter notes to the nearest point on the QUANTIZE_DIVISORS grid."""
+    candidates = [round(quarter_length * divisor) / divisor for divisor in QUANTIZE_DIVISORS]
+    return min(candidates, key=lambda value: abs(value - quarter_length))
+
+
+def from_score(score):
+    """
+    Builds a note table from a music21 stream, keeping the order of score.flat.notesAndRests.
+    Ties are only kept for single notes: the fitting transforms reassign chord pitches, which drops chord ties.
+    """
+    from music21 import chord, note
+
+    rows = []
+    chord_id = 0
+    for element in score.flat.notesAndRests:
+        offset = float(element.offset)
+        quarter_length = float(element.quarterLength)
+        if isinstance(element, (note.Note, chord.Chord)) and element.volume.velocity is not None:
+            velocity = element.volume.velocity
+        else:
+            velocity = DEFAULT_VELOCITY
+
+        if isinstance(element, chord.Chord):
+            if element.pitches:
+                for pitch in element.pitches:
+                    rows.append((offset, quarter_length, pitch.midi, velocity, chord_id, TIE_NONE))
+                chord_id += 1
+            else:
+                rows.append((offset, quarter_length, REST, 0, -1, TIE_NONE))
+        elif isinstance(element, note.Note):
+            tie = _TIE_TYPES.get(element.tie.type, TIE_NONE) if element.tie is not None else TIE_NONE
+            rows.append((offset, quarter_length, element.pitch.midi, velocity, -1, tie))
+        else:
+            rows.append((offset, quarter_length, REST, 0, -1, TIE_NONE))
+
+    return np.array(rows, dtype=NOTE_DTYPE)
+
+
+def from_note_events(note_events, midi_tempo=120):
+    """
+    Builds a note table from Basic Pitch note events (start_s, end_s, pitch, amplitude, pitch_bends).
+    Notes that start and end on the same quantized offsets are grouped into a chord, which is how music21 groups the
+    notes of a parsed MIDI file. Notes that start together but end at other times stay separate notes or chords,
+    ordered by length. Unlike from_score there are no rests between the notes.
+    """
+    quarters_per_second = midi_tempo / 60.0
+    groups = {}  # (offset, quarter_length) -> [(pitch, velocity), ...]
+    for start_time, end_time, pitch, amplitude, _ in note_events:
+        offset = quantize_offset(start_time * quarters_per_second)
+        quarter_length = max(quantize_offset((end_time - start_time) * quarters_per_second), 1 / QUANTIZE_DIVISORS[0])
+        velocity = max(1, min(127, int(round(amplitude * 127))))
+        groups.setdefault((offset, quarter_length), []).append((int(pitch), velocity))
+
+    rows = []
+    chord_id = 0
+    for offset, quarter_length in sorted(groups):
+        notes = groups[offset, quarter_length]
+        pitches = sorted({pitch for pitch, _ in notes})
+        velocity = max(velocity for _, velocity in notes)
+        if len(pitches) == 1:
+            rows.append((offset, quarter_length, pitches[0], velocity, -1, TIE_NONE))
+        else:
+            for pitch in pitches:
+                rows.append((offset, quarter_length, pitch, velocity, chord_id, TIE_NONE))
+            chord_id += 1
+
+    return np.array(rows, dtype=NOTE_DTYPE)
+
+
+def event_index(table):
+    """Returns the index of the note, chord or rest each row belongs to."""
+    if len(table) == 0:
+        return np.zeros(0, dtype=np.int64)
+    chord_ids = table['chord']
+    new_event = np.empty(len(table), dtype=bool)
+    new_event[0] = True
+    new_event[1:] = (chord_ids[1:] < 0) | (chord_ids[1:] != chord_ids[:-1])
+    return np.cumsum(new_event) - 1
+
+
+def is_sharp(pitches):
+    return (pitches >= 0) & np.isin(pitches % 12, SHARP_PITCH_CLASSES)
+
+
+def transpose_to_octave(table, min_note='C4', max_note='C5'):
+    """Moves pitches below min_note up an octave and pitches above max_note down an octave."""
+    lower_pitch = note_name_to_midi(min_note)
+    upper_pitch = note_name_to_midi(max_note)
+    pitches = table['pitch']
+    sounding = pitches != REST
+
+    result = table.copy()
+    result['pitch'] = np.where(sounding & (pitches < lower_pitch), pitches + 12,
+                               np.where(sounding & (pitches > upper_pitch), pitches - 12, pitches))
+    return result
+
+
+def move_sharps_up(table):
+    """Moves sharp notes up to their next natural counterpart."""
+    result = table.copy()
+    result['pitch'] = np.where(is_sharp(table['pitch']), table['pitch'] + 1, table['pitch'])
+    return result
+
+
+def remove_sharps(table):
+    """Removes sharp notes, and sharp pitches from chords. Chords without remaining pitches disappear."""
+    return table[~is_sharp(table['pitch'])]
+
+
+def remove_repeating_chords(table):
+    """Removes chords with the same pitches as the previous chord. Notes in between do not reset the comparison."""
+    chord_rows = np.flatnonzero((table['chord'] >= 0) & (table['pitch'] >= 0))
+    if len(chord_rows) == 0:
+        return table.copy()
+
+    chord_ids = table['chord'][chord_rows]
+    pitches = table['pitch'][chord_rows].astype(np.uint64)
+
+    # Every chord is summarised as a 128-bit pitch mask, stored in two 64-bit words
+    low_bits = np.where(pitches < 64, np.left_shift(np.uint64(1), pitches % np.uint64(64)), np.uint64(0))
+    high_bits = np.where(pitches >= 64, np.left_shift(np.uint64(1), pitches % np.uint64(64)), np.uint64(0))
+    starts = np.flatnonzero(np.r_[True, chord_ids[1:] != chord_ids[:-1]])
+    low_mask = np.bitwise_or.reduceat(low_bits, starts)
+    high_mask = np.bitwise_or.reduceat(high_bits, starts)
+
+    repeated = np.r_[False, (low_mask[1:] == low_mask[:-1]) & (high_mask[1:] == high_mask[:-1])]
+    return table[~np.isin(table['chord'], chord_ids[starts][repeated])]
+
+
+def shift_overlapping_notes(table):
+    """
+    Moves every note or chord that starts before the previous one ends to the end of the previous one.
+    Shifts cascade like in the music21 version, and a rest between two elements stops the cascade.
+    """
+    if len(table) == 0:
+        return table.copy()
+
+    events = event_index(table)
+    first_rows = np.flatnonzero(np.r_[True, events[1:] != events[:-1]])
+    onsets = table['onset'][first_rows]
+    durations = table['duration'][first_rows]
+    is_rest = table['pitch'][first_rows] == REST
+
+    # A new cascade starts at every rest and right after every rest
+    breaks = np.r_[True, is_rest[1:] | is_rest[:-1]]
+    new_onsets = np.where(is_rest, onsets, cascade_shift(onsets, durations, breaks))
+    # Summed durations pick up rounding errors, so the shifted onsets are snapped back onto the offset grid
+    grid = np.lcm.reduce(QUANTIZE_DIVISORS)
+    new_onsets = np.round(new_onsets * grid) / grid
+
+    result = table.copy()
+    result['onset'] = new_onsets[events]
+    # Shifted elements are sorted back into time order, like a music21 stream re-sorts itself
+    return result[np.argsort(new_onsets[events], kind='stable')]
+
+
+def smooth_notes_and_add_gaps(table, tempo_factor, duration_extension, gap_duration):
+    """
+    Table version of smooth_notes_and_add_gaps from midi_testing.py. Durations are scaled, chord pitches that are
+    still sounding are dropped and the elements are placed back to back, as Stream.append does.
+    """
+    events = event_index(table)
+    keep = table['pitch'] != REST
+    durations = table['duration'] / tempo_factor + duration_extension
+
+    # Every pitch only depends on the earlier rows with the same pitch
+    rows = np.flatnonzero(keep)
+    _, kept_rows = resolve_pitch_overlaps(table['onset'][rows], durations[rows], table['pitch'][rows],
+                                          table['chord'][rows] >= 0, gap_duration)
+    keep[rows] = kept_rows
+
+    # Stream.append places each note or chord right after the previous one, rests are left out
+    first_rows = np.flatnonzero(np.r_[True, events[1:] != events[:-1]]) if len(table) else np.zeros(0, dtype=int)
+    is_element = table['pitch'][first_rows] != REST
+    event_durations = np.where(is_element, durations[first_rows], 0.0)
+    event_onsets = np.r_[0.0, np.cumsum(event_durations)[:-1]]
+
+    result = table.copy()
+    result['onset'] = event_onsets[events]
+    result['duration'] = durations
+
+    # A chord that lost all of its pitches still takes up its time, so it becomes a rest
+    emptied = np.zeros(len(table), dtype=bool)
+    chord_rows = table['chord'] >= 0
+    if chord_rows.any():
+        kept_per_event = np.bincount(events, weights=keep, minlength=len(first_rows))
+        emptied_events = np.flatnonzero(kept_per_event == 0)
+        emptied[first_rows[emptied_events]] = chord_rows[first_rows[emptied_events]]
+    result['pitch'][emptied] = REST
+    result['chord'][emptied] = -1
+    return result[keep | emptied]
+
+
+def fit_to_octave_range(table, min_note='C4', max_note='C5', shift_overlaps=False):
+    """
+    The fitting pipeline of fit_midi_to_octave_range, on a note table.
+    The music21 shift_overlapping_notes assigns the new offsets on the temporary score.flat stream, so it never
+    changed the written file. Shifting is therefore off by default, which keeps the output identical.
+    """
+    table = transpose_to_octave(table, min_note, max_note)
+
+    # Remove repeating chords
+    table = remove_repeating_chords(table)
+
+    # Shift overlapping notes instead of cutting them off
+    if shift_overlaps:
+        table = shift_overlapping_notes(table)
+
+    # Removing sharp notes
+    return remove_sharps(table)
+
+
+def strip_ties(table):
+    """
+    Merges tied notes into one note, like the Stream.stripTies call music21 makes when writing a MIDI file.
+    This follows music21's rules: the elements are walked in order, a tie start is joined with the next
+    tie stop (or a directly following note of the same pitch) and the first note gets the summed duration.
+    """
+    events = event_index(table)
+    if len(events) == 0:
+        return table.copy()
+    first_rows = np.flatnonzero(np.r_[True, events[1:] != events[:-1]])
+    event_sizes = np.diff(np.r_[first_rows, len(table)]).tolist()
+    pitches = table['pitch'][first_rows].tolist()
+    ties = table['tie'][first_rows].tolist()
+    is_note = ((table['chord'][first_rows] < 0) & (table['pitch'][first_rows] != REST)).tolist()
+    durations = table['duration'][first_rows].tolist()
+
+    merged_durations = table['duration'].copy()
+    cleared_ties = np.zeros(len(table), dtype=bool)
+    deleted = np.zeros(len(first_rows), dtype=bool)
+
+    def matches_last(i, last):
+        # A same-pitch note, or a one-note chord, directly after a connected note
+        if last is None or last not in connected or not is_note[last]:
+            return False
+        if is_note[i] or (pitches[i] != REST and event_sizes[i] == 1):
+            return pitches[i] == pitches[last]
+        return False
+
+    connected = []
+    last = None
+    for i in range(len(first_rows)):
+        if durations[i] <= 0:
+            continue  # music21 skips elements without a duration
+        end_match = None
+        if is_note[i] and ties[i] == TIE_START:
+            if last is None or last not in connected:
+                connected = [i]
+            else:
+                connected.append(i)
+            end_match = False
+        elif is_note[i] and ties[i] == TIE_CONTINUE:
+            if not connected or matches_last(i, last):
+                connected.append(i)
+            else:
+                connected = [i]
+            end_match = False
+
+        if end_match is None:
+            end_match = (is_note[i] and ties[i] == TIE_STOP) or matches_last(i, last)
+
+        if end_match:
+            connected.append(i)
+            if len(connected) >= 2:
+                first = first_rows[connected[0]]
+                merged_durations[first] += sum(durations[j] for j in connected[1:])
+                cleared_ties[first] = True
+                deleted[connected[1:]] = True
+            connected = []
+        last = i
+
+    result = table.copy()
+    result['duration'] = merged_durations
+    result['tie'][cleared_ties] = TIE_NONE
+    return result[~deleted[events]]
+
+
+def to_midi_file(table, ticks_per_beat=TICKS_PER_QUARTER, tempo=500000):
+    """Converts a note table into a single-track mido MidiFile. Tied notes are merged first."""
+    table = strip_ties(table)
+    sounding = table[table['pitch'] != REST]
+    on_ticks = np.round(sounding['onset'] * ticks_per_beat).astype(np.int64)
+    off_ticks = np.round((sounding['onset'] + sounding['duration']) * ticks_per_beat).astype(np.int64)
+
+    ticks = np.concatenate([off_ticks, on_ticks])
+    is_on = np.r_[np.zeros(len(sounding), dtype=bool), np.ones(len(sounding), dtype=bool)]
+    pitches = np.concatenate([sounding['pitch'], sounding['pitch']])
+    velocities = np.concatenate([np.zeros(len(sounding), dtype=np.int16), sounding['velocity']])
+    # Note offs go before note ons at the same tick, so repeated pitches are released first
+    order = np.lexsort((is_on, ticks))
+
+    track = MidiTrack()
+    track.append(MetaMessage('set_tempo', tempo=tempo, time=0))
+    previous_tick = 0
+    for i in order:
+        delta = int(ticks[i] - previous_tick)
+        previous_tick = ticks[i]
+        message_type = 'note_on' if is_on[i] else 'note_off'
+        track.append(Message(message_type, note=int(pitches[i]), velocity=int(velocities[i]), time=delta))
+    track.append(MetaMessage('end_of_track', time=0))
+
+    mf = MidiFile(ticks_per_beat=ticks_per_beat)
+    mf.tracks.append(track)
+    return mf
+
+
+def write_midi(table, output_file):
+    to_midi_file(table).save(output_file)
+    return output_file
+
+
+def note_list(table):
+    """Sorted (onset, duration, pitch) tuples of the sounding notes, for comparing results."""
+    sounding = table[table['pitch'] != REST]
+    return sorted(zip(np.round(sounding['onset'], 4).tolist(), np.round(sounding['duration'], 4).tolist(),
+                      sounding['pitch'].tolist()))
+
+
+def compare_with_music21(midi_file):
+    """Runs the music21 and the note table fitting on the same file, and reports their timings and differences."""
+    from music21 import converter
+    from midi_processing import fit_score_to_octave_range
+
+    score = converter.parse(midi_file)
+    table = from_score(score)
+    print(f"{len(table)} rows")
+
+    start_time = time.perf_counter()
+    fitted_score = fit_score_to_octave_range(score)
+    music21_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    fitted_table = fit_to_octave_range(table)
+    table_time = time.perf_counter() - start_time
+
+    expected = note_list(from_score(fitted_score))
+    actual = note_list(fitted_table)
+    print(f"music21: {music21_time:.3f}s, note table: {table_time:.3f}s ({music21_time / max(table_time, 1e-9):.1f}x)")
+    if expected == actual:
+        print(f"Outputs match ({len(actual)} notes)")
+    else:
+        mismatches = len(set(expected) ^ set(actual))
+        print(f"Outputs differ: {len(expected)} vs {len(actual)} notes, {mismatches} mismatching")
+    return expected == actual
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        compare_with_music21(path)
@@ -0,0 +1,92 @@
+import numpy as np
+
+
+def cascade_shift(onsets, durations, breaks):
+    """
+    Moves every element that starts before the previous element ends to the end of the previous element.
+    Shifts cascade: new_onset[i] = max(onset[i], new_onset[i - 1] + duration[i - 1]).
+    A True in breaks starts a new run, whose first element is never moved.
+
+    The recurrence is solved in one sweep: within a run, new_onset[i] - elapsed[i] is the running maximum of
+    onset[j] - elapsed[j], where elapsed is the summed duration of the earlier elements of the run.
+    The running maximum is taken over ranks sorted by (run, slack), so it restarts in every run without adding
+    large offsets to the values, and elements that are not moved keep their exact onset.
+    """
+    onsets = np.asarray(onsets, dtype=np.float64)
+    durations = np.asarray(durations, dtype=np.float64)
+    if len(onsets) == 0:
+        return onsets.copy()
+
+    breaks = np.asarray(breaks, dtype=bool).copy()
+    breaks[0] = True
+    runs = np.cumsum(breaks) - 1
+    elapsed = np.r_[0.0, np.cumsum(durations)[:-1]]
+    elapsed -= elapsed[np.flatnonzero(breaks)][runs]
+
+    slack = onsets - elapsed
+    order = np.lexsort((slack, runs))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    latest = order[np.maximum.accumulate(ranks)]
+
+    moved = latest != np.arange(len(onsets))
+    return np.where(moved, onsets[latest] + (elapsed - elapsed[latest]), onsets)
+
+
+class PitchIndex:
+    """
+    Row indices grouped by pitch, keeping the original (time) order within every pitch.
+    Built with one stable sort, so lookups and sweeps over a single pitch never touch the other rows.
+    """
+
+    def __init__(self, pitches):
+        pitches = np.asarray(pitches)
+        self.order = np.argsort(pitches, kind='stable')
+        self.pitches, self.starts = np.unique(pitches[self.order], return_index=True)
+        self.ends = np.r_[self.starts[1:], len(self.order)].astype(np.int64)
+
+    def rows(self, pitch):
+        i = np.searchsorted(self.pitches, pitch)
+        if i == len(self.pitches) or self.pitches[i] != pitch:
+            return self.order[:0]
+        return self.order[self.starts[i]:self.ends[i]]
+
+    def __iter__(self):
+        for pitch, start, end in zip(self.pitches.tolist(), self.starts.tolist(), self.ends.tolist()):
+            yield pitch, self.order[start:end]
+
+
+def resolve_pitch_overlaps(onsets, durations, pitches, is_chord_row, gap_duration):
+    """
+    The overlap and gap rules of smooth_notes_and_add_gaps, swept one pitch at a time:
+    a note that starts while the previous note of its pitch still sounds is moved to gap_duration after it,
+    if it still ends after that point; a chord pitch that is still sounding is dropped from its chord.
+    :return: (new_onsets, keep) arrays with one entry per row.
+    """
+    new_onsets = np.array(onsets, dtype=np.float64)
+    durations = np.asarray(durations, dtype=np.float64)
+    keep = np.ones(len(new_onsets), dtype=bool)
+    is_chord_row = np.asarray(is_chord_row, dtype=bool)
+
+    for _, rows in PitchIndex(pitches):
+        row_list = rows.tolist()
+        starts = new_onsets[rows].tolist()
+        lengths = durations[rows].tolist()
+        chords = is_chord_row[rows].tolist()
+
+        last_end = None
+        for i, row in enumerate(row_list):
+            start_time = starts[i]
+            end_time = start_time + lengths[i]
+            if not chords[i]:
+                if last_end is not None and last_end > start_time and last_end + gap_duration <= end_time:
+                    start_time = last_end + gap_duration
+                    end_time = start_time + lengths[i]
+                    new_onsets[row] = start_time
+                last_end = end_time
+            elif last_end is None or last_end <= start_time:
+                last_end = end_time
+            else:
+                keep[row] = False
+
+    return new_onsets, keep
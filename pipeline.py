@@ -0,0 +1,150 @@
+import queue
+import threading
+import time
+
+from tracing import span
+
+DEFAULT_QUEUE_SIZE = 2  # Segments waiting between two stages; a full queue blocks the stage before it
+STOP_CHECK_INTERVAL = 0.1  # How often blocked stages check whether the pipeline was stopped
+
+_END = object()  # Passed down the queues after the last item
+
+
+class StageQueue:
+    """Bounded queue between two stages that records how full it got and how long each side had to wait."""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize)
+        self.puts = 0
+        self.max_depth = 0
+        self.depth_total = 0
+        self.put_wait_ns = 0  # Producer blocked on a full queue (backpressure)
+        self.get_wait_ns = 0  # Consumer waiting on an empty queue (starved)
+
+    def put(self, item, stopping):
+        """Blocks while the queue is full. Returns False if the pipeline was stopped in the meantime."""
+        start_ns = time.perf_counter_ns()
+        while True:
+            try:
+                self.queue.put(item, timeout=STOP_CHECK_INTERVAL)
+                break
+            except queue.Full:
+                if stopping.is_set():
+                    return False
+        self.put_wait_ns += time.perf_counter_ns() - start_ns
+        if item is not _END:
+            depth = self.queue.qsize()
+            self.puts += 1
+            self.depth_total += depth
+            self.max_depth = max(self.max_depth, depth)
+        return True
+
+    def get(self, stopping):
+        """Blocks while the queue is empty. Returns _END if the pipeline was stopped in the meantime."""
+        start_ns = time.perf_counter_ns()
+        while True:
+            try:
+                item = self.queue.get(timeout=STOP_CHECK_INTERVAL)
+                break
+            except queue.Empty:
+                if stopping.is_set():
+                    return _END
+        self.get_wait_ns += time.perf_counter_ns() - start_ns
+        return item
+
+    def summary(self):
+        mean_depth = self.depth_total / self.puts if self.puts else 0.0
+        return (f"{self.name}: max depth {self.max_depth}/{self.maxsize}, mean depth {mean_depth:.1f}, "
+                f"producer blocked {self.put_wait_ns / 1e9:.2f}s, consumer waited {self.get_wait_ns / 1e9:.2f}s")
+
+
+class Pipeline:
+    """
+    Runs a source and a chain of stages concurrently, connected by bounded queues.
+    The source is iterated on the calling thread and every stage gets its own thread, so stage N works on item k
+    while stage N+1 works on item k-1. A stage function returns the item for the next stage, or None to drop it.
+    If any stage fails, the others stop and run() raises the error.
+    """
+
+    def __init__(self, source_name, source, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        """
+        :param source: Iterable of items, e.g. a generator of transcribed segments.
+        :param stages: List of (name, function) pairs.
+        """
+        self.source_name = source_name
+        self.source = source
+        self.stages = stages
+        self.queues = [StageQueue(f"{source_name} -> {stages[0][0]}", queue_size)]
+        for (name, _), (next_name, _) in zip(stages, stages[1:]):
+            self.queues.append(StageQueue(f"{name} -> {next_name}", queue_size))
+        self.stats = {name: {'items': 0, 'busy_ns': 0} for name in [source_name] + [name for name, _ in stages]}
+        self.error = None
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _fail(self, name, error):
+        print(f"Pipeline stage {name} failed: {error}")
+        if self.error is None:
+            self.error = error
+        self._stopping.set()
+
+    def _run_stage(self, name, function, inbound, outbound):
+        try:
+            while True:
+                item = inbound.get(self._stopping)
+                if item is _END or self._stopping.is_set():
+                    break
+                start_ns = time.perf_counter_ns()
+                with span(name):
+                    result = function(item)
+                self.stats[name]['items'] += 1
+                self.stats[name]['busy_ns'] += time.perf_counter_ns() - start_ns
+                if outbound is not None and result is not None and not outbound.put(result, self._stopping):
+                    break
+        except Exception as e:
+            self._fail(name, e)
+        finally:
+            if outbound is not None:
+                outbound.put(_END, self._stopping)
+
+    def run(self):
+        threads = []
+        for index, (name, function) in enumerate(self.stages):
+            outbound = self.queues[index + 1] if index + 1 < len(self.queues) else None
+            thread = threading.Thread(target=self._run_stage, args=(name, function, self.queues[index], outbound),
+                                      name=f"pipeline-{name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        items = iter(self.source)
+        try:
+            while not self._stopping.is_set():
+                start_ns = time.perf_counter_ns()
+                with span(self.source_name):
+                    item = next(items, _END)
+                if item is _END:
+                    break
+                self.stats[self.source_name]['items'] += 1
+                self.stats[self.source_name]['busy_ns'] += time.perf_counter_ns() - start_ns
+                if not self.queues[0].put(item, self._stopping):
+                    break
+        except Exception as e:
+            self._fail(self.source_name, e)
+        finally:
+            self.queues[0].put(_END, self._stopping)
+
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def report(self):
+        lines = [f"  {name}: {stats['items']} items, busy {stats['busy_ns'] / 1e9:.2f}s"
+                 for name, stats in self.stats.items()]
+        lines += [f"  {stage_queue.summary()}" for stage_queue in self.queues]
+        return "Pipeline:\n" + '\n'.join(lines)
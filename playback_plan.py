@@ -0,0 +1,112 @@
+"""
+Compiled playback plans: a fitted song stored as fixed-size records that can be played without mido or music21.
+
+File layout (little-endian):
+    header  MAGIC (8 bytes), version (2 bytes), record size (2 bytes), record count (4 bytes), song length in ms (4 bytes)
+    records PLAN_DTYPE, one per group of notes that start together and have the same duration, sorted by time
+
+Replays memory-map the records, so a song starts without parsing anything and the page cache keeps it in memory
+for the next replay.
+"""
+import os
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b'MPPLAN\x00\x00'
+PLAN_VERSION = 1
+HEADER_FORMAT = '<8sHHII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+PLAN_EXTENSION = '.plan'
+
+PLAN_DTYPE = np.dtype([
+    ('time_ms', '<u4'),  # Start of the notes since the beginning of the song
+    ('duration_ms', '<u4'),
+    ('mask', 'u1', 16),  # Bit (pitch % 8) of byte (pitch // 8) is set for every note of the group
+])
+
+
+def build_records(events):
+    """
+    Groups (time_ms, pitch, duration_ms) events into plan records.
+    A note that appears twice with the same time and duration is stored once, a servo cannot play it twice anyway.
+    :return: A PLAN_DTYPE array sorted by time.
+    """
+    groups = {}
+    for time_ms, pitch, duration in events:
+        mask = groups.setdefault((int(time_ms), int(duration)), np.zeros(16, dtype=np.uint8))
+        mask[pitch // 8] |= 1 << (pitch % 8)
+
+    records = np.zeros(len(groups), dtype=PLAN_DTYPE)
+    for i, ((time_ms, duration), mask) in enumerate(sorted(groups.items(), key=lambda item: item[0])):
+        records[i] = (time_ms, duration, mask)
+    return records
+
+
+def write_plan(records, plan_path):
+    """Writes plan records to a file, through a temporary file so a replay never sees a half-written plan."""
+    song_length = int((records['time_ms'].astype(np.int64) + records['duration_ms']).max()) if len(records) else 0
+    with open(plan_path + '.tmp', 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, PLAN_VERSION, PLAN_DTYPE.itemsize, len(records), song_length))
+        f.write(records.tobytes())
+    os.replace(plan_path + '.tmp', plan_path)
+    return plan_path
+
+
+def compile_plan(midi_file, plan_path, min_note_duration=0):
+    """
+    Compiles a fitted MIDI file (path or mido MidiFile) into a plan file.
+    This is the only step that reads MIDI; replays of the plan do not.
+    """
+    from mido import MidiFile
+
+    from lookahead_streamer import note_events_ms
+
+    mf = midi_file if isinstance(midi_file, MidiFile) else MidiFile(midi_file)
+    records = build_records(note_events_ms(mf, min_note_duration))
+    write_plan(records, plan_path)
+    print(f"Compiled {len(records)} plan records to {plan_path}")
+    return plan_path
+
+
+def load_plan(plan_path):
+    """
+    Memory-maps the records of a plan file.
+    :return: (read-only PLAN_DTYPE array, song length in ms)
+    """
+    with open(plan_path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise ValueError(f"{plan_path} is not a playback plan")
+    magic, version, record_size, count, song_length = struct.unpack(HEADER_FORMAT, header)
+    if magic != MAGIC:
+        raise ValueError(f"{plan_path} is not a playback plan")
+    if version != PLAN_VERSION or record_size != PLAN_DTYPE.itemsize:
+        raise ValueError(f"{plan_path} was compiled for plan version {version}, recompile it")
+    if count == 0:
+        return np.zeros(0, dtype=PLAN_DTYPE), song_length
+    return np.memmap(plan_path, dtype=PLAN_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,)), song_length
+
+
+def record_pitches(record):
+    """MIDI pitches of a plan record, decoded from its mask."""
+    return np.flatnonzero(np.unpackbits(record['mask'], bitorder='little')).tolist()
+
+
+def plan_chords(records):
+    """Yields (time_ms, [(pitch, duration_ms), ...]) for every record of a plan."""
+    for record in records:
+        duration = int(record['duration_ms'])
+        yield int(record['time_ms']), [(pitch, duration) for pitch in record_pitches(record)]
+
+
+def plan_events(records):
+    """Returns the (time_ms, pitch, duration_ms) events of a plan, e.g. for the ring buffer streamer."""
+    return [(time_ms, pitch, duration) for time_ms, notes in plan_chords(records) for pitch, duration in notes]
+
+
+if __name__ == '__main__':
+    # python playback_plan.py song.mid [song.plan]
+    source = sys.argv[1]
+    compile_plan(source, sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(source)[0] + PLAN_EXTENSION)
@@ -0,0 +1,110 @@
+import contextlib
+import threading
+import time
+
+from timeline import timed_messages
+
+# The last stretch before a deadline is spun instead of slept, since sleep can oversleep by a millisecond or more
+SPIN_THRESHOLD_NS = 2_000_000
+
+
+_shared_start = threading.local()
+
+
+@contextlib.contextmanager
+def shared_start(start_ns):
+    """
+    Makes every PlaybackScheduler started on this thread count from start_ns (a time.monotonic_ns value) instead of
+    from its own start, so senders for several boards on their own threads play the song in step.
+    """
+    previous = getattr(_shared_start, 'start_ns', None)
+    _shared_start.start_ns = start_ns
+    try:
+        yield
+    finally:
+        _shared_start.start_ns = previous
+
+
+def song_length_ns(mf):
+    """Time of the last message of the song."""
+    last_ns = 0
+    for last_ns, _ in timed_messages(mf):
+        pass
+    return last_ns
+
+
+class PlaybackScheduler:
+    """
+    Fires events at absolute deadlines measured from the start of playback, instead of sleeping for each delta.
+    Time spent writing to the serial port, waiting for ACKs or printing therefore delays one event at most
+    and never shifts the rest of the song.
+    """
+
+    def __init__(self):
+        self.start_ns = None
+        self.lateness_ns = []
+        self.song_end_ns = 0  # End of the last note, from the start of playback
+
+    def start(self):
+        shared = getattr(_shared_start, 'start_ns', None)
+        self.start_ns = shared if shared is not None else time.monotonic_ns()
+        self.lateness_ns = []
+        self.song_end_ns = 0
+
+    def elapsed_ns(self):
+        return time.monotonic_ns() - self.start_ns
+
+    def wait_until(self, deadline_ns, length_ns=0):
+        """
+        Blocks until deadline_ns after the start of playback (starting the clock on the first call)
+        and records how late the call returned.
+        :param length_ns: Length of the longest note sent at the deadline, for the song length in print_report.
+        """
+        self.song_end_ns = max(self.song_end_ns, deadline_ns + length_ns)
+        if self.start_ns is None:
+            self.start()
+        target = self.start_ns + deadline_ns
+
+        remaining = target - time.monotonic_ns()
+        if remaining > SPIN_THRESHOLD_NS:
+            time.sleep((remaining - SPIN_THRESHOLD_NS) / 1e9)
+        while time.monotonic_ns() < target:
+            pass
+
+        self.lateness_ns.append(time.monotonic_ns() - target)
+
+    def lateness_stats(self):
+        """Returns the event count and the mean, median, 95th percentile and maximum lateness in milliseconds."""
+        if not self.lateness_ns:
+            return {'events': 0, 'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+        ordered = sorted(self.lateness_ns)
+        count = len(ordered)
+        return {
+            'events': count,
+            'mean_ms': sum(ordered) / count / 1e6,
+            'p50_ms': ordered[count // 2] / 1e6,
+            'p95_ms': ordered[min(count - 1, int(count * 0.95))] / 1e6,
+            'max_ms': ordered[-1] / 1e6,
+        }
+
+    def print_report(self, drift=True):
+        """
+        :param drift: Also print how far the end of the song moved. Streamed songs are played by one scheduler per
+            segment and only print it after the last one, see print_drift.
+        """
+        stats = self.lateness_stats()
+        print(f"Playback timing: {stats['events']} events, lateness mean {stats['mean_ms']:.2f} ms, "
+              f"median {stats['p50_ms']:.2f} ms, 95th percentile {stats['p95_ms']:.2f} ms, max {stats['max_ms']:.2f} ms")
+        if drift:
+            self.print_drift()
+
+    def print_drift(self):
+        """
+        Compares the end of the last note in the song with its end as played: the last note was sent as late as its
+        wait returned, and it sounds for its own length from there.
+        """
+        if not self.lateness_ns:
+            return
+        drift_ms = self.lateness_ns[-1] / 1e6
+        print(f"Song length {self.song_end_ns / 1e9:.3f}s, played in {self.song_end_ns / 1e9 + drift_ms / 1e3:.3f}s "
+              f"({drift_ms:+.1f} ms)")
@@ -1,58 +1,110 @@
-import atexit
+import contextlib
 import sys
 import os
+import threading
 import time
 import serial
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal
 from PyQt5.QtGui import QDragEnterEvent, QDropEvent
 from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QVBoxLayout, QWidget, QPushButton, QFileDialog, \
-    QProgressBar
-from basic_pitch import ICASSP_2022_MODEL_PATH
-from basic_pitch.inference import predict_and_save, Model
+    QProgressBar, QCheckBox, QDoubleSpinBox, QFormLayout, QLineEdit
 from mido import MidiFile
-from music21 import converter, note, chord, midi, stream
 
-
-def send_midi_to_arduino_bulk(midi_file, max_notes=64):  # Set a maximum number of notes to send
+import note_table
+from model_registry import get_model, preload_in_background, print_model_stats
+from lookahead_streamer import CLOCK_SYNC_INTERVAL, LookaheadStreamer, note_events_ms
+from multi_device import SHARDS_VARIABLE, ShardedPlayback, shards_from_environment
+from playback_plan import PLAN_EXTENSION, compile_plan, load_plan, plan_chords, plan_events
+from pipeline import Pipeline
+from refit import FIT_DEFAULTS, Refitter, preview_table, valid_note_name
+from playback_scheduler import PlaybackScheduler, shared_start
+from timeline import merged_timeline, note_lengths, timed_deltas
+from serial_connection import connect_in_background, get_connection
+from serial_protocol import MAX_CHORD_NOTES, chunk_notes
+from servo_allocator import allocate_table
+from tracing import Tracer, span
+
+# basic_pitch (TensorFlow), librosa and music21 are imported where they are used, so the window opens without them.
+# preload_in_background loads them right after the window is shown.
+
+# Framed packets with sequence numbers and CRC (see serial_protocol.py). Needs a sketch that parses the frames,
+# the default sends the raw pitch + duration bytes the existing sketches expect.
+USE_FRAMED_PROTOCOL = False
+# Let the Arduino play from its own clock out of a ring buffer that is kept filled ahead of the playhead
+# (see lookahead_streamer.py). Needs USE_FRAMED_PROTOCOL and a sketch that supports the EVENTS, START and STATUS
+# frames.
+USE_DEVICE_BUFFER = False
+# Every job writes a Chrome trace of its stages here (open it in chrome://tracing or https://ui.perfetto.dev)
+TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces')
+# Also run every stage under cProfile and save its stats next to the trace
+PROFILE_STAGES = False
+# Segments that may wait between two stages of the streaming pipeline before the earlier stage is held back
+PIPELINE_QUEUE_SIZE = 2
+# Boards that share the song by pitch (see multi_device.py), a list of DeviceShard. None reads them from
+# ARDUINO_SHARDS, e.g. ARDUINO_SHARDS=COM13:C4-F4,COM14:F#4-C5, when a job starts. Empty means a single board on
+# ARDUINO_PORT.
+DEVICE_SHARDS = None
+# Servos of the player (see servo_allocator.py), e.g. servo_allocator.DEFAULT_PROFILE once its numbers have been
+# measured on the player. Fitted songs are then planned for them, so every note that is sent can actually be played.
+# None sends the fitted notes as they are.
+SERVO_PROFILE = None
+# Shortest note the senders send. The servo plan already keeps notes at least min_press_ms long, and lengthening
+# them any further could run into the next strike of the key.
+MIN_NOTE_DURATION = SERVO_PROFILE.min_press_ms if SERVO_PROFILE else 200
+
+
+def device_shards():
+    """The boards to play on, see DEVICE_SHARDS. Raises ValueError if ARDUINO_SHARDS is malformed."""
+    return DEVICE_SHARDS if DEVICE_SHARDS is not None else shards_from_environment()
+
+
+def load_midi_file(midi_file):
+    """Accepts either a path to a MIDI file or an already loaded mido MidiFile."""
+    if isinstance(midi_file, MidiFile):
+        print(f"Using in-memory MIDI file with {len(midi_file.tracks)} track(s)")
+        return midi_file
+
+    mf = MidiFile(midi_file)
+    print(f"Loaded MIDI file: {midi_file}")
+    return mf
+
+
+def send_midi_to_arduino_bulk(midi_file, max_notes=64, port=None):  # Set a maximum number of notes to send
     try:
         # Initialize serial connection to Arduino
         print("Attempting to connect to Arduino...")
-        arduino = serial.Serial('COM13', 9600, timeout=1)  # Ensure the correct port is used
-        time.sleep(2)  # Allow time for Arduino to reset
+        arduino = get_connection(port)  # Shared connection, opened once without resetting the board
         print("Connected to Arduino!")
 
-        mf = MidiFile(midi_file)
-        print(f"Loaded MIDI file: {midi_file}")
+        mf = load_midi_file(midi_file)
 
         note_data = []  # Store the notes and their corresponding durations
 
-        # Loop through each track and message in the MIDI file
-        for i, track in enumerate(mf.tracks):
-            print(f"Processing track {i + 1}/{len(mf.tracks)}")
-
-            for msg in track:
-                print(f"Message: {msg}")
+        # Loop through the messages of all tracks, merged in time order
+        previous_tick = 0
+        for event in merged_timeline(mf):
+            msg = event.msg
+            print(f"Message: {msg}")
 
-                # Handle 'note_on' messages
-                if msg.type == 'note_on' and msg.velocity > 0:
-                    pitch = msg.note
-                    duration = msg.time  # Duration in ticks
+            duration = event.tick - previous_tick  # Duration in ticks, since the previous message of any track
+            previous_tick = event.tick
 
-                    # Validate pitch
-                    if 0 <= pitch <= 127:  # Ensure pitch is within MIDI range
-                        # Ensure duration is within acceptable limits
-                        if 0 <= duration <= 65535:  # Check if duration can be represented in 2 bytes
-                            # Split duration into two bytes and store in the list
-                            duration_bytes = [duration >> 8, duration & 0xFF]
-                            note_data.extend(
-                                [pitch] + duration_bytes)  # Append the pitch and duration bytes to the data list
+            # Handle 'note_on' messages
+            if msg.type == 'note_on' and msg.velocity > 0:
+                pitch = msg.note
 
-                            # Check if we have reached the maximum number of notes
-                            if len(note_data) // 3 >= max_notes:  # Each note consists of 3 bytes (pitch + duration)
-                                break  # Exit the loop if max notes reached
+                # Validate pitch
+                if 0 <= pitch <= 127:  # Ensure pitch is within MIDI range
+                    # Ensure duration is within acceptable limits
+                    if 0 <= duration <= 65535:  # Check if duration can be represented in 2 bytes
+                        # Split duration into two bytes and store in the list
+                        duration_bytes = [duration >> 8, duration & 0xFF]
+                        note_data.extend(
+                            [pitch] + duration_bytes)  # Append the pitch and duration bytes to the data list
 
-            if len(note_data) // 3 >= max_notes:
-                break  # Exit the outer loop if max notes reached
+                        # Check if we have reached the maximum number of notes
+                        if len(note_data) // 3 >= max_notes:  # Each note consists of 3 bytes (pitch + duration)
+                            break  # Exit the loop if max notes reached
 
         # Send all accumulated note data in one go
         if note_data:
@@ -68,86 +120,77 @@ def send_midi_to_arduino_bulk(midi_file, max_notes=64):  # Set a maximum number
         else:
             print("No note data found to send.")
 
-        print("Closing connection.")
-        arduino.close()
-
     except serial.SerialException as se:
         print(f"Serial communication error: {se}")
     except FileNotFoundError as fnfe:
         print(f"MIDI file not found: {fnfe}")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-    finally:
-        if arduino.is_open:
-            arduino.close()
-        print("Serial connection closed.")
 
 
-def send_midi_to_arduino(midi_file):
+def send_midi_to_arduino(midi_file, port=None):
     try:
         # Initialize serial connection to Arduino
         print("Attempting to connect to Arduino...")
-        arduino = serial.Serial('COM13', 9600, timeout=1)  # Ensure the correct port is used
-        time.sleep(2)  # Allow time for Arduino to reset
+        arduino = get_connection(port)  # Shared connection, opened once without resetting the board
         print("Connected to Arduino!")
 
-        mf = MidiFile(midi_file)
-        print(f"Loaded MIDI file: {midi_file}")
-
-        for i, track in enumerate(mf.tracks):
-            print(f"Processing track {i + 1}/{len(mf.tracks)}")
-
-            for msg in track:
-                print(f"Message: {msg}")
-
-                # Handle 'note_on' messages
-                if msg.type == 'note_on' and msg.velocity > 0:
-                    pitch = msg.note
-                    duration = msg.time  # Duration in ticks
-
-                    print(f"Sending note {pitch} with duration {duration}")
-                    try:
-                        # Split duration into two bytes
-                        duration_bytes = [duration >> 8, duration & 0xFF]
-                        arduino.write(bytes([pitch] + duration_bytes))
-
-                        # Wait for ACK from Arduino before continuing
-                        while True:
-                            ack = arduino.read()  # Read one byte
-                            if ack == b'\x06':  # 0x06 is the ASCII code for ACK
-                                print("ACK received, sending next note...")
-                                break  # Exit the loop once ACK is received
-                            else:
-                                print("Waiting for ACK...")
-
-                    except Exception as e:
-                        print(f"Error sending note to Arduino: {e}")
-
-                # Example case for handling a chord
-                elif msg.type == 'chord':
-                    chord_pitches = [note.note for note in msg.notes]
-                    duration = msg.time
-
-                    print(f"Sending chord {chord_pitches} with duration {duration}")
-                    try:
-                        chord_bytes = [pitch for pitch in chord_pitches]
-                        duration_bytes = [duration >> 8, duration & 0xFF]
-                        arduino.write(bytes(chord_bytes + duration_bytes))
-
-                        # Wait for ACK from Arduino before continuing
-                        while True:
-                            ack = arduino.read()  # Read one byte
-                            if ack == b'\x06':  # 0x06 is the ASCII code for ACK
-                                print("ACK received, sending next note...")
-                                break  # Exit the loop once ACK is received
-                            else:
-                                print("Waiting for ACK...")
+        mf = load_midi_file(midi_file)
+
+        # Loop through the messages of all tracks, merged in time order
+        previous_tick = 0
+        for event in merged_timeline(mf):
+            msg = event.msg
+            print(f"Message: {msg}")
+
+            duration = event.tick - previous_tick  # Duration in ticks, since the previous message of any track
+            previous_tick = event.tick
+
+            # Handle 'note_on' messages
+            if msg.type == 'note_on' and msg.velocity > 0:
+                pitch = msg.note
+
+                print(f"Sending note {pitch} with duration {duration}")
+                try:
+                    # Split duration into two bytes
+                    duration_bytes = [duration >> 8, duration & 0xFF]
+                    arduino.write(bytes([pitch] + duration_bytes))
+
+                    # Wait for ACK from Arduino before continuing
+                    while True:
+                        ack = arduino.read()  # Read one byte
+                        if ack == b'\x06':  # 0x06 is the ASCII code for ACK
+                            print("ACK received, sending next note...")
+                            break  # Exit the loop once ACK is received
+                        else:
+                            print("Waiting for ACK...")
+
+                except Exception as e:
+                    print(f"Error sending note to Arduino: {e}")
+
+            # Example case for handling a chord
+            elif msg.type == 'chord':
+                chord_pitches = [note.note for note in msg.notes]
+
+                print(f"Sending chord {chord_pitches} with duration {duration}")
+                try:
+                    chord_bytes = [pitch for pitch in chord_pitches]
+                    duration_bytes = [duration >> 8, duration & 0xFF]
+                    arduino.write(bytes(chord_bytes + duration_bytes))
+
+                    # Wait for ACK from Arduino before continuing
+                    while True:
+                        ack = arduino.read()  # Read one byte
+                        if ack == b'\x06':  # 0x06 is the ASCII code for ACK
+                            print("ACK received, sending next note...")
+                            break  # Exit the loop once ACK is received
+                        else:
+                            print("Waiting for ACK...")
 
-                    except Exception as e:
-                        print(f"Error sending chord to Arduino: {e}")
+                except Exception as e:
+                    print(f"Error sending chord to Arduino: {e}")
 
-        print("MIDI file processed successfully. Closing connection.")
-        arduino.close()
+        print("MIDI file processed successfully.")
 
     except serial.SerialException as se:
         print(f"Serial communication error: {se}")
@@ -155,91 +198,71 @@ def send_midi_to_arduino(midi_file):
         print(f"MIDI file not found: {fnfe}")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-    finally:
-        if arduino.is_open:
-            arduino.close()
-        print("Serial connection closed.")
 
 
-def send_midi_to_arduino_updated(midi_file):
+def send_midi_to_arduino_updated(midi_file, port=None):
     try:
         print("Attempting to connect to Arduino...")
-        arduino = serial.Serial('COM13', 9600, timeout=1)  # Adjust port as necessary
-        time.sleep(2)  # Allow time for Arduino to reset
+        arduino = get_connection(port)  # Shared connection, opened once without resetting the board
         print("Connected to Arduino!")
 
-        mf = MidiFile(midi_file)
-        print(f"Loaded MIDI file: {midi_file}")
+        mf = load_midi_file(midi_file)
 
-        ticks_per_beat = mf.ticks_per_beat
-        tempo = 500000  # Default tempo in microseconds per beat (120 BPM)
-        current_time = 0
+        notes_to_send = []  # To store notes in a chord
 
-        for i, track in enumerate(mf.tracks):
-            print(f"Processing track {i + 1}/{len(mf.tracks)}")
+        # Messages of all tracks merged in time order, with the tempo map applied
+        for _, delta_time_ms, msg in timed_deltas(mf):
+            print(f"Message: {msg}")
 
-            notes_to_send = []  # To store notes in a chord
+            if msg.type == 'note_on' and msg.velocity > 0:
+                pitch = msg.note
 
-            for msg in track:
-                print(f"Message: {msg}")
+                # Increase the duration slightly to slow down servos
+                duration = int(delta_time_ms * 1.5)
 
-                if msg.type == 'set_tempo':
-                    tempo = msg.tempo
+                # Set a minimum duration of 100ms to prevent rapid movement
+                if duration < 100:
+                    duration = 100
 
-                # Convert ticks to milliseconds
-                delta_time_ms = msg.time * (tempo / ticks_per_beat) / 1000.0
-                current_time += delta_time_ms
+                notes_to_send.append((pitch, duration))
 
-                if msg.type == 'note_on' and msg.velocity > 0:
-                    pitch = msg.note
+            # If there's a delay or an end of the track, send all collected notes as a chord
+            if (msg.type == 'note_on' and msg.velocity == 0) or (len(notes_to_send) > 0 and delta_time_ms > 0):
+                for pitch, duration in notes_to_send:
+                    print(f"Sending note {pitch} with duration {duration}")
+                    try:
+                        duration_bytes = [duration >> 8, duration & 0xFF]
+                        arduino.write(bytes([pitch] + duration_bytes))
 
-                    # Increase the duration slightly to slow down servos
-                    duration = int(delta_time_ms * 1.5)
-
-                    # Set a minimum duration of 100ms to prevent rapid movement
-                    if duration < 100:
-                        duration = 100
-
-                    notes_to_send.append((pitch, duration))
-
-                # If there's a delay or an end of the track, send all collected notes as a chord
-                if (msg.type == 'note_on' and msg.velocity == 0) or (len(notes_to_send) > 0 and msg.time > 0):
-                    for pitch, duration in notes_to_send:
-                        print(f"Sending note {pitch} with duration {duration}")
-                        try:
-                            duration_bytes = [duration >> 8, duration & 0xFF]
-                            arduino.write(bytes([pitch] + duration_bytes))
-
-                            # Add a small delay between sending notes to prevent servo overload
-                            time.sleep(0.05)  # 50 ms delay between notes
-
-                        except Exception as e:
-                            print(f"Error sending note to Arduino: {e}")
-
-                    # Retry mechanism for ACK
-                    retries = 3
-                    ack_received = False
-                    while retries > 0:
-                        start_time = time.time()
-                        while time.time() - start_time < 2:  # 2-second timeout
-                            ack = arduino.read()  # Read one byte
-                            if ack == b'\x06':  # ACK received
-                                print("ACK received, sending next notes...")
-                                ack_received = True
-                                break
-                        if ack_received:
+                        # Add a small delay between sending notes to prevent servo overload
+                        time.sleep(0.05)  # 50 ms delay between notes
+
+                    except Exception as e:
+                        print(f"Error sending note to Arduino: {e}")
+
+                # Retry mechanism for ACK
+                retries = 3
+                ack_received = False
+                while retries > 0:
+                    start_time = time.time()
+                    while time.time() - start_time < 2:  # 2-second timeout
+                        ack = arduino.read()  # Read one byte
+                        if ack == b'\x06':  # ACK received
+                            print("ACK received, sending next notes...")
+                            ack_received = True
                             break
-                        else:
-                            retries -= 1
-                            print(f"ACK timeout, retrying... ({3 - retries}/3)")
+                    if ack_received:
+                        break
+                    else:
+                        retries -= 1
+                        print(f"ACK timeout, retrying... ({3 - retries}/3)")
 
-                    if retries == 0:
-                        print("Failed to receive ACK after 3 retries, moving to next notes...")
+                if retries == 0:
+                    print("Failed to receive ACK after 3 retries, moving to next notes...")
 
-                    notes_to_send.clear()  # Clear the notes buffer for the next chord or note
+                notes_to_send.clear()  # Clear the notes buffer for the next chord or note
 
-        print("MIDI file processed successfully. Closing connection.")
-        arduino.close()
+        print("MIDI file processed successfully.")
 
     except serial.SerialException as se:
         print(f"Serial communication error: {se}")
@@ -247,135 +270,338 @@ def send_midi_to_arduino_updated(midi_file):
         print(f"MIDI file not found: {fnfe}")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-    finally:
-        if arduino.is_open:
-            arduino.close()
-        print("Serial connection closed.")
 
 
 # Worker thread for processing
 class WorkerThread(QThread):
     update_message = pyqtSignal(str)
     progress = pyqtSignal(int)
+    timings = pyqtSignal(str)
+    fitted = pyqtSignal(object)  # Refitter of the converted song, for the preview
 
-    def __init__(self, input_file, output_dir):
+    def __init__(self, input_file, output_dir=None, streaming=False, port=None, fit_params=None):
+        """
+        :param port: Serial port to play on, ARDUINO_PORT if not given.
+        :param fit_params: Fitting parameters, see refit.FIT_DEFAULTS.
+        """
         super().__init__()
         self.input_file = input_file
-        self.output_dir = output_dir
-        self.arduino = serial.Serial("COM13", 9600, timeout=1)
-        time.sleep(2)  # Wait for Arduino to reset
+        self.fit_params = dict(FIT_DEFAULTS, **(fit_params or {}))
+        self.output_dir = output_dir  # MIDI files are only exported when an output directory is given
+        self.streaming = streaming  # Start playing while the rest of the song is still being transcribed
+        # The port stays open between songs and is only opened (without a board reset) on first use,
+        # so nothing here blocks the GUI thread
+        self.port = port
+        self.arduino = get_connection(port, connect=False)
+        # With several boards every one gets a sender of its own, which is never started as a thread. They are set
+        # up when the job starts (see run), so a malformed ARDUINO_SHARDS is reported instead of crashing the window.
+        self.shards = []
+        self.shard_senders = []
+        self.use_framing = USE_FRAMED_PROTOCOL
+        self.frame_encoder = self.arduino.frame_encoder
+        self.frame_decoder = self.arduino.frame_decoder
+        # Several frames stay in flight, only lost ones are sent again
+        self.window_sender = self.arduino.window_sender
+        self.last_scheduler = None  # PlaybackScheduler of the last song or segment sent
 
     def run(self):
+        trace_name = f"{os.path.splitext(os.path.basename(self.input_file))[0]}_{time.strftime('%Y%m%d_%H%M%S')}"
+        tracer = Tracer(os.path.join(TRACE_DIR, trace_name + '_profiles') if PROFILE_STAGES else None)
+        if self.port is None:
+            try:
+                self.shards = device_shards()
+            except ValueError as e:
+                print(f"Invalid {SHARDS_VARIABLE}: {e}")
+                self.update_message.emit(f"Invalid {SHARDS_VARIABLE}: {e}")
+                return
+            self.shard_senders = [WorkerThread(self.input_file, port=shard.port) for shard in self.shards]
+        with contextlib.ExitStack() as sessions, tracer.activate():
+            for sender in self.shard_senders or [self]:
+                sender.use_framing = self.use_framing
+                sessions.enter_context(sender.session())
+            self.process()
+        self.report_timings(tracer, trace_name)
+
+    @contextlib.contextmanager
+    def session(self):
+        # One song at a time on the shared port
+        with self.arduino.session_lock:
+            self.arduino.telemetry.reset()
+            # Replies are read on the engine's own thread while this one keeps writing
+            self.arduino.io.start(framed=self.use_framing)
+            try:
+                yield
+            finally:
+                self.arduino.io.stop()
+
+    def report_timings(self, tracer, trace_name):
+        """Writes the job's trace and sends the per-stage breakdown to the window."""
+        breakdown = tracer.format_breakdown()
+        print(breakdown)
+        try:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            tracer.write_chrome_trace(os.path.join(TRACE_DIR, trace_name + '.trace.json'))
+        except OSError as e:
+            print(f"Could not write trace: {e}")
+        self.timings.emit(breakdown)
+
+    def process(self):
+        if self.input_file.lower().endswith(PLAN_EXTENSION):
+            # A compiled song from an earlier conversion, played without transcribing or parsing anything
+            self.update_message.emit("Playing compiled song...")
+            self.play_plan(self.input_file)
+            self.update_message.emit("MIDI notes processed")
+            self.progress.emit(100)
+            return
+
+        if self.streaming:
+            self.run_streaming()
+            return
+
         self.update_message.emit("Converting MP3 to MIDI...")
-        midi_file = self.convert_mp3_to_midi(self.input_file, self.output_dir)
+        with span('transcribe'):
+            midi_data, note_events = self.transcribe_mp3(self.input_file)
+        print_model_stats()
         self.progress.emit(50)  # Update progress
 
         self.update_message.emit("Fitting MIDI notes to octave range...")
-        fitted_midi_file = self.fit_midi_to_octave_range(midi_file, os.path.join(self.output_dir, 'adjusted_music.mid'))
+        # The notes go straight from Basic Pitch to fitting and sending, without MIDI files in between
+        refitter = Refitter(note_table.from_note_events(note_events))
+        with span('fit', notes=len(note_events)):
+            fitted_notes = refitter.refit(**self.fit_params)
+        # The window keeps the notes, so other fitting values can be previewed without converting again
+        self.fitted.emit(refitter)
+        fitted_notes = self.plan_for_servos(fitted_notes)
+        with span('build MIDI'):
+            fitted_midi = note_table.to_midi_file(fitted_notes)
         self.progress.emit(100)  # Update progress
 
         self.update_message.emit("MIDI notes processed")
-        # Here you can add the code to send MIDI to Arduino
 
         # Send MIDI to Arduino
-        # Updated function with better timing
-        # send_midi_to_arduino_updated(fitted_midi_file)
-        self.send_midi_to_arduino_updated_timing(fitted_midi_file)
+        with span('serial transmission'):
+            if self.shard_senders:
+                # Every board plays the notes of its own pitch range
+                self.send_to_shards(fitted_midi)
+            elif USE_DEVICE_BUFFER and self.use_framing:
+                # The Arduino plays from its own buffer, host timing no longer matters
+                self.stream_midi_to_arduino(fitted_midi)
+            else:
+                # Updated function with better timing
+                # send_midi_to_arduino_updated(fitted_midi)
+                self.send_midi_to_arduino_updated_timing(fitted_midi)
 
         # First original function for sending notes/chords
-        # send_midi_to_arduino(fitted_midi_file)
+        # send_midi_to_arduino(fitted_midi)
 
         # Function for sending all notes/chord at once
-        # send_midi_to_arduino_bulk(fitted_midi_file)
+        # send_midi_to_arduino_bulk(fitted_midi)
+
+        if self.output_dir:
+            with span('export'):
+                self.export_midi_files(midi_data, fitted_notes)
+
+    def run_streaming(self):
+        """
+        Transcribes, fits and plays the song as a pipeline of segments (see pipeline.py): while segment N is
+        played, segment N+1 is fitted and the following windows are transcribed, so playback starts after the
+        first windows instead of after the whole song. The bounded queues between the stages keep at most a few
+        segments in memory when transcription runs ahead of playback.
+        A song that was transcribed before, streamed or not, is played from the transcription cache instead.
+        """
+        from basic_pitch.constants import AUDIO_SAMPLE_RATE
+        from basic_pitch.note_creation import note_events_to_midi
+        from streaming import shift_note_events, stream_note_events
+        from transcription import INFERENCE_PARAMS, load_audio
+        from transcription_cache import cache_key, get_cache, hash_file
+
+        self.update_message.emit("Converting and playing...")
+        cache = get_cache()
+        with span('transcription cache lookup'):
+            audio_hash = hash_file(self.input_file)
+            # Streamed notes can differ from a whole-song transcription at the window edges, so they get a key
+            # of their own. The whole-song transcription is preferred when both are cached.
+            streamed_key = cache_key(self.input_file, dict(INFERENCE_PARAMS, streamed=True), audio_hash=audio_hash)
+            cached = cache.get(cache_key(self.input_file, INFERENCE_PARAMS, audio_hash=audio_hash)) or \
+                cache.get(streamed_key)
+        if cached is not None:
+            print(f"Using cached transcription for {self.input_file}")
+            note_events = cached[1]
+            song_duration = max((event[1] for event in note_events), default=0.0)
+            # Fitting the whole song takes milliseconds, so it is played as a single segment
+            segments = iter([(0.0, song_duration, list(note_events))])
+        else:
+            with span('decode audio'):
+                audio = load_audio(self.input_file, audio_hash)
+            song_duration = len(audio) / AUDIO_SAMPLE_RATE
+            segments = stream_note_events(audio, get_model())
+        all_note_events = []
+
+        # Segments are played on one clock for the whole song, at their time in the song
+        song_start_ns = None
+        fitted_end = 0.0  # Seconds, end of the fitted segments so far
+        sharded_playback = ShardedPlayback(self.shards) if self.shard_senders else None
+
+        def fit_segment(segment):
+            nonlocal fitted_end
+            segment_start, segment_end, note_events = segment
+            print(f"Segment {segment_start:.1f}s - {segment_end:.1f}s: {len(note_events)} notes")
+            all_note_events.extend(note_events)
+            self.progress.emit(min(99, int(100 * segment_end / song_duration)) if song_duration else 99)
+            if not note_events:
+                return None
+            # Each segment is fitted on its own, with times relative to the segment start
+            segment_notes = note_table.from_note_events(shift_note_events(note_events, -segment_start))
+            fitted_notes = self.plan_for_servos(Refitter(segment_notes).refit(**self.fit_params))
+            if self.fit_params['smooth_timing']:
+                # Smoothing places the notes back to back, so the segment follows the end of the previous one
+                offset = fitted_end
+                fitted_end += preview_table(fitted_notes).duration_s
+            else:
+                offset = segment_start
+            return offset, note_table.to_midi_file(fitted_notes)
+
+        def play_segment(segment):
+            nonlocal song_start_ns
+            offset, segment_midi = segment
+            offset_ns = int(offset * 1e9)
+            if self.shard_senders:
+                self.send_to_shards(segment_midi, finish=False, playback=sharded_playback, offset_ns=offset_ns)
+                return
+            if song_start_ns is None:
+                song_start_ns = time.monotonic_ns()
+            with shared_start(song_start_ns):
+                self.send_midi_to_arduino_updated_timing(segment_midi, finish=False, offset_ns=offset_ns)
+
+        pipeline = Pipeline('transcribe', segments, [
+            ('fit', fit_segment),
+            ('serial transmission', play_segment),
+        ], queue_size=PIPELINE_QUEUE_SIZE)
+        try:
+            pipeline.run()
+        finally:
+            print(pipeline.report())
+        print_model_stats()
+
+        midi_data = cached[0] if cached is not None else note_events_to_midi(all_note_events)
+        if cached is None:
+            with span('transcription cache write'):
+                cache.put(streamed_key, midi_data, all_note_events)
+        refitter = Refitter(note_table.from_note_events(all_note_events))
+        if self.output_dir:
+            with span('export'):
+                self.export_midi_files(midi_data, refitter.refit(**self.fit_params))
+        self.fitted.emit(refitter)
+
+        for sender in self.shard_senders or [self]:
+            if sender.last_scheduler is not None:
+                sender.last_scheduler.print_drift()
+            sender.finish_sending()
+        self.update_message.emit("MIDI notes processed")
+        self.progress.emit(100)
 
     @staticmethod
-    def convert_mp3_to_midi(input_dir, output_dir):
-        basic_pitch_model = Model(ICASSP_2022_MODEL_PATH)
-        midi_filename = os.path.splitext(os.path.basename(input_dir))[0] + "_basic_pitch.mid"
-
-        predict_and_save(
-            audio_path_list=[input_dir],
-            output_directory=output_dir,
-            model_or_model_path=ICASSP_2022_MODEL_PATH,
-            save_midi=True,
-            save_model_outputs=True,
-            sonify_midi=True,
-            save_notes=True
-        )
-        return os.path.join(output_dir, midi_filename)
+    def plan_for_servos(fitted_notes):
+        """Moves, shortens or drops the notes the servos could not play in time, and reports what changed."""
+        if SERVO_PROFILE is None:
+            return fitted_notes
+        with span('plan servos', notes=len(fitted_notes)):
+            planned_notes, allocation = allocate_table(fitted_notes, SERVO_PROFILE)
+        print(allocation.summary())
+        return planned_notes
 
     @staticmethod
-    def fit_midi_to_octave_range(midi_file, output_file, min_note='C4', max_note='C5', gap_duration=0.2,
-                                 tempo_factor=2.5, duration_extension=0.5):
+    def transcribe_mp3(input_file):
+        """
+        Transcribes the MP3 in memory and returns Basic Pitch's MIDI data and note events.
+        A song that was transcribed before is loaded from the transcription cache instead.
+        """
+        from transcription import transcribe_file
 
-        score = converter.parse(midi_file)
-        score = transpose_to_octave(score, min_note, max_note)
+        midi_data, note_events, _ = transcribe_file(input_file)
+        return midi_data, note_events
 
-        # Remove repeating chords
-        unique_score = remove_repeating_chords(score)
+    def export_midi_files(self, midi_data, fitted_notes):
+        """Optionally saves the raw transcription and the fitted score, as the file-based pipeline does."""
+        midi_filename = os.path.splitext(os.path.basename(self.input_file))[0] + "_basic_pitch.mid"
+        with span('write MIDI files'):
+            midi_data.write(os.path.join(self.output_dir, midi_filename))
+            note_table.write_midi(fitted_notes, os.path.join(self.output_dir, 'adjusted_music.mid'))
+        print(f"MIDI files exported to {self.output_dir}")
 
-        # Shift overlapping notes instead of cutting them off
-        smooth_score = shift_overlapping_notes(unique_score)
+        # Compiled once here, so replays of the song can skip transcription, fitting and MIDI parsing
+        plan_filename = os.path.splitext(os.path.basename(self.input_file))[0] + PLAN_EXTENSION
+        with span('compile plan'):
+            compile_plan(note_table.to_midi_file(fitted_notes), os.path.join(self.output_dir, plan_filename),
+                         min_note_duration=MIN_NOTE_DURATION)
 
-        # Removing sharp notes
-        remove_sharps(smooth_score)
+    @staticmethod
+    def convert_mp3_to_midi(input_dir, output_dir, **inference_params):
+        from transcription import transcribe_and_save
 
-        mf = midi.translate.music21ObjectToMidiFile(smooth_score)
-        mf.open(output_file, 'wb')
-        mf.write()
-        mf.close()
-        return output_file
+        # Reusing the model loaded by an earlier conversion, if any, and the decoded audio of an earlier run
+        return transcribe_and_save(input_dir, output_dir, save_model_outputs=True, sonify_midi=True, save_notes=True,
+                                   **inference_params)
 
-    def send_midi_to_arduino_updated_timing(self, midi_file, min_note_duration=200):
+    @staticmethod
+    def fit_midi_to_octave_range(midi_file, output_file, min_note='C4', max_note='C5', gap_duration=0.2,
+                                 tempo_factor=2.5, duration_extension=0.5):
+        import midi_processing
+        return midi_processing.fit_midi_to_octave_range(midi_file, output_file, min_note, max_note, gap_duration,
+                                                        tempo_factor, duration_extension)
+
+    def send_midi_to_arduino_updated_timing(self, midi_file, min_note_duration=MIN_NOTE_DURATION, finish=True,
+                                            offset_ns=0):
         """
         Sends MIDI data to Arduino while following the original timing and slowing down the tempo as needed.
         :param midi_file: Path to the MIDI file
         :param min_note_duration: Minimum duration in milliseconds for any note, regardless of MIDI timing.
+        :param finish: Whether to wait for the outstanding frames afterwards. Streaming mode only does so after the
+            last segment.
+        :param offset_ns: Time of the start of the MIDI data in the song. Streaming mode plays every segment on the
+            clock of the whole song (see shared_start), so the silence between two segments is kept.
         """
         try:
-            mf = MidiFile(midi_file)
-            print(f"Loaded MIDI file: {midi_file}")
-
-            ticks_per_beat = mf.ticks_per_beat
-            tempo = 500000  # Default tempo in microseconds per beat (120 BPM)
-            current_time = 0
+            mf = load_midi_file(midi_file)
 
-            for i, track in enumerate(mf.tracks):
-                print(f"Processing track {i + 1}/{len(mf.tracks)}")
+            # Every chord is sent at its absolute time in the song, so time spent sending does not add up as drift
+            scheduler = PlaybackScheduler()
+            scheduler.start()
+            # Notes planned for the servos are sent with their planned length, which keeps every servo free in time
+            # for its next strike
+            planned_lengths = note_lengths(mf) if SERVO_PROFILE else None
 
-                notes_to_send = []  # To store notes in a chord
-
-                for msg in track:
-                    print(f"Message: {msg}")
+            notes_to_send = []  # To store notes in a chord
+            chord_time_ns = 0  # Start of the chord that is being collected
 
-                    if msg.type == 'set_tempo':
-                        tempo = msg.tempo
+            # Messages of all tracks merged in time order, with the tempo map applied
+            for time_ns, delta_time_ms, msg in timed_deltas(mf):
+                print(f"Message: {msg}")
 
-                    # Convert ticks to milliseconds and apply the tempo scaling
-                    delta_time_ms = msg.time * (tempo / ticks_per_beat) / 1000.0
-                    current_time += delta_time_ms
+                # A later message or a note_off ends the chord, send all collected notes
+                if notes_to_send and (time_ns > chord_time_ns or msg.type == 'note_off'):
+                    self.send_chord_at(scheduler, offset_ns + chord_time_ns, notes_to_send)
+                    notes_to_send = []
 
-                    if msg.type == 'note_on' and msg.velocity > 0:
-                        pitch = msg.note
+                if msg.type == 'note_on' and msg.velocity > 0:
+                    if not notes_to_send:
+                        chord_time_ns = time_ns
 
+                    if planned_lengths is not None:
+                        duration = max(planned_lengths[time_ns, msg.note].pop(0) // 1_000_000, min_note_duration)
+                    else:
                         # Adjust the duration using tempo scale and ensure a minimum duration
                         duration = max(int(delta_time_ms), min_note_duration)
 
-                        notes_to_send.append((pitch, duration))
+                    notes_to_send.append((msg.note, duration))
 
-                    # If there's a delay or an end of the track, send all collected notes as a chord
-                    if (msg.type == 'note_off' or msg.time > 0) and len(notes_to_send) > 0:
-                        print(f"Sending chord with {len(notes_to_send)} notes")
+            if notes_to_send:
+                self.send_chord_at(scheduler, offset_ns + chord_time_ns, notes_to_send)
 
-                        # Send all notes in the chord
-                        self.send_chord_to_arduino(notes_to_send)
-                        notes_to_send.clear()  # Clear the notes buffer for the next chord
-
-                        # Wait for the correct timing before sending the next chord/note
-                        time.sleep(delta_time_ms / 1000.0)
-
-            print("MIDI file processed successfully. Closing connection.")
-            self.arduino.close()
+            # Segments of a streamed song print the drift of the whole song after the last one
+            scheduler.print_report(drift=finish)
+            self.last_scheduler = scheduler
+            print("MIDI file processed successfully.")
 
         except serial.SerialException as se:
             print(f"Serial communication error: {se}")
@@ -384,55 +610,166 @@ class WorkerThread(QThread):
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
         finally:
-            atexit.register(close_arduino_connection)
-            if self.arduino.is_open:
-                self.arduino.close()
-            print("Serial connection closed.")
+            if finish:
+                self.finish_sending()
+
+    def stream_midi_to_arduino(self, midi_file, min_note_duration=MIN_NOTE_DURATION, finish=True,
+                               start_barrier=None):
+        """
+        Streams the whole song into the Arduino's ring buffer, a few seconds ahead of its playhead.
+        Unlike send_midi_to_arduino_bulk there is no limit on the number of notes.
+        :param min_note_duration: Minimum duration in milliseconds for any note.
+        :param start_barrier: Barrier shared with the senders of the other boards playing the song. Their clocks
+            are started together and kept in step with SYNC frames.
+        """
+        try:
+            events = note_events_ms(load_midi_file(midi_file), min_note_duration)
+            streamer = LookaheadStreamer(self.arduino, self.frame_encoder, self.frame_decoder,
+                                         telemetry=self.arduino.telemetry, io=self.arduino.io,
+                                         start_barrier=start_barrier,
+                                         clock_sync_interval=CLOCK_SYNC_INTERVAL if start_barrier else None)
+            if streamer.play(events):
+                print("MIDI file processed successfully.")
+        except serial.SerialException as se:
+            print(f"Serial communication error: {se}")
+        except FileNotFoundError as fnfe:
+            print(f"MIDI file not found: {fnfe}")
+        finally:
+            if finish:
+                self.finish_sending()
+
+    def send_to_shards(self, midi_file, finish=True, playback=None, offset_ns=0):
+        """
+        Splits the song by pitch and plays every part on its own board, all starting together (see
+        multi_device.py). Each board is played by its own sender with the same strategy as a single board.
+        :param playback: ShardedPlayback shared by all segments of a streamed song, so they are played on the clock
+            of the whole song at offset_ns. Segments are always sent on the host clock, as with a single board.
+        """
+        segment = playback is not None
+        playback = playback or ShardedPlayback(self.shards)
+        senders = dict(zip((shard.port for shard in self.shards), self.shard_senders))
+        if USE_DEVICE_BUFFER and self.use_framing and not segment:
+            # The boards start their clocks themselves, once all of them have filled their buffers
+            start_barrier = threading.Barrier(len(self.shards))
+
+            def play(shard, part):
+                senders[shard.port].stream_midi_to_arduino(part, finish=finish, start_barrier=start_barrier)
+
+            playback.play_midi(load_midi_file(midi_file), play, synchronized_start=False)
+        else:
+            def play(shard, part):
+                senders[shard.port].send_midi_to_arduino_updated_timing(part, finish=finish, offset_ns=offset_ns)
+
+            playback.play_midi(load_midi_file(midi_file), play)
+
+    def play_plan(self, plan_path, finish=True):
+        """
+        Plays a compiled playback plan (see playback_plan.py). The records are memory-mapped and already hold
+        absolute times and durations, so nothing is parsed or converted before the first note.
+        """
+        try:
+            with span('load plan'):
+                records, song_length_ms = load_plan(plan_path)
+            print(f"Playing {plan_path}: {len(records)} chords, {song_length_ms / 1000:.1f}s")
+
+            with span('serial transmission'):
+                if USE_DEVICE_BUFFER and self.use_framing:
+                    streamer = LookaheadStreamer(self.arduino, self.frame_encoder, self.frame_decoder,
+                                                 telemetry=self.arduino.telemetry, io=self.arduino.io)
+                    streamer.play(plan_events(records))
+                    return
+
+                scheduler = PlaybackScheduler()
+                scheduler.start()
+                for time_ms, notes in plan_chords(records):
+                    self.send_chord_at(scheduler, time_ms * 1_000_000, notes)
+                scheduler.print_report()
+        except (OSError, ValueError) as e:
+            print(f"Could not play {plan_path}: {e}")
+        finally:
+            if finish:
+                self.finish_sending()
+
+    def send_chord_at(self, scheduler, chord_time_ns, notes):
+        """Waits for the chord's time in the song, then sends it."""
+        scheduler.wait_until(chord_time_ns, max(duration for _, duration in notes) * 1_000_000)
+        print(f"Sending chord with {len(notes)} notes")
+        self.send_chord_to_arduino(notes)
 
     def send_chord_to_arduino(self, notes):
         """
         Sends a chord (multiple notes) to the Arduino. Each note is sent along with its duration.
         """
+        if self.use_framing:
+            self.send_chord_frames(notes)
+            return
+
         try:
+            # All notes of the chord in one write, without a pause between them. A chord is at most a few dozen
+            # bytes, well within the Arduino's 64-byte receive buffer.
+            data = bytearray()
             for pitch, duration in notes:
                 # Convert duration to 2 bytes
-                duration_bytes = [duration >> 8, duration & 0xFF]
-                # Send the pitch and duration bytes to Arduino
-                self.arduino.write(bytes([pitch] + duration_bytes))
-                print(f"Sent note {pitch} with duration {duration}")
-                # Add a small delay to avoid overloading the Arduino with many notes at once
-                time.sleep(0.05)  # 50 ms delay between notes
+                data += bytes([pitch, duration >> 8, duration & 0xFF])
+            self.arduino.write(bytes(data))
+            print(f"Sent {len(notes)} note(s): {notes}")
 
-            # Retry mechanism for ACK
+            # The sketch answers every note with an ACK
             retries = 3
-            ack_received = False
-
-            while retries > 0:
-                start_time = time.time()
-                while time.time() - start_time < 2:  # 2-second timeout
-                    ack = self.arduino.read()  # Read one byte
-                    if ack == b'\x06':  # ACK received
-                        print("ACK received, chord played successfully.")
-                        ack_received = True
-                        break
-                if ack_received:
-                    break
+            pending = len(notes)
+            telemetry = self.arduino.telemetry
+            sent_ns = time.perf_counter_ns()  # After the last note, the round trip is measured from here
+
+            while pending and retries > 0:
+                # Sleeps until the reader thread sees the ACK, with a 2-second timeout
+                if self.arduino.wait_for_ack(2):
+                    telemetry.record_ack(time.perf_counter_ns() - sent_ns)
+                    pending -= 1
                 else:
                     retries -= 1
+                    telemetry.count('timeouts')
+                    if retries:
+                        telemetry.count('retries')
                     print(f"ACK timeout, retrying... ({3 - retries}/3)")
 
-            if retries == 0:
+            if pending:
+                telemetry.count('failures')
                 print("Failed to receive ACK after 3 retries, moving to next notes...")
+            else:
+                print("ACK received, chord played successfully.")
 
         except Exception as e:
             print(f"Error sending chord to Arduino: {e}")
 
-    def close_arduino_connection(self):
-        if self.arduino:
-            print("Closing Arduino connection safely.")
-            self.arduino.close()
+    def send_chord_frames(self, notes):
+        """
+        Sends notes that start together as CHORD frames, one frame per chord instead of one write per note.
+        The frames go through the sliding window, so this only blocks while the window is full.
+        """
+        try:
+            for chunk in chunk_notes(notes, MAX_CHORD_NOTES):
+                seq, frame = self.frame_encoder.chord(chunk)
+                print(f"Sending frame {seq} with {len(chunk)} note(s)")
+                self.window_sender.submit(seq, frame)
+            self.window_sender.poll()
+        except Exception as e:
+            print(f"Error sending chord to Arduino: {e}")
 
-    def send_midi_to_arduino_batch(self, midi_file, batch_size=5, min_note_duration=200):
+    def finish_sending(self):
+        """
+        Waits for the last frames of the song and prints the link telemetry of the song.
+        The connection itself stays open for the next song.
+        """
+        if self.arduino.is_open:
+            if self.window_sender.in_flight:
+                print(f"Waiting for {len(self.window_sender.in_flight)} unacknowledged frame(s)...")
+                self.window_sender.flush(timeout=5)
+            print(f"Frames: {self.window_sender.stats}")
+        # Numbers of this song only, the next one starts from zero
+        print(self.arduino.telemetry.report(histograms=True))
+        self.arduino.telemetry.reset()
+
+    def send_midi_to_arduino_batch(self, midi_file, batch_size=5, min_note_duration=MIN_NOTE_DURATION):
         """
         Sends MIDI data to Arduino in batches while preserving original timing, without modifying the tempo.
         Chords are handled by sending all notes with the same delta time together.
@@ -441,61 +778,51 @@ class WorkerThread(QThread):
         :param min_note_duration: Minimum duration in milliseconds for any note.
         """
         try:
-            mf = MidiFile(midi_file)
-            print(f"Loaded MIDI file: {midi_file}")
+            mf = load_midi_file(midi_file)
 
-            ticks_per_beat = mf.ticks_per_beat
-            tempo = 500000  # Default tempo in microseconds per beat (120 BPM)
-            current_time = 0
+            scheduler = PlaybackScheduler()
+            scheduler.start()
             notes_batch = []  # To store notes in a batch
             chord_notes = []  # To store chord notes
 
-            for i, track in enumerate(mf.tracks):
-                print(f"Processing track {i + 1}/{len(mf.tracks)}")
-
-                for msg in track:
-                    if msg.type == 'set_tempo':
-                        tempo = msg.tempo
-
-                    # Convert ticks to milliseconds using the original tempo
-                    delta_time_ms = msg.time * (tempo / ticks_per_beat) / 1000.0
-                    current_time += delta_time_ms
-
-                    if msg.type == 'note_on' and msg.velocity > 0:
-                        pitch = msg.note
-                        duration = max(int(delta_time_ms), min_note_duration)
+            # Messages of all tracks merged in time order, with the tempo map applied
+            for time_ns, delta_time_ms, msg in timed_deltas(mf):
+                if msg.type == 'note_on' and msg.velocity > 0:
+                    pitch = msg.note
+                    duration = max(int(delta_time_ms), min_note_duration)
 
-                        # If delta time is zero, it's part of a chord
-                        if msg.time == 0:
-                            chord_notes.append((pitch, duration))
-                        else:
-                            # Send any collected chord notes first
-                            if chord_notes:
-                                self.send_batch_to_arduino(chord_notes)  # Send chord together
-                                chord_notes.clear()
+                    # If delta time is zero, it's part of a chord
+                    if delta_time_ms == 0:
+                        chord_notes.append((pitch, duration))
+                    else:
+                        # Send any collected chord notes first
+                        if chord_notes:
+                            self.send_batch_to_arduino(chord_notes)  # Send chord together
+                            chord_notes.clear()
 
-                            # Now add the individual note
-                            notes_batch.append((pitch, duration))
+                        # Now add the individual note
+                        notes_batch.append((pitch, duration))
 
-                            # If the batch is full, send it
-                            if len(notes_batch) >= batch_size:
-                                self.send_batch_to_arduino(notes_batch)
-                                notes_batch.clear()
+                        # If the batch is full, send it
+                        if len(notes_batch) >= batch_size:
+                            self.send_batch_to_arduino(notes_batch)
+                            notes_batch.clear()
 
-                            # Respect the original timing
-                            time.sleep(delta_time_ms / 1000.0)
+                        # Respect the original timing, against the absolute time of the note
+                        scheduler.wait_until(time_ns, duration * 1_000_000)
 
-                # If there's a chord to send after the loop, send it
-                if chord_notes:
-                    self.send_batch_to_arduino(chord_notes)
-                    chord_notes.clear()
+            # If there's a chord to send after the loop, send it
+            if chord_notes:
+                self.send_batch_to_arduino(chord_notes)
+                chord_notes.clear()
 
             # Send any remaining notes in the batch
             if notes_batch:
                 self.send_batch_to_arduino(notes_batch)
+            scheduler.print_report()
 
-            print("MIDI file processed successfully. Closing connection.")
-            self.arduino.close()
+            print("MIDI file processed successfully.")
+            self.finish_sending()
 
         except Exception as e:
             print(f"An error occurred: {e}")
@@ -505,6 +832,11 @@ class WorkerThread(QThread):
         Sends a batch of notes or chords to Arduino and waits for ACK after the batch is sent.
         :param notes_batch: List of notes to send in a batch or a chord.
         """
+        if self.use_framing:
+            # All notes of a batch were written at once without delays, which is exactly a chord frame
+            self.send_chord_frames(notes_batch)
+            return
+
         try:
             for pitch, duration in notes_batch:
                 duration_bytes = [duration >> 8, duration & 0xFF]
@@ -522,12 +854,12 @@ class WorkerThread(QThread):
         Waits for an ACK from Arduino with a timeout.
         :param timeout: Time in seconds to wait for the ACK.
         """
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            ack = self.arduino.read()
-            if ack == b'\x06':  # ACK received
-                print("ACK received.")
-                return
+        sent_ns = time.perf_counter_ns()
+        if self.arduino.wait_for_ack(timeout):
+            self.arduino.telemetry.record_ack(time.perf_counter_ns() - sent_ns)
+            print("ACK received.")
+            return
+        self.arduino.telemetry.count('timeouts')
         print("ACK not received within timeout.")
 
 
@@ -557,7 +889,7 @@ class MP3ToMIDIApp(QMainWindow):
         self.input_label.setStyleSheet(self.get_default_stylesheet())
         self.layout.addWidget(self.input_label)
 
-        self.output_label = QLabel("Drag & Drop Output Directory Here", self)
+        self.output_label = QLabel("Drag & Drop Output Directory Here (optional)", self)
         self.output_label.setAlignment(Qt.AlignCenter)
         self.output_label.setStyleSheet(self.get_default_stylesheet())
         self.layout.addWidget(self.output_label)
@@ -570,10 +902,50 @@ class MP3ToMIDIApp(QMainWindow):
         self.select_output_btn.clicked.connect(self.select_output_directory)
         self.layout.addWidget(self.select_output_btn)
 
+        self.streaming_checkbox = QCheckBox('Start playback while converting', self)
+        self.layout.addWidget(self.streaming_checkbox)
+
         self.process_button = QPushButton('Convert and Send', self)
         self.process_button.clicked.connect(self.start_conversion)
         self.layout.addWidget(self.process_button)
 
+        # Time per stage of the last job, shown when it is done
+        self.timings_label = QLabel(self)
+        self.timings_label.setStyleSheet("font-family: monospace;")
+        self.timings_label.hide()
+        self.layout.addWidget(self.timings_label)
+
+        # Fitting values for the next conversion, previewed on the last converted song while they are changed
+        self.fit_panel = QWidget(self)
+        fit_form = QFormLayout(self.fit_panel)
+        self.min_note_edit = QLineEdit(FIT_DEFAULTS['min_note'], self)
+        self.max_note_edit = QLineEdit(FIT_DEFAULTS['max_note'], self)
+        self.tempo_factor_spin = self.create_spin_box(FIT_DEFAULTS['tempo_factor'], 0.1, 10.0)
+        self.gap_duration_spin = self.create_spin_box(FIT_DEFAULTS['gap_duration'], 0.0, 4.0)
+        self.duration_extension_spin = self.create_spin_box(FIT_DEFAULTS['duration_extension'], 0.0, 4.0)
+        self.smooth_timing_checkbox = QCheckBox('Smooth timing (tempo factor, gap and extension)', self)
+        self.smooth_timing_checkbox.setChecked(FIT_DEFAULTS['smooth_timing'])
+        fit_form.addRow('Lowest note', self.min_note_edit)
+        fit_form.addRow('Highest note', self.max_note_edit)
+        fit_form.addRow('Tempo factor', self.tempo_factor_spin)
+        fit_form.addRow('Gap (quarter notes)', self.gap_duration_spin)
+        fit_form.addRow('Duration extension (quarter notes)', self.duration_extension_spin)
+        fit_form.addRow(self.smooth_timing_checkbox)
+        self.layout.addWidget(self.fit_panel)
+        for edit in (self.min_note_edit, self.max_note_edit):
+            edit.textChanged.connect(self.update_preview)
+        for spin_box in (self.tempo_factor_spin, self.gap_duration_spin, self.duration_extension_spin):
+            spin_box.valueChanged.connect(self.update_preview)
+        self.smooth_timing_checkbox.toggled.connect(self.update_preview)
+
+        self.preview_label = QLabel("Convert a song to preview the fitting", self)
+        self.layout.addWidget(self.preview_label)
+
+        self.send_refitted_button = QPushButton('Send Again with These Settings', self)
+        self.send_refitted_button.clicked.connect(self.send_refitted)
+        self.send_refitted_button.hide()
+        self.layout.addWidget(self.send_refitted_button)
+
         self.process_again_button = QPushButton('Process Again', self)
         self.process_again_button.clicked.connect(self.process_again)
         self.process_again_button.hide()  # Hide it initially
@@ -581,6 +953,16 @@ class MP3ToMIDIApp(QMainWindow):
 
         self.input_file = None
         self.output_dir = None
+        self.fit_params = dict(FIT_DEFAULTS)
+        self.refitter = None  # Notes of the last converted song
+        self.refitter_input = None
+
+    def create_spin_box(self, value, minimum, maximum):
+        spin_box = QDoubleSpinBox(self)
+        spin_box.setRange(minimum, maximum)
+        spin_box.setSingleStep(0.1)
+        spin_box.setValue(value)
+        return spin_box
 
     @staticmethod
     def get_default_stylesheet():
@@ -619,6 +1001,9 @@ class MP3ToMIDIApp(QMainWindow):
             if os.path.isfile(file_path) and file_path.lower().endswith('.mp3'):
                 self.input_file = file_path
                 self.input_label.setText(f"Selected MP3: {file_path}")
+            elif os.path.isfile(file_path) and file_path.lower().endswith(PLAN_EXTENSION):
+                self.input_file = file_path
+                self.input_label.setText(f"Selected compiled song: {file_path}")
             elif os.path.isdir(file_path):
                 self.output_dir = file_path
                 self.output_label.setText(f"Output Directory: {file_path}")
@@ -628,7 +1013,8 @@ class MP3ToMIDIApp(QMainWindow):
         self.output_label.setStyleSheet(self.get_default_stylesheet())
 
     def select_input_file(self):
-        self.input_file, _ = QFileDialog.getOpenFileName(self, "Select MP3 File", "", "MP3 Files (*.mp3)")
+        self.input_file, _ = QFileDialog.getOpenFileName(self, "Select MP3 File", "",
+                                                         f"MP3 Files (*.mp3);;Compiled Songs (*{PLAN_EXTENSION})")
         if self.input_file:
             self.input_label.setText(f"Selected MP3: {self.input_file}")
 
@@ -638,8 +1024,8 @@ class MP3ToMIDIApp(QMainWindow):
             self.output_label.setText(f"Output Directory: {self.output_dir}")
 
     def start_conversion(self):
-        if not self.input_file or not self.output_dir:
-            print("Please select both MP3 file and output directory.")
+        if not self.input_file:
+            print("Please select an MP3 file.")
             return
 
         # Hide other UI elements
@@ -648,19 +1034,58 @@ class MP3ToMIDIApp(QMainWindow):
         self.output_label.hide()
         self.select_input_btn.hide()
         self.select_output_btn.hide()
+        self.streaming_checkbox.hide()
         self.process_button.hide()
 
         self.progress_bar.setValue(0)
         self.progress_bar.show()
 
-        self.worker = WorkerThread(self.input_file, self.output_dir)
+        self.send_refitted_button.hide()
+
+        self.worker = WorkerThread(self.input_file, self.output_dir, self.streaming_checkbox.isChecked(),
+                                   fit_params=self.fit_params)
         self.worker.update_message.connect(self.show_message)
         self.worker.progress.connect(self.update_progress)
+        self.worker.timings.connect(self.show_timings)
+        self.worker.fitted.connect(self.show_fitted)
         self.worker.start()
 
+    def show_fitted(self, refitter):
+        self.refitter = refitter
+        self.refitter_input = self.worker.input_file
+        self.update_preview()
+
+    def update_preview(self):
+        """Fits the last converted song with the values of the form. Only the stages whose values changed run."""
+        min_note = self.min_note_edit.text().strip()
+        max_note = self.max_note_edit.text().strip()
+        if not (valid_note_name(min_note) and valid_note_name(max_note)):
+            self.preview_label.setText("Enter note names such as C4 or F#3")
+            return
+        self.fit_params = {
+            'min_note': min_note,
+            'max_note': max_note,
+            'tempo_factor': self.tempo_factor_spin.value(),
+            'gap_duration': self.gap_duration_spin.value(),
+            'duration_extension': self.duration_extension_spin.value(),
+            'smooth_timing': self.smooth_timing_checkbox.isChecked(),
+        }
+        if self.refitter is None:
+            return
+        self.refitter.refit(**self.fit_params)
+        self.preview_label.setText(self.refitter.format_preview())
+
+    def send_refitted(self):
+        """
+        Plays the last song with the previewed values. Its transcription comes from the cache, also in streaming mode.
+        """
+        if self.refitter_input:
+            self.input_file = self.refitter_input
+            self.start_conversion()
+
     def process_again(self):
         self.input_label.setText("Drag & Drop MP3 File Here")
-        self.output_label.setText("Drag & Drop Output Directory Here")
+        self.output_label.setText("Drag & Drop Output Directory Here (optional)")
         self.input_file = None
         self.output_dir = None
 
@@ -669,8 +1094,11 @@ class MP3ToMIDIApp(QMainWindow):
         self.output_label.show()
         self.select_input_btn.show()
         self.select_output_btn.show()
+        self.streaming_checkbox.show()
         self.process_button.show()
         self.progress_bar.hide()
+        self.timings_label.hide()
+        self.send_refitted_button.hide()
         self.process_again_button.hide()  # Hide process again button
 
     def update_progress(self, value):
@@ -678,118 +1106,24 @@ class MP3ToMIDIApp(QMainWindow):
         if value == 100:
             # Show all elements again after processing is done
             self.process_again_button.show()  # Show process again button
+            if self.refitter is not None:
+                self.send_refitted_button.show()
+
+    def show_timings(self, breakdown):
+        self.timings_label.setText(breakdown)
+        self.timings_label.show()
 
     def show_message(self, message):
         self.input_label.setText(message)
         self.input_label.repaint()  # Update the label immediately
 
 
-# MIDI processing functions
-def transpose_to_octave(score, min_note='C4', max_note='C5'):
-    lower_pitch = note.Pitch(min_note)
-    upper_pitch = note.Pitch(max_note)
-    original_notes = []
-
-    for element in score.flat.notesAndRests:
-        if isinstance(element, note.Note):
-            if element.pitch < lower_pitch:
-                # Transpose up to the nearest note within the octave range
-                transposition = 12  # One octave up
-                element.pitch = element.pitch.transpose(transposition)
-            elif element.pitch > upper_pitch:
-                # Transpose down to the nearest note within the octave range
-                transposition = -12  # One octave down
-                element.pitch = element.pitch.transpose(transposition)
-            else:
-                original_notes.append(element)  # Keep original notes
-        elif isinstance(element, chord.Chord):
-            new_pitches = []
-            for pitch in element.pitches:
-                if pitch < lower_pitch:
-                    pitch = pitch.transpose('P8')  # Transpose up
-                elif pitch > upper_pitch:
-                    pitch = pitch.transpose('-P8')  # Transpose down
-                else:
-                    original_notes.append(note.Note(pitch))  # Keep original notes
-                new_pitches.append(pitch)  # Always add the transposed pitch
-            element.pitches = new_pitches
-
-    return original_notes
-
-
-def remove_repeating_chords(score):
-    """Remove consecutive repeating chords."""
-    unique_chords = []
-    prev_chord = None
-
-    for element in score.flat.notesAndRests:
-        if isinstance(element, chord.Chord):
-            chord_pitches = sorted([p.midi for p in element.pitches])  # Use sorted MIDI values to compare
-            if chord_pitches != prev_chord:
-                unique_chords.append(element)
-                prev_chord = chord_pitches
-        else:
-            unique_chords.append(element)
-
-    return stream.Stream(unique_chords)
-
-
-def remove_sharps(score):
-    """Remove all sharp notes from the score."""
-    notes_to_remove = []
-
-    print("Identifying sharp notes to remove...")
-    for element in score.flat.notesAndRests:
-        if isinstance(element, note.Note):
-            if '#' in element.nameWithOctave:
-                notes_to_remove.append(element)
-                print(f"Found sharp note: {element.nameWithOctave}")
-        elif isinstance(element, chord.Chord):
-            # Remove pitches from chord that are sharps
-            new_pitches = [pitch for pitch in element.pitches if '#' not in pitch.nameWithOctave]
-            if len(new_pitches) != len(element.pitches):
-                chord_pitches = ', '.join(p.nameWithOctave for p in element.pitches)
-                print(f"Chord {chord_pitches} had sharps and is being modified.")
-            element.pitches = new_pitches
-
-            # If no pitches remain in the chord, mark it for removal
-            if not element.pitches:
-                notes_to_remove.append(element)
-                print(f"Chord {chord_pitches} has no remaining pitches and will be removed.")
-
-    # Remove sharp notes from the score
-    for note_to_remove in notes_to_remove:
-        if isinstance(note_to_remove, note.Note):
-            print(f"Removing note: {note_to_remove.nameWithOctave}")
-        else:
-            print(f"Removing chord with pitches: {', '.join(p.nameWithOctave for p in note_to_remove.pitches)}")
-
-        if note_to_remove in score.flat.notesAndRests:
-            score.remove(note_to_remove)
-        else:
-            print(f"Note or chord not found in score.")
-
-
-def shift_overlapping_notes(score):
-    """Shift overlapping notes instead of cutting them off."""
-    for i in range(len(score.flat.notesAndRests) - 1):
-        current_note = score.flat.notesAndRests[i]
-        next_note = score.flat.notesAndRests[i + 1]
-
-        if isinstance(current_note, (note.Note, chord.Chord)) and isinstance(next_note, (note.Note, chord.Chord)):
-            # Calculate the end time of the current note
-            current_end_time = current_note.offset + current_note.quarterLength
-
-            # Check if the next note starts before the current note ends
-            if next_note.offset < current_end_time:
-                # Move the next note's start time to the current note's end time
-                next_note.offset = current_end_time
-
-    return score
-
-
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     ex = MP3ToMIDIApp()
     ex.show()
+    # Loading the model and the notation stack once the event loop has drawn the window
+    QTimer.singleShot(0, preload_in_background)
+    # Opening the port now, so the first song does not wait for it
+    QTimer.singleShot(0, connect_in_background)
     sys.exit(app.exec_())
@@ -0,0 +1,179 @@
+"""
+Fitting a song again with other parameters, without converting or parsing it again.
+
+    refitter = Refitter(note_table.from_note_events(note_events))  # or Refitter.for_midi_file('song.mid')
+    fitted = refitter.refit(min_note='D4', max_note='D5')
+    print(refitter.preview())
+
+Parsed MIDI files are kept in memory per path and only parsed again when the file's modification time changes.
+Fitting is split into stages, and a stage only runs again when one of its parameters or an earlier stage changed,
+so trying another tempo factor does not transpose the song again.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import note_table
+from tracing import span
+
+# The parameters of fit_midi_to_octave_range. Without smooth_timing the song is fitted like midi_processing.py,
+# which keeps the timing. With it, sharps are moved up and the timing parameters are applied as in midi_testing.py.
+FIT_DEFAULTS = {
+    'min_note': 'C4',
+    'max_note': 'C5',
+    'gap_duration': 0.2,
+    'tempo_factor': 2.5,
+    'duration_extension': 0.5,
+    'smooth_timing': False,
+}
+MAX_PARSED_FILES = 8  # MIDI files kept parsed in memory
+PREVIEW_TEMPO = 500000  # Microseconds per quarter note, the tempo note_table.to_midi_file writes
+
+Preview = namedtuple('Preview', ['notes', 'lowest', 'highest', 'duration_s'])
+
+
+class ParsedMidiCache:
+    """Note tables of parsed MIDI files, dropped when the file changes on disk. The tables are read-only."""
+
+    def __init__(self, max_files=MAX_PARSED_FILES):
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()  # path -> ((mtime, size), table), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, midi_file):
+        path = os.path.abspath(midi_file)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._tables.get(path)
+            if entry is not None and entry[0] == version:
+                self._tables.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        from music21 import converter
+
+        with span('music21 parse'):
+            table = note_table.from_score(converter.parse(path))
+        table.flags.writeable = False
+        with self._lock:
+            self._tables[path] = (version, table)
+            self._tables.move_to_end(path)
+            while len(self._tables) > self.max_files:
+                self._tables.popitem(last=False)
+        return table
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+
+_default_cache = None
+
+
+def get_parsed_cache():
+    """Returns the process-wide cache of parsed MIDI files."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ParsedMidiCache()
+    return _default_cache
+
+
+def fit_range(table, min_note, max_note, smooth_timing):
+    if smooth_timing:
+        # midi_testing.py moves sharps up instead of removing them
+        return note_table.move_sharps_up(note_table.transpose_to_octave(table, min_note, max_note))
+    return note_table.fit_to_octave_range(table, min_note, max_note)
+
+
+def fit_timing(table, tempo_factor, duration_extension, gap_duration, smooth_timing):
+    if smooth_timing:
+        return note_table.smooth_notes_and_add_gaps(table, tempo_factor, duration_extension, gap_duration)
+    return table
+
+
+# (name, function, parameters), each stage gets the result of the previous one
+STAGES = (
+    ('range', fit_range, ('min_note', 'max_note', 'smooth_timing')),
+    ('timing', fit_timing, ('tempo_factor', 'duration_extension', 'gap_duration', 'smooth_timing')),
+)
+
+
+def preview_table(table, tempo=PREVIEW_TEMPO):
+    """Note count, lowest and highest note name and length in seconds of a fitted table."""
+    sounding = table[table['pitch'] != note_table.REST]
+    if len(sounding) == 0:
+        return Preview(0, None, None, 0.0)
+    end = float((sounding['onset'] + sounding['duration']).max())
+    return Preview(len(sounding), midi_to_note_name(int(sounding['pitch'].min())),
+                   midi_to_note_name(int(sounding['pitch'].max())), end * tempo / 1e6)
+
+
+def midi_to_note_name(pitch):
+    return ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B'][pitch % 12] + str(pitch // 12 - 1)
+
+
+def valid_note_name(name):
+    """Returns whether a note name such as 'C4' or 'F#3' can be used as a fitting limit."""
+    try:
+        pitch = note_table.note_name_to_midi(name.strip())
+    except (KeyError, IndexError, ValueError):
+        return False
+    return 0 <= pitch <= 127
+
+
+class Refitter:
+    """Fits one song with changing parameters, running only the stages whose parameters changed."""
+
+    def __init__(self, table):
+        self.table = table
+        self.params = None
+        self.stage_runs = dict.fromkeys((name for name, _, _ in STAGES), 0)
+        self.last_refit_ms = 0.0
+        self._results = [None] * len(STAGES)  # (parameter values, result) of every stage
+
+    @classmethod
+    def for_midi_file(cls, midi_file, cache=None):
+        return cls((cache or get_parsed_cache()).get(midi_file))
+
+    def refit(self, **params):
+        """
+        Returns the fitted note table for the parameters, see FIT_DEFAULTS. Unchanged stages are reused.
+        Note names have to be checked with valid_note_name first.
+        """
+        start_time = time.perf_counter()
+        self.params = dict(FIT_DEFAULTS, **params)
+        table = self.table
+        rerun = False
+        for index, (name, function, names) in enumerate(STAGES):
+            values = tuple(self.params[key] for key in names)
+            cached = self._results[index]
+            if rerun or cached is None or cached[0] != values:
+                with span(f'refit {name}'):
+                    cached = (values, function(table, *values))
+                self._results[index] = cached
+                self.stage_runs[name] += 1
+                rerun = True  # Every later stage works on the new result
+            table = cached[1]
+        self.last_refit_ms = (time.perf_counter() - start_time) * 1000
+        return table
+
+    def fitted(self):
+        """Result of the last refit."""
+        return self._results[-1][1] if self._results[-1] is not None else self.refit()
+
+    def preview(self):
+        return preview_table(self.fitted())
+
+    def format_preview(self):
+        preview = self.preview()
+        if not preview.notes:
+            return "No notes left with these settings"
+        minutes, seconds = divmod(int(round(preview.duration_s)), 60)
+        return (f"{preview.notes} notes from {preview.lowest} to {preview.highest}, {minutes}:{seconds:02d} long "
+                f"(fitted in {self.last_refit_ms:.0f} ms)")
+
@@ -0,0 +1,236 @@
+import atexit
+import os
+import threading
+import time
+
+import serial
+
+from flow_control import SlidingWindowSender
+from link_telemetry import LinkTelemetry
+from serial_io import SerialIOEngine
+from serial_protocol import FrameDecoder, FrameEncoder
+
+# ARDUINO_PORT points every sender at another port, e.g. the emulator from arduino_emulator.py
+DEFAULT_PORT = os.environ.get('ARDUINO_PORT', 'COM13')
+DEFAULT_BAUD_RATE = 9600
+READ_TIMEOUT = 1
+BOOT_DELAY = 2  # Seconds an Arduino needs after a reset before it reads serial data
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 0.5  # Doubled after every failed attempt
+
+
+class ArduinoConnection:
+    """
+    Long-lived serial connection shared by every job and sender.
+    The port is opened once with DTR held low, so opening it does not reset the board, and it is reopened
+    automatically when a write or read fails (e.g. after the USB cable was unplugged and plugged back in).
+    Offers the subset of serial.Serial the senders use: write, read, read_until, in_waiting, is_open.
+
+    The framing state lives here as well, so sequence numbers keep counting across songs and every sender
+    strategy reads replies through the same decoder.
+
+    While the I/O engine (self.io) runs, a reader thread owns the port: raw reads are served from its buffer and
+    framed replies only come from self.io, never from read().
+    """
+
+    def __init__(self, port, baud_rate=DEFAULT_BAUD_RATE, timeout=READ_TIMEOUT):
+        self.port = port
+        self.baud_rate = baud_rate
+        self.timeout = timeout
+        self.serial = None
+        self.connects = 0
+        self.reconnects = 0
+        # Held for opening and for the whole close-and-reopen of a reconnect. Reentrant, since reconnect opens.
+        self._connect_lock = threading.RLock()
+        # Held by a job for the whole song, so two songs never interleave on the wire
+        self.session_lock = threading.RLock()
+        self.frame_encoder = FrameEncoder()
+        self.frame_decoder = FrameDecoder()
+        self.telemetry = LinkTelemetry()
+        self.io = SerialIOEngine(self.read_port, self.frame_decoder)
+        self.window_sender = SlidingWindowSender(self, decoder=self.frame_decoder, telemetry=self.telemetry,
+                                                 io=self.io)
+
+    def open(self):
+        """Opens the port if it is not open yet. Only the very first open waits for the board to boot."""
+        with self._connect_lock:
+            if self.serial is not None and self.serial.is_open:
+                return self
+            start_time = time.perf_counter()
+
+            connection = serial.Serial()
+            connection.port = self.port
+            connection.baudrate = self.baud_rate
+            connection.timeout = self.timeout
+            # Keeping DTR low while opening. A rising DTR is what resets an Uno or Nano.
+            connection.dtr = False
+            connection.rts = False
+            connection.open()
+
+            if self.connects == 0:
+                # Some boards and drivers pulse DTR regardless, give the bootloader time once per process
+                time.sleep(BOOT_DELAY)
+            connection.reset_input_buffer()
+            # Half a frame from before a reconnect would otherwise be glued to the first new reply
+            self.frame_decoder.buffer.clear()
+
+            self.serial = connection
+            self.connects += 1
+            print(f"Connected to Arduino on {self.port} in {time.perf_counter() - start_time:.2f}s")
+            return self
+
+    def reconnect(self, failed=None):
+        """
+        Closes the port and opens it again, retrying with a growing delay.
+        :param failed: The serial.Serial that raised the error. The reader and the writer thread can both fail on
+            the same port, and the one that gets here second finds the port already replaced and keeps it.
+        """
+        with self._connect_lock:
+            if failed is not None and self.serial is not failed and self.is_open:
+                return self
+            self.reconnects += 1
+            self._close_port()
+            delay = RECONNECT_DELAY
+            for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+                try:
+                    return self.open()
+                except serial.SerialException as e:
+                    print(f"Reconnecting to {self.port} failed ({attempt}/{RECONNECT_ATTEMPTS}): {e}")
+                    time.sleep(delay)
+                    delay *= 2
+            raise serial.SerialException(f"Could not reconnect to {self.port}")
+
+    def _connection(self):
+        """The open serial.Serial, opened first if needed. Waits while another thread reconnects."""
+        with self._connect_lock:
+            if self.serial is None or not self.serial.is_open:
+                self.open()
+            return self.serial
+
+    def _call(self, method, *args):
+        connection = self._connection()
+        try:
+            return getattr(connection, method)(*args)
+        except (serial.SerialException, OSError) as e:
+            print(f"Serial error on {self.port}: {e}, reconnecting...")
+            self.reconnect(connection)
+            return getattr(self._connection(), method)(*args)
+
+    def write(self, data):
+        start_ns = time.perf_counter_ns()
+        written = self._call('write', data)
+        self.telemetry.record_write(len(data), time.perf_counter_ns() - start_ns)
+        return written
+
+    def read_port(self):
+        """Reads whatever has arrived straight from the port, waiting up to the read timeout for the first byte."""
+        data = self._call('read', self._port_in_waiting() or 1)
+        self.telemetry.record_read(len(data))
+        return data
+
+    def read(self, size=1):
+        if self.io.running:
+            return self.io.read(size, self.timeout)
+        data = self._call('read', size)
+        self.telemetry.record_read(len(data))
+        return data
+
+    def read_until(self, expected=b'\n', size=None):
+        if self.io.running:
+            return self.io.read_until(expected, self.timeout)
+        data = self._call('read_until', expected, size)
+        self.telemetry.record_read(len(data))
+        return data
+
+    def wait_for_ack(self, timeout):
+        """Waits for a raw 0x06 ACK. Event-driven while the I/O engine runs, otherwise by reading byte by byte."""
+        if self.io.running:
+            return self.io.wait_for_ack(timeout)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.read() == b'\x06':
+                return True
+        return False
+
+    def reset_input_buffer(self):
+        """Drops replies nobody waited for, e.g. ACKs left over from an earlier song."""
+        self.io.clear()
+        return self._call('reset_input_buffer')
+
+    @property
+    def in_waiting(self):
+        if self.io.running:
+            return self.io.in_waiting
+        return self._port_in_waiting()
+
+    def _port_in_waiting(self):
+        connection = self._connection()
+        try:
+            return connection.in_waiting
+        except (serial.SerialException, OSError):
+            self.reconnect(connection)
+            return self._connection().in_waiting
+
+    @property
+    def is_open(self):
+        return self.serial is not None and self.serial.is_open
+
+    def _close_port(self):
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.serial = None
+
+    def close(self):
+        """Closes the port for good, at exit. Jobs leave the connection open for the next song."""
+        self.io.stop()
+        with self._connect_lock:
+            if self.is_open:
+                print(f"Closing Arduino connection on {self.port}.")
+            self._close_port()
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(port=None, baud_rate=DEFAULT_BAUD_RATE, connect=True):
+    """
+    Returns the process-wide connection for a port, opening it on first use.
+    :param port: Defaults to DEFAULT_PORT at the time of the call.
+    :param connect: Open the port right away. Pass False to create it without touching the hardware.
+    """
+    port = port or DEFAULT_PORT
+    with _connections_lock:
+        connection = _connections.get(port)
+        if connection is None:
+            connection = ArduinoConnection(port, baud_rate)
+            _connections[port] = connection
+    if connect:
+        connection.open()
+    return connection
+
+
+def connect_in_background(port=None, baud_rate=DEFAULT_BAUD_RATE):
+    """Opens the connection on a daemon thread, so the one-time boot delay is over before the first song."""
+    def connect():
+        try:
+            get_connection(port, baud_rate)
+        except serial.SerialException as e:
+            print(f"Arduino not connected yet, will retry when a song starts: {e}")
+
+    thread = threading.Thread(target=connect, name='serial-connect', daemon=True)
+    thread.start()
+    return thread
+
+
+def close_all():
+    with _connections_lock:
+        connections = list(_connections.values())
+    for connection in connections:
+        connection.close()
+
+
+atexit.register(close_all)
@@ -0,0 +1,203 @@
+import threading
+import time
+from collections import deque
+
+import serial
+
+from serial_protocol import MSG_ACK, MSG_NAK, UNKNOWN_SEQ, FrameDecoder
+
+ACK = b'\x06'
+READ_ERROR_PAUSE = 0.5  # Seconds the reader waits after a failed read before trying again
+READ_ERROR_MAX_PAUSE = 8.0  # The pause doubles with every failed read in a row, up to this
+
+
+class SerialIOEngine:
+    """
+    Reads the serial port on its own thread, so the sending thread only ever writes and waits on a condition for
+    the replies it needs instead of polling the port.
+    Framed replies are parsed into a queue of frames as they arrive. In raw mode the received bytes are buffered
+    and every wait_for_ack consumes one 0x06 from them.
+    """
+
+    def __init__(self, read, decoder=None):
+        """
+        :param read: Blocking read of whatever bytes are available, returning b'' after the port's read timeout.
+        :param decoder: FrameDecoder for framed replies.
+        """
+        self._read = read
+        self.decoder = decoder or FrameDecoder()
+        self.framed = True
+        self.stats = {'bytes': 0, 'frames': 0, 'read_errors': 0}
+        self._condition = threading.Condition()
+        self._replies = deque()
+        self._bytes = bytearray()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, framed=True):
+        """Starts the reader thread. Replies that arrived before are dropped."""
+        if self.running:
+            if framed == self.framed:
+                return self
+            self.stop()
+        self.framed = framed
+        self.clear()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='serial-reader', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=2):
+        """Stops the reader, which takes until its current read returns (at most the port's read timeout)."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._condition:
+            self._condition.notify_all()
+
+    def clear(self):
+        with self._condition:
+            self._replies.clear()
+            self._bytes.clear()
+            self.decoder.buffer.clear()
+
+    def _run(self):
+        # With no board attached every read fails at once, so the reader backs off and only prints an error
+        # when it differs from the previous one
+        failures = 0
+        last_error = None
+        while not self._stopping.is_set():
+            try:
+                data = self._read()
+                received_ns = time.monotonic_ns()
+            except (serial.SerialException, OSError) as e:
+                self.stats['read_errors'] += 1
+                failures += 1
+                if str(e) != last_error:
+                    print(f"Serial reader error: {e}")
+                    last_error = str(e)
+                self._stopping.wait(min(READ_ERROR_PAUSE * 2 ** (failures - 1), READ_ERROR_MAX_PAUSE))
+                continue
+            if failures:
+                print(f"Serial reader recovered after {failures} failed reads")
+                failures = 0
+                last_error = None
+            if not data:
+                continue
+            with self._condition:
+                self.stats['bytes'] += len(data)
+                if self.framed:
+                    frames = self.decoder.feed(data, received_ns)
+                    self.stats['frames'] += len(frames)
+                    self._replies.extend(frames)
+                else:
+                    self._bytes += data
+                self._condition.notify_all()
+
+    # Raw protocol
+
+    @property
+    def in_waiting(self):
+        return len(self._bytes)
+
+    def read(self, size=1, timeout=None):
+        """Returns up to size received bytes, waiting up to timeout seconds for the first one."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._bytes, timeout)
+            data = bytes(self._bytes[:size])
+            del self._bytes[:size]
+            return data
+
+    def read_until(self, expected=b'\n', timeout=None):
+        """Returns the received bytes up to and including expected, or whatever arrived before the timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while expected not in self._bytes:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            end = self._bytes.find(expected)
+            end = len(self._bytes) if end < 0 else end + len(expected)
+            data = bytes(self._bytes[:end])
+            del self._bytes[:end]
+            return data
+
+    def wait_for_ack(self, timeout):
+        """
+        Waits for the next 0x06 byte and consumes only that byte. The other received bytes stay buffered for read()
+        and read_until(), and the ACKs of later notes stay buffered for the next waits.
+        :return: True if an ACK arrived within the timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                position = self._bytes.find(ACK)
+                if position >= 0:
+                    del self._bytes[position]
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    return False
+
+    # Framed protocol
+
+    def next_replies(self, timeout=0):
+        """Returns all frames received so far, first waiting up to timeout seconds if there are none."""
+        with self._condition:
+            if timeout:
+                self._condition.wait_for(lambda: self._replies, timeout)
+            replies = list(self._replies)
+            self._replies.clear()
+            return replies
+
+    def wait_for_reply(self, seq, timeout):
+        """
+        Waits until the Arduino answers the frame with the given sequence number, like serial_protocol.wait_for_reply.
+        Replies to other frames are dropped, other frames (e.g. STATUS) stay queued.
+        :return: MSG_ACK, MSG_NAK or None on timeout.
+        """
+        def answers(reply):
+            replied_seq = reply.payload[0] if reply.payload else reply.seq
+            return (reply.msg_type == MSG_ACK and replied_seq == seq or
+                    reply.msg_type == MSG_NAK and replied_seq in (seq, UNKNOWN_SEQ))
+
+        reply = self._take_frame(answers, timeout, drop=lambda reply: reply.msg_type in (MSG_ACK, MSG_NAK))
+        return reply.msg_type if reply is not None else None
+
+    def wait_for_message(self, msg_type, timeout):
+        """
+        Waits for the next frame of the given type, e.g. a STATUS reply. Returns it, or None on timeout.
+        Frames of other types stay queued for the next wait.
+        """
+        return self._take_frame(lambda reply: reply.msg_type == msg_type, timeout)
+
+    def discard(self, msg_type):
+        """Drops the queued frames of a type, e.g. late STATUS replies to an earlier request."""
+        with self._condition:
+            self._replies = deque(reply for reply in self._replies if reply.msg_type != msg_type)
+
+    def _take_frame(self, matches, timeout, drop=None):
+        """Removes and returns the first queued frame that matches, waiting up to timeout seconds for one."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                kept = deque()
+                found = None
+                for reply in self._replies:
+                    if found is None and matches(reply):
+                        found = reply
+                    elif found is not None or drop is None or not drop(reply):
+                        kept.append(reply)
+                self._replies = kept
+                if found is not None:
+                    return found
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
@@ -0,0 +1,365 @@
+"""
+Framed binary protocol between the player and the Arduino.
+
+Every frame looks like this (multi-byte fields are big-endian, like the old duration bytes):
+
+    0xA5 0x5A | version | type | seq | length | payload (length bytes) | CRC16 (2 bytes)
+
+The CRC is CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF) over version, type, seq, length and payload.
+A receiver looks for the two sync bytes, and a frame with a bad CRC is dropped and reported with a NAK,
+so a lost byte costs one frame instead of shifting every following pitch.
+
+Frame types:
+    CHORD  notes that start together: length / 3 entries of pitch (1 byte) and duration in ms (2 bytes)
+    BATCH  notes played one after another: length / 5 entries of delay in ms since the previous note (2 bytes),
+           pitch (1 byte) and duration in ms (2 bytes)
+    STOP   releases all notes, no payload
+    EVENTS appends notes to the Arduino's ring buffer: index of the first event (2 bytes) and its time in ms since
+           START (4 bytes), then per event the delta in ms from the previous event (variable length), pitch (1 byte)
+           and duration in ms (variable length). The Arduino only accepts the frame if the index is the next one
+           it expects, so the buffer never has gaps. A resent frame whose events were already stored is
+           acknowledged again without storing them twice
+    START  starts the Arduino's playback clock at 0, no payload
+    STATUS sent without payload to ask for the buffer state, the Arduino answers with a STATUS frame of
+           playhead in ms (4 bytes), buffered events (2 bytes) and buffer capacity in events (2 bytes)
+    SYNC   sets the playback clock to the given time in ms since START (4 bytes), so boards that play parts of the
+           same song stay in step
+    ACK    sent by the Arduino, the payload is the seq of the frame it accepted
+    NAK    sent by the Arduino, the payload is the seq of the frame it dropped (or 0xFF if unknown)
+
+Variable length numbers use 7 bits per byte, most significant group first, with the top bit set on every byte but
+the last (the same encoding as MIDI delta times).
+"""
+import binascii
+import time
+from collections import namedtuple
+
+SYNC = b'\xA5\x5A'
+PROTOCOL_VERSION = 1
+
+MSG_CHORD = 0x01
+MSG_BATCH = 0x02
+MSG_STOP = 0x03
+MSG_EVENTS = 0x04
+MSG_START = 0x07
+MSG_STATUS = 0x08
+MSG_SYNC = 0x09
+MSG_ACK = 0x06
+MSG_NAK = 0x15
+
+HEADER_SIZE = len(SYNC) + 4  # version, type, seq, length
+CRC_SIZE = 2
+FRAME_OVERHEAD = HEADER_SIZE + CRC_SIZE
+MAX_PAYLOAD = 255
+CHORD_NOTE_SIZE = 3
+BATCH_NOTE_SIZE = 5
+MAX_CHORD_NOTES = MAX_PAYLOAD // CHORD_NOTE_SIZE
+MAX_BATCH_NOTES = MAX_PAYLOAD // BATCH_NOTE_SIZE
+MAX_MS = 0xFFFF  # Durations and delays have to fit into 2 bytes
+UNKNOWN_SEQ = 0xFF
+EVENTS_HEADER_SIZE = 6
+
+Status = namedtuple('Status', ['playhead_ms', 'buffered', 'capacity'])
+
+# received_ns: time.monotonic_ns() when the bytes that completed the frame were read, if the reader stamped it
+Frame = namedtuple('Frame', ['version', 'msg_type', 'seq', 'payload', 'received_ns'], defaults=(None,))
+
+
+def crc16(data):
+    """CRC-16/CCITT-FALSE of the given bytes."""
+    return binascii.crc_hqx(bytes(data), 0xFFFF)
+
+
+def encode_frame(msg_type, seq, payload=b''):
+    """Wraps a payload into a frame with sync bytes, header and CRC."""
+    payload = bytes(payload)
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Payload of {len(payload)} bytes does not fit into one frame (max {MAX_PAYLOAD})")
+    body = bytes([PROTOCOL_VERSION, msg_type, seq & 0xFF, len(payload)]) + payload
+    return SYNC + body + crc16(body).to_bytes(2, 'big')
+
+
+def _ms(value):
+    return min(max(int(value), 0), MAX_MS)
+
+
+def _pitch(pitch):
+    if not 0 <= pitch <= 127:
+        raise ValueError(f"Pitch {pitch} is outside the MIDI range")
+    return int(pitch)
+
+
+def encode_chord(seq, notes):
+    """
+    Encodes notes that start together into one CHORD frame.
+    :param notes: (pitch, duration_ms) pairs. Durations above 65535 ms are clamped.
+    """
+    if len(notes) > MAX_CHORD_NOTES:
+        raise ValueError(f"A chord frame holds at most {MAX_CHORD_NOTES} notes")
+    payload = bytearray()
+    for pitch, duration in notes:
+        payload.append(_pitch(pitch))
+        payload += _ms(duration).to_bytes(2, 'big')
+    return encode_frame(MSG_CHORD, seq, payload)
+
+
+def encode_batch(seq, notes):
+    """
+    Encodes a run of notes into one BATCH frame, so the Arduino can play them without waiting for the host.
+    :param notes: (delay_ms, pitch, duration_ms) tuples, the delay counted from the previous note of the batch.
+    """
+    if len(notes) > MAX_BATCH_NOTES:
+        raise ValueError(f"A batch frame holds at most {MAX_BATCH_NOTES} notes")
+    payload = bytearray()
+    for delay, pitch, duration in notes:
+        payload += _ms(delay).to_bytes(2, 'big')
+        payload.append(_pitch(pitch))
+        payload += _ms(duration).to_bytes(2, 'big')
+    return encode_frame(MSG_BATCH, seq, payload)
+
+
+def encode_stop(seq):
+    return encode_frame(MSG_STOP, seq)
+
+
+def encode_ack(seq):
+    return encode_frame(MSG_ACK, seq, bytes([seq & 0xFF]))
+
+
+def encode_nak(seq=UNKNOWN_SEQ):
+    return encode_frame(MSG_NAK, seq, bytes([seq & 0xFF]))
+
+
+def encode_vlq(value):
+    """Encodes a non-negative integer as a MIDI style variable length quantity."""
+    value = int(value)
+    if value < 0:
+        raise ValueError("Variable length numbers cannot be negative")
+    groups = [value & 0x7F]
+    value >>= 7
+    while value:
+        groups.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(groups))
+
+
+def decode_vlq(data, position):
+    """Returns (value, position after the number) of the variable length number starting at position."""
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, position
+
+
+def _events_header(first_index, start_ms):
+    return (first_index & 0xFFFF).to_bytes(2, 'big') + int(start_ms).to_bytes(4, 'big')
+
+
+def _event_entry(delta_ms, pitch, duration):
+    return encode_vlq(delta_ms) + bytes([_pitch(pitch)]) + encode_vlq(_ms(duration))
+
+
+def pack_events(first_index, events, max_payload=MAX_PAYLOAD):
+    """
+    Builds an EVENTS payload from as many events from the front of the list as fit into one frame.
+    :param first_index: Stream index of the first event, wraps at 2 bytes.
+    :param events: (time_ms, pitch, duration_ms) tuples in time order, times counted from the start of playback.
+    :return: (payload, number of events used)
+    """
+    start_ms = int(events[0][0]) if events else 0
+    payload = bytearray(_events_header(first_index, start_ms))
+    previous_ms = start_ms
+    count = 0
+    for time_ms, pitch, duration in events:
+        entry = _event_entry(int(time_ms) - previous_ms, pitch, int(duration))
+        if len(payload) + len(entry) > max_payload:
+            break
+        payload += entry
+        previous_ms = int(time_ms)
+        count += 1
+    return bytes(payload), count
+
+
+def decode_events(payload):
+    """Returns (first_index, [(time_ms, pitch, duration_ms), ...]) of an EVENTS payload."""
+    first_index = int.from_bytes(payload[0:2], 'big')
+    time_ms = int.from_bytes(payload[2:6], 'big')
+    events = []
+    position = EVENTS_HEADER_SIZE
+    while position < len(payload):
+        delta, position = decode_vlq(payload, position)
+        pitch = payload[position]
+        duration, position = decode_vlq(payload, position + 1)
+        time_ms += delta
+        events.append((time_ms, pitch, duration))
+    return first_index, events
+
+
+def encode_status(seq, playhead_ms, buffered, capacity):
+    payload = int(playhead_ms).to_bytes(4, 'big') + int(buffered).to_bytes(2, 'big') + int(capacity).to_bytes(2, 'big')
+    return encode_frame(MSG_STATUS, seq, payload)
+
+
+def decode_status(payload):
+    return Status(int.from_bytes(payload[0:4], 'big'), int.from_bytes(payload[4:6], 'big'),
+                  int.from_bytes(payload[6:8], 'big'))
+
+
+def encode_sync(seq, playhead_ms):
+    return encode_frame(MSG_SYNC, seq, int(playhead_ms).to_bytes(4, 'big'))
+
+
+def decode_sync(payload):
+    return int.from_bytes(payload[0:4], 'big')
+
+
+def decode_chord(payload):
+    """Returns the (pitch, duration_ms) pairs of a CHORD payload."""
+    return [(payload[i], int.from_bytes(payload[i + 1:i + 3], 'big'))
+            for i in range(0, len(payload) - CHORD_NOTE_SIZE + 1, CHORD_NOTE_SIZE)]
+
+
+def decode_batch(payload):
+    """Returns the (delay_ms, pitch, duration_ms) tuples of a BATCH payload."""
+    return [(int.from_bytes(payload[i:i + 2], 'big'), payload[i + 2], int.from_bytes(payload[i + 3:i + 5], 'big'))
+            for i in range(0, len(payload) - BATCH_NOTE_SIZE + 1, BATCH_NOTE_SIZE)]
+
+
+def chunk_notes(notes, size):
+    """Splits a list of notes into pieces that fit into single frames."""
+    return [notes[i:i + size] for i in range(0, len(notes), size)]
+
+
+class FrameDecoder:
+    """
+    Incremental frame parser. Bytes can be fed in any chunking; complete frames are returned as they arrive.
+    Garbage before a sync pattern is skipped and a frame with a bad CRC or an unknown version is dropped,
+    after which the decoder searches for the next sync pattern inside the dropped bytes.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.crc_errors = 0
+        self.skipped_bytes = 0
+
+    def feed(self, data, received_ns=None):
+        """
+        Adds received bytes and returns the list of frames completed by them.
+        :param received_ns: time.monotonic_ns() of the read, stored in the frames so replies can be timed from
+            their arrival rather than from when they were handled.
+        """
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                # Keeping a trailing first sync byte, its partner may arrive with the next read
+                keep = 1 if self.buffer[-1:] == SYNC[:1] else 0
+                self.skipped_bytes += len(self.buffer) - keep
+                del self.buffer[:len(self.buffer) - keep]
+                return frames
+            if start:
+                self.skipped_bytes += start
+                del self.buffer[:start]
+
+            if len(self.buffer) < HEADER_SIZE:
+                return frames
+            length = self.buffer[HEADER_SIZE - 1]
+            frame_size = HEADER_SIZE + length + CRC_SIZE
+            if len(self.buffer) < frame_size:
+                return frames
+
+            body = bytes(self.buffer[len(SYNC):HEADER_SIZE + length])
+            received_crc = int.from_bytes(self.buffer[HEADER_SIZE + length:frame_size], 'big')
+            if received_crc != crc16(body) or body[0] != PROTOCOL_VERSION:
+                self.crc_errors += 1
+                # Only the sync bytes are dropped, a real frame may start inside the corrupted one
+                self.skipped_bytes += len(SYNC)
+                del self.buffer[:len(SYNC)]
+                continue
+
+            frames.append(Frame(body[0], body[1], body[2], body[4:], received_ns))
+            del self.buffer[:frame_size]
+
+
+class FrameEncoder:
+    """Numbers outgoing frames with a wrapping sequence number (0xFF is reserved for 'unknown')."""
+
+    def __init__(self):
+        self.seq = 0
+
+    def next_seq(self):
+        seq = self.seq
+        self.seq = (self.seq + 1) % UNKNOWN_SEQ
+        return seq
+
+    def chord(self, notes):
+        seq = self.next_seq()
+        return seq, encode_chord(seq, notes)
+
+    def batch(self, notes):
+        seq = self.next_seq()
+        return seq, encode_batch(seq, notes)
+
+    def stop(self):
+        seq = self.next_seq()
+        return seq, encode_stop(seq)
+
+
+def wait_for_reply(port, seq, decoder, timeout=2):
+    """
+    Reads from the port until the Arduino answers the frame with the given sequence number.
+    :return: MSG_ACK, MSG_NAK or None on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        data = port.read(port.in_waiting or 1)
+        if not data:
+            continue
+        for reply in decoder.feed(data):
+            replied_seq = reply.payload[0] if reply.payload else reply.seq
+            if reply.msg_type == MSG_ACK and replied_seq == seq:
+                return MSG_ACK
+            if reply.msg_type == MSG_NAK and replied_seq in (seq, UNKNOWN_SEQ):
+                return MSG_NAK
+    return None
+
+
+def send_frame(port, frame, seq, decoder, retries=3, timeout=2, telemetry=None, io=None):
+    """
+    Writes a frame and waits for the Arduino to acknowledge its sequence number.
+    The frame is sent again after a NAK or a timeout.
+    :param port: An open serial.Serial (or anything with write, read and in_waiting).
+    :param decoder: The FrameDecoder of the port, so bytes of later frames are not lost between calls.
+    :param telemetry: LinkTelemetry that records round trips, NAKs, timeouts and retries, if given.
+    :param io: SerialIOEngine of the port. While it runs, the reply is awaited from its reader thread.
+    :return: True if the frame was acknowledged.
+    """
+    for attempt in range(retries):
+        if attempt and telemetry is not None:
+            telemetry.count('retries')
+        port.write(frame)
+        sent_ns = time.perf_counter_ns()
+        if io is not None and io.running:
+            reply = io.wait_for_reply(seq, timeout)
+        else:
+            reply = wait_for_reply(port, seq, decoder, timeout)
+        if reply == MSG_ACK:
+            if telemetry is not None:
+                telemetry.record_ack(time.perf_counter_ns() - sent_ns)
+            return True
+        if reply == MSG_NAK:
+            if telemetry is not None:
+                telemetry.count('naks')
+            print(f"Frame {seq} rejected by Arduino, resending... ({attempt + 1}/{retries})")
+        else:
+            if telemetry is not None:
+                telemetry.count('timeouts')
+            print(f"ACK timeout for frame {seq}, retrying... ({attempt + 1}/{retries})")
+    if telemetry is not None:
+        telemetry.count('failures')
+    print(f"Frame {seq} was not acknowledged after {retries} attempts")
+    return False
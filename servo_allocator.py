@@ -0,0 +1,197 @@
+"""
+Plans a fitted song for the servos that actually play it.
+
+Every key is pressed by a servo, and a servo needs time to travel down, cannot strike its key again right after
+releasing it, and only so many servos can be driven at once. A song that asks for more than that either loses notes
+on the board or falls behind. allocate() goes through the notes in time order and gives each one the earliest start
+the hardware allows:
+
+    1. A note whose key or servo is still busy first tries to cut the previous note short, down to
+       min_press_ms, so the new one can start on time.
+    2. Otherwise it is delayed until its key and a servo are free,
+    3. unless that is more than max_delay_ms late, then it is dropped and the notes it cut short keep their length.
+
+Busy servos are kept in a heap by release time, so the pass takes O(n log n) for n notes.
+"""
+import heapq
+from collections import namedtuple
+
+import numpy as np
+
+import note_table
+
+# servo_count: notes that can be held at the same time
+# travel_ms: time a servo needs to lift off a key before it can press another one
+# restrike_ms: time a key needs after its release before it can be pressed again, a dict gives it per pitch with
+#     the 'default' entry for the other keys
+# min_press_ms: shortest press that still sounds the key
+# max_delay_ms: notes that would start later than this are dropped instead
+ServoProfile = namedtuple('ServoProfile', ['servo_count', 'travel_ms', 'restrike_ms', 'min_press_ms', 'max_delay_ms'])
+
+# The player: one servo per white key from C4 to C5. The timings are estimates, not measured on the servos yet.
+DEFAULT_PROFILE = ServoProfile(servo_count=8, travel_ms=50, restrike_ms={'default': 100}, min_press_ms=100,
+                               max_delay_ms=250)
+
+
+def restrike_interval(profile, pitch):
+    if isinstance(profile.restrike_ms, dict):
+        return profile.restrike_ms.get(pitch, profile.restrike_ms.get('default', 0))
+    return profile.restrike_ms
+
+
+class Allocation:
+    """Result of allocate(): the planned notes and what had to change to make them playable."""
+
+    def __init__(self, onsets, durations, pitches, played, source_onsets):
+        self.onsets = onsets  # ms, of every input note, planned
+        self.durations = durations
+        self.pitches = pitches
+        self.played = played  # False for dropped notes
+        self.source_onsets = source_onsets  # ms, as given
+        self.shortened = 0
+
+    @property
+    def delays(self):
+        return np.where(self.played, self.onsets - self.source_onsets, 0)
+
+    def dropped_notes(self):
+        """(time_ms, pitch) of every dropped note."""
+        dropped = ~self.played
+        return list(zip(self.source_onsets[dropped].tolist(), self.pitches[dropped].tolist()))
+
+    def delayed_notes(self):
+        """(time_ms, pitch, delay_ms) of every delayed note."""
+        delays = self.delays
+        delayed = delays > 0
+        return list(zip(self.source_onsets[delayed].tolist(), self.pitches[delayed].tolist(),
+                        delays[delayed].tolist()))
+
+    def events(self):
+        """(time_ms, pitch, duration_ms) of the played notes, sorted by time."""
+        order = np.lexsort((self.pitches, self.onsets))
+        return [(int(round(self.onsets[i])), int(self.pitches[i]), int(round(self.durations[i])))
+                for i in order if self.played[i]]
+
+    def summary(self, listed=10):
+        """Counts, plus the first few dropped and delayed notes."""
+        delays = self.delays
+        delayed = self.delayed_notes()
+        played = int(self.played.sum())
+        lines = [f"Servo plan: {played} of {len(self.played)} notes played, {self.shortened} shortened, "
+                 f"{len(delayed)} delayed (max {delays.max() if len(delays) else 0:.0f} ms), "
+                 f"{len(self.played) - played} dropped"]
+        for time_ms, pitch in self.dropped_notes()[:listed]:
+            lines.append(f"  dropped {pitch} at {time_ms:.0f} ms")
+        for time_ms, pitch, delay in delayed[:listed]:
+            lines.append(f"  delayed {pitch} at {time_ms:.0f} ms by {delay:.0f} ms")
+        return '\n'.join(lines)
+
+
+def allocate(onsets, durations, pitches, profile=DEFAULT_PROFILE):
+    """
+    Plans notes given in milliseconds for the servos of the profile, see the module docstring.
+    :return: Allocation
+    """
+    source_onsets = np.asarray(onsets, dtype=np.float64)
+    pitches = np.asarray(pitches, dtype=np.int64)
+    onsets = source_onsets.copy()
+    durations = np.maximum(np.asarray(durations, dtype=np.float64), profile.min_press_ms)
+    played = np.ones(len(onsets), dtype=bool)
+    allocation = Allocation(onsets, durations, pitches, played, source_onsets)
+
+    busy = []  # (release_ms, note) of the servos holding a key; entries of notes cut short later are stale
+    holding = np.zeros(len(onsets), dtype=bool)  # Notes whose servo has not moved on yet
+    holding_count = 0
+    last_note = {}  # pitch -> last played note on that key
+
+    def release(note):
+        return onsets[note] + durations[note]
+
+    def pop_stale():
+        while busy and (busy[0][0] != release(busy[0][1]) or not holding[busy[0][1]]):
+            heapq.heappop(busy)
+
+    def cut_short(note, end_ms, cuts):
+        """Ends a note at end_ms if it is still long enough then. Returns whether it was cut."""
+        if end_ms - onsets[note] < profile.min_press_ms:
+            return False
+        if end_ms < release(note):
+            cuts.append((note, durations[note]))
+            durations[note] = end_ms - onsets[note]
+            if holding[note]:
+                heapq.heappush(busy, (release(note), note))  # The old entry is stale now
+            allocation.shortened += 1
+        return True
+
+    def undo_cuts(cuts):
+        """Gives the notes cut short for a dropped note their length back."""
+        for note, duration in reversed(cuts):
+            durations[note] = duration
+            if holding[note]:
+                heapq.heappush(busy, (release(note), note))
+            allocation.shortened -= 1
+
+    for note in np.lexsort((pitches, source_onsets)).tolist():
+        start = source_onsets[note]
+        pitch = int(pitches[note])
+        cuts = []  # (note, duration before) of the notes cut short for this one
+
+        # Servos whose notes are over by now (onsets are visited in order, so this only moves forward)
+        pop_stale()
+        while busy and busy[0][0] + profile.travel_ms <= start:
+            holding[heapq.heappop(busy)[1]] = False
+            holding_count -= 1
+            pop_stale()
+
+        # The key has to be released and rested since its last note
+        previous = last_note.get(pitch)
+        if previous is not None:
+            ready = release(previous) + restrike_interval(profile, pitch)
+            if ready > start and not cut_short(previous, start - restrike_interval(profile, pitch), cuts):
+                start = ready
+
+        # And a servo has to be free
+        if holding_count >= profile.servo_count:
+            pop_stale()
+            earliest, first = busy[0]
+            if earliest + profile.travel_ms > start:
+                if cut_short(first, start - profile.travel_ms, cuts):
+                    pop_stale()
+                else:
+                    start = earliest + profile.travel_ms
+
+        if start - source_onsets[note] > profile.max_delay_ms:
+            played[note] = False
+            undo_cuts(cuts)
+            continue
+
+        onsets[note] = start
+        if holding_count >= profile.servo_count:
+            # The servo of the note that ends first moves on to this one
+            pop_stale()
+            holding[heapq.heappop(busy)[1]] = False
+            holding_count -= 1
+        heapq.heappush(busy, (release(note), note))
+        holding[note] = True
+        holding_count += 1
+        last_note[pitch] = note
+    return allocation
+
+
+def allocate_table(table, profile=DEFAULT_PROFILE, tempo=500000):
+    """
+    Plans a fitted note table for the servos, see allocate.
+    :param tempo: Microseconds per quarter note the table is played at, the one of note_table.to_midi_file.
+    :return: (note table with the planned notes, Allocation)
+    """
+    table = note_table.strip_ties(table)
+    table = table[table['pitch'] != note_table.REST]
+    ms_per_quarter = tempo / 1000
+    allocation = allocate(table['onset'] * ms_per_quarter, table['duration'] * ms_per_quarter, table['pitch'],
+                          profile)
+
+    result = table.copy()
+    result['onset'] = allocation.onsets / ms_per_quarter
+    result['duration'] = allocation.durations / ms_per_quarter
+    result = result[allocation.played]
+    return result[np.argsort(result['onset'], kind='stable')], allocation
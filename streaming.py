@@ -0,0 +1,90 @@
+from basic_pitch.constants import AUDIO_SAMPLE_RATE
+
+from transcription import INFERENCE_PARAMS, transcribe_audio
+
+WINDOW_SECONDS = 8.0
+OVERLAP_SECONDS = 1.0
+# A note ending this close to the end of a window was probably cut off by the window edge
+EDGE_TOLERANCE = 0.1
+# Maximum onset difference for a note in the next window to count as the same note
+JOIN_TOLERANCE = 0.15
+
+
+def stream_note_events(audio, model, window_seconds=WINDOW_SECONDS, overlap_seconds=OVERLAP_SECONDS,
+                       **inference_params):
+    """
+    Transcribes decoded audio in overlapping windows and yields the notes of each segment as soon as they are final.
+    Yields (segment_start, segment_end, note_events) with note times in seconds from the start of the song.
+
+    Every window overlaps the next one by overlap_seconds. Notes are assigned to a segment by their onset,
+    with the segment boundary in the middle of the overlap, so notes seen by both windows are kept only once.
+    A note that runs into the end of its window is extended with the matching note of the next window,
+    which is why a segment is only released after the following window has been transcribed.
+    """
+    params = dict(INFERENCE_PARAMS, **inference_params)
+    window_len = int(window_seconds * AUDIO_SAMPLE_RATE)
+    hop = window_len - int(overlap_seconds * AUDIO_SAMPLE_RATE)
+    if hop <= 0:
+        raise ValueError("The overlap must be shorter than the window")
+
+    previous_events = None
+    previous_end = 0.0
+    segment_start = 0.0
+
+    for window_start in range(0, max(len(audio), 1), hop):
+        chunk = audio[window_start:window_start + window_len]
+        chunk_start = window_start / AUDIO_SAMPLE_RATE
+        chunk_end = chunk_start + len(chunk) / AUDIO_SAMPLE_RATE
+
+        _, _, window_events = transcribe_audio(chunk, model, **params)
+        window_events = sorted((
+            [start + chunk_start, end + chunk_start, pitch, amplitude, bends]
+            for start, end, pitch, amplitude, bends in window_events
+        ), key=lambda event: (event[0], event[2]))
+
+        if previous_events is not None:
+            boundary = (chunk_start + previous_end) / 2
+            segment = stitch_window_edge(previous_events, window_events, segment_start, boundary, chunk_start,
+                                         previous_end)
+            yield segment_start, boundary, segment
+            segment_start = boundary
+            window_events = [event for event in window_events if event[0] >= boundary]
+
+        previous_events = window_events
+        previous_end = chunk_end
+        if window_start + window_len >= len(audio):
+            break
+
+    if previous_events is not None:
+        yield segment_start, previous_end, [tuple(event) for event in previous_events if event[0] >= segment_start]
+
+
+def stitch_window_edge(previous_events, window_events, segment_start, boundary, window_start, previous_end):
+    """
+    Returns the final notes of the segment [segment_start, boundary) of the previous window.
+    Notes cut off by the end of the previous window are extended with their continuation in the next window.
+    """
+    segment = [event for event in previous_events if segment_start <= event[0] < boundary]
+
+    # Continuations of earlier notes start inside the overlap, before the boundary
+    continuations = {}
+    for event in window_events:
+        if event[0] < boundary:
+            continuations.setdefault(event[2], []).append(event)
+
+    for event in segment:
+        if event[1] < previous_end - EDGE_TOLERANCE:
+            continue
+        for candidate in continuations.get(event[2], []):
+            # Either the same onset, or a note that was already sounding when the next window started
+            if abs(candidate[0] - event[0]) <= JOIN_TOLERANCE or candidate[0] <= window_start + JOIN_TOLERANCE:
+                event[1] = max(event[1], candidate[1])
+                break
+
+    return [tuple(event) for event in segment]
+
+
+def shift_note_events(note_events, offset):
+    """Moves note events by offset seconds, e.g. to make a segment start at zero."""
+    return [(start + offset, end + offset, pitch, amplitude, bends)
+            for start, end, pitch, amplitude, bends in note_events]
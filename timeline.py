@@ -0,0 +1,72 @@
+import heapq
+from collections import namedtuple
+
+DEFAULT_TEMPO = 500000  # Microseconds per beat (120 BPM), until the first set_tempo message
+
+TimelineEvent = namedtuple('TimelineEvent', ['time_ns', 'tick', 'track', 'msg'])
+
+
+def track_ticks(track, track_index):
+    """Yields (absolute tick, track index, message) for one track, turning its delta times into absolute ticks."""
+    tick = 0
+    for msg in track:
+        tick += msg.time
+        yield tick, track_index, msg
+
+
+def merged_timeline(mf):
+    """
+    Lazily merges all tracks of a mido MidiFile into one stream of TimelineEvents in time order.
+    The tracks are merged with a k-way heap merge, so only one message per track is held in memory at a time.
+    Messages at the same tick keep the order of their tracks, like mido.merge_tracks.
+
+    A set_tempo message applies to every track from its tick on. Times are converted from whole tick counts per
+    tempo segment, so rounding never accumulates over a long song.
+    """
+    tempo = DEFAULT_TEMPO
+    segment_start_ns = 0  # Time and tick of the last tempo change
+    segment_start_tick = 0
+    tracks = [track_ticks(track, i) for i, track in enumerate(mf.tracks)]
+
+    for tick, track_index, msg in heapq.merge(*tracks, key=lambda item: item[0]):
+        time_ns = segment_start_ns + (tick - segment_start_tick) * tempo * 1000 // mf.ticks_per_beat
+        yield TimelineEvent(time_ns, tick, track_index, msg)
+        if msg.type == 'set_tempo':
+            segment_start_ns, segment_start_tick, tempo = time_ns, tick, msg.tempo
+
+
+def timed_messages(mf):
+    """Yields (time_ns, msg) for every message of the song in time order, see merged_timeline."""
+    for event in merged_timeline(mf):
+        yield event.time_ns, event.msg
+
+
+def timed_deltas(mf):
+    """
+    Yields (time_ns, delta_ms, msg), where delta_ms is the time since the previous message of any track.
+    This replaces the per-track msg.time * tempo / ticks_per_beat conversion of the senders.
+    """
+    previous_ns = 0
+    for time_ns, msg in timed_messages(mf):
+        yield time_ns, (time_ns - previous_ns) / 1e6, msg
+        previous_ns = time_ns
+
+
+def note_lengths(mf):
+    """
+    Returns {(time_ns, pitch): [length_ns, ...]} for every note of the song, from its note_on to the matching
+    note_off. Notes without a note_off last until the end of the song.
+    """
+    open_notes = {}  # pitch -> start times of the notes that are still sounding
+    lengths = {}
+    last_ns = 0
+    for last_ns, msg in timed_messages(mf):
+        if msg.type == 'note_on' and msg.velocity > 0:
+            open_notes.setdefault(msg.note, []).append(last_ns)
+        elif msg.type in ('note_on', 'note_off') and open_notes.get(msg.note):
+            start_ns = open_notes[msg.note].pop(0)
+            lengths.setdefault((start_ns, msg.note), []).append(last_ns - start_ns)
+    for pitch, starts in open_notes.items():
+        for start_ns in starts:
+            lengths.setdefault((start_ns, pitch), []).append(last_ns - start_ns)
+    return lengths
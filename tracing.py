@@ -0,0 +1,141 @@
+"""
+Timing spans for conversion jobs.
+
+    tracer = Tracer()
+    with tracer.activate():
+        with span('decode audio'):
+            ...
+    tracer.write_chrome_trace('job.trace.json')  # Open in chrome://tracing or https://ui.perfetto.dev
+    print(tracer.format_breakdown())
+
+span() records into the active tracer and does nothing when no job is being traced, so library code such as
+transcription.py can mark its stages without knowing about the GUI.
+"""
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+Span = namedtuple('Span', ['name', 'start_ns', 'duration_ns', 'thread', 'depth', 'args'])
+
+_active = None
+# Only one cProfile profiler can be enabled at a time in a process (Python 3.12+ raises otherwise)
+_profiler_lock = threading.Lock()
+
+
+class Tracer:
+    """
+    Collects spans of one job from any number of threads.
+    With a profile_dir, top-level spans also run under cProfile and their stats are written to
+    <profile_dir>/<number>_<span name>.prof (viewable with snakeviz or pstats).
+    Only one span is profiled at a time: a top-level span that starts while another thread is being profiled
+    is timed but not profiled.
+    """
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.spans = []
+        self.start_ns = time.perf_counter_ns()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = 0
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Makes this the tracer span() records into, for all threads."""
+        global _active
+        previous = _active
+        _active = self
+        try:
+            yield self
+        finally:
+            _active = previous
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        depth = getattr(self._local, 'depth', 0)
+        profiler = None
+        if self.profile_dir and depth == 0 and _profiler_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+
+        self._local.depth = depth + 1
+        start_ns = time.perf_counter_ns()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                _profiler_lock.release()
+            duration_ns = time.perf_counter_ns() - start_ns
+            self._local.depth = depth
+            with self._lock:
+                self.spans.append(Span(name, start_ns, duration_ns, threading.current_thread().name, depth, args))
+                if profiler is not None:
+                    self._profiles += 1
+                    number = self._profiles
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                file_name = f"{number:02d}_{name.replace(' ', '_')}.prof"
+                profiler.dump_stats(os.path.join(self.profile_dir, file_name))
+
+    def to_chrome_trace(self):
+        """Spans in the Chrome trace event format, as complete ('X') events with microsecond times."""
+        thread_ids = {}
+        events = []
+        for recorded in sorted(self.spans, key=lambda s: s.start_ns):
+            tid = thread_ids.setdefault(recorded.thread, len(thread_ids) + 1)
+            events.append({
+                'name': recorded.name,
+                'ph': 'X',
+                'ts': (recorded.start_ns - self.start_ns) / 1000,
+                'dur': recorded.duration_ns / 1000,
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': {key: str(value) for key, value in recorded.args.items()},
+            })
+        for thread, tid in thread_ids.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                           'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+        print(f"Trace written to {path}")
+        return path
+
+    def breakdown(self):
+        """
+        Returns [(name, depth, total seconds, count)] with the spans of the same name and depth added up,
+        in the order the stages first started.
+        """
+        totals = {}
+        for recorded in sorted(self.spans, key=lambda s: s.start_ns):
+            entry = totals.setdefault((recorded.name, recorded.depth), [0, 0])
+            entry[0] += recorded.duration_ns
+            entry[1] += 1
+        return [(name, depth, total_ns / 1e9, count) for (name, depth), (total_ns, count) in totals.items()]
+
+    def format_breakdown(self):
+        """Text table of the breakdown, nested stages indented under their parents."""
+        lines = []
+        total = 0.0
+        for name, depth, seconds, count in self.breakdown():
+            label = '  ' * depth + name + (f" (x{count})" if count > 1 else '')
+            lines.append(f"{label:<32} {seconds:8.2f}s")
+            if depth == 0:
+                total += seconds
+        lines.append(f"{'total':<32} {total:8.2f}s")
+        return '\n'.join(lines)
+
+
+def span(name, **args):
+    """Records a span in the active tracer, if there is one."""
+    if _active is None:
+        return contextlib.nullcontext()
+    return _active.span(name, **args)
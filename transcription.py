@@ -0,0 +1,147 @@
+import os
+
+import librosa
+import numpy as np
+from basic_pitch import note_creation as infer
+from basic_pitch.constants import AUDIO_SAMPLE_RATE, AUDIO_N_SAMPLES, FFT_HOP
+from basic_pitch.inference import window_audio_file, unwrap_output
+
+from audio_cache import get_audio_cache
+from model_registry import get_model
+from tracing import span
+from transcription_cache import cache_key, get_cache, hash_file
+
+# Same windowing as basic_pitch.inference.run_inference
+N_OVERLAPPING_FRAMES = 30
+OVERLAP_LEN = N_OVERLAPPING_FRAMES * FFT_HOP
+HOP_SIZE = AUDIO_N_SAMPLES - OVERLAP_LEN
+
+# Default inference parameters of basic_pitch.inference.predict, also part of the transcription cache key
+INFERENCE_PARAMS = {
+    'onset_threshold': 0.5,
+    'frame_threshold': 0.3,
+    'minimum_note_length': 127.70,
+    'minimum_frequency': None,
+    'maximum_frequency': None,
+    'multiple_pitch_bends': False,
+    'melodia_trick': True,
+    'midi_tempo': 120,
+}
+
+
+def load_audio(audio_path, audio_hash=None, cache=None):
+    """
+    Decodes an audio file and resamples it to the Basic Pitch model rate.
+    A file that was decoded before is memory-mapped from the decoded-audio cache instead (read-only).
+    Decoding does not need the model, so it can run in a worker pool while another file is being transcribed.
+    :param audio_hash: hash_file of the audio, if the caller already has it.
+    """
+    cache = cache or get_audio_cache()
+    audio_hash = audio_hash or hash_file(audio_path)
+    audio = cache.get(audio_hash, AUDIO_SAMPLE_RATE)
+    if audio is not None:
+        print(f"Using cached audio for {audio_path}")
+        return audio
+
+    audio, _ = librosa.load(str(audio_path), sr=AUDIO_SAMPLE_RATE, mono=True)
+    cache.put(audio_hash, AUDIO_SAMPLE_RATE, audio)
+    return audio
+
+
+def run_inference_on_audio(audio, model):
+    """
+    Runs the model on already decoded audio. Equivalent to basic_pitch.inference.run_inference,
+    which only accepts a file path and decodes it itself.
+    """
+    original_length = audio.shape[0]
+    audio = np.concatenate([np.zeros((OVERLAP_LEN // 2,), dtype=np.float32), audio])
+
+    output = {"note": [], "onset": [], "contour": []}
+    for window, _ in window_audio_file(audio, HOP_SIZE):
+        for k, v in model.predict(np.expand_dims(window, axis=0)).items():
+            output[k].append(v)
+
+    return {
+        k: unwrap_output(np.concatenate(output[k]), original_length, N_OVERLAPPING_FRAMES) for k in output
+    }
+
+
+def transcribe_audio(audio, model, onset_threshold=0.5, frame_threshold=0.3, minimum_note_length=127.70,
+                     minimum_frequency=None, maximum_frequency=None, multiple_pitch_bends=False,
+                     melodia_trick=True, midi_tempo=120):
+    """
+    Transcribes decoded audio with the given model.
+    Returns the same (model_output, midi_data, note_events) tuple as basic_pitch.inference.predict.
+    """
+    with span('inference', seconds=round(len(audio) / AUDIO_SAMPLE_RATE, 1)):
+        model_output = run_inference_on_audio(audio, model)
+    min_note_len = int(np.round(minimum_note_length / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)))
+    with span('note creation'):
+        midi_data, note_events = infer.model_output_to_notes(
+            model_output,
+            onset_thresh=onset_threshold,
+            frame_thresh=frame_threshold,
+            min_note_len=min_note_len,
+            min_freq=minimum_frequency,
+            max_freq=maximum_frequency,
+            multiple_pitch_bends=multiple_pitch_bends,
+            melodia_trick=melodia_trick,
+            midi_tempo=midi_tempo,
+        )
+    return model_output, midi_data, note_events
+
+
+def transcribe_file(audio_path, cache=None, **inference_params):
+    """
+    Transcribes an audio file, reusing the cached result if the same audio was already transcribed
+    with the same model and inference parameters.
+    :return: (midi_data, note_events, cached)
+    """
+    params = dict(INFERENCE_PARAMS, **inference_params)
+    cache = cache or get_cache()
+    with span('transcription cache lookup'):
+        audio_hash = hash_file(audio_path)
+        key = cache_key(audio_path, params, audio_hash=audio_hash)
+        cached = cache.get(key)
+    if cached is not None:
+        print(f"Using cached transcription for {audio_path}")
+        midi_data, note_events = cached
+        return midi_data, note_events, True
+
+    with span('decode audio'):
+        audio = load_audio(audio_path, audio_hash)
+    with span('load model'):
+        model = get_model()
+    _, midi_data, note_events = transcribe_audio(audio, model, **params)
+    with span('transcription cache write'):
+        cache.put(key, midi_data, note_events)
+    return midi_data, note_events, False
+
+
+def transcribe_and_save(audio_path, output_dir, save_model_outputs=True, sonify_midi=True, save_notes=True,
+                        sonification_samplerate=44100, **inference_params):
+    """
+    Writes the same <name>_basic_pitch.mid/.npz/.wav/.csv files as basic_pitch.inference.predict_and_save, but the
+    audio comes from the decoded-audio cache, so running a song again with other thresholds skips decoding the MP3.
+    Files of an earlier run are overwritten.
+    :return: Path of the MIDI file.
+    """
+    from basic_pitch.inference import save_note_events
+
+    params = dict(INFERENCE_PARAMS, **inference_params)
+    with span('decode audio'):
+        audio = load_audio(audio_path)
+    with span('load model'):
+        model = get_model()
+    model_output, midi_data, note_events = transcribe_audio(audio, model, **params)
+
+    base_path = os.path.join(output_dir, os.path.splitext(os.path.basename(audio_path))[0] + '_basic_pitch')
+    with span('write outputs'):
+        midi_data.write(base_path + '.mid')
+        if save_model_outputs:
+            np.savez(base_path + '.npz', basic_pitch_model_output=model_output)
+        if sonify_midi:
+            infer.sonify_midi(midi_data, base_path + '.wav', sr=sonification_samplerate)
+        if save_notes:
+            save_note_events(note_events, base_path + '.csv')
+    return base_path + '.mid'
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import threading
+from importlib import metadata
+
+import pretty_midi
+from basic_pitch import ICASSP_2022_MODEL_PATH
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.midi_player', 'transcriptions')
+MAX_CACHE_BYTES = 512 * 1024 * 1024  # 512 MB
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Returns the SHA-256 of a file's contents, so renamed or copied songs still hit the cache."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_identity(model_path=ICASSP_2022_MODEL_PATH):
+    """Identifies the model by its path and the installed basic-pitch version."""
+    try:
+        version = metadata.version('basic-pitch')
+    except metadata.PackageNotFoundError:
+        version = 'unknown'
+    return f"{version}:{os.path.basename(str(model_path))}"
+
+
+def cache_key(audio_path, inference_params, model_path=ICASSP_2022_MODEL_PATH, audio_hash=None):
+    """
+    Builds the cache key from the audio content, the model and the inference parameters.
+    Fitting parameters are not part of the key, since fitting always runs after the cache.
+    """
+    key_data = {
+        'audio': audio_hash or hash_file(audio_path),
+        'model': model_identity(model_path),
+        'params': inference_params,
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+class TranscriptionCache:
+    """
+    On-disk cache of Basic Pitch results. Every entry is a <key>.mid file with the transcribed MIDI
+    and a <key>.json file with the note events. File modification times are used as the LRU order.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.mid', base + '.json'
+
+    def get(self, key):
+        """Returns (midi_data, note_events) for the key, or None if it is not cached."""
+        midi_path, notes_path = self._paths(key)
+        try:
+            with open(notes_path) as f:
+                note_events = [
+                    (start, end, pitch, amplitude, bends) for start, end, pitch, amplitude, bends in json.load(f)
+                ]
+            midi_data = pretty_midi.PrettyMIDI(midi_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except Exception as e:
+            print(f"Ignoring unreadable cache entry {key}: {e}")
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Marking the entry as recently used
+        os.utime(midi_path)
+        os.utime(notes_path)
+        with self._lock:
+            self.hits += 1
+        return midi_data, note_events
+
+    def put(self, key, midi_data, note_events):
+        midi_path, notes_path = self._paths(key)
+        serializable_events = [
+            [float(start), float(end), int(pitch), float(amplitude),
+             [int(bend) for bend in bends] if bends is not None else None]
+            for start, end, pitch, amplitude, bends in note_events
+        ]
+
+        # Writing to temporary files first so a crash never leaves a half-written entry behind
+        midi_data.write(midi_path + '.tmp')
+        with open(notes_path + '.tmp', 'w') as f:
+            json.dump(serializable_events, f)
+        os.replace(midi_path + '.tmp', midi_path)
+        os.replace(notes_path + '.tmp', notes_path)
+
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits into max_bytes."""
+        with self._lock:
+            entries = {}
+            for name in os.listdir(self.cache_dir):
+                key, ext = os.path.splitext(name)
+                if ext not in ('.mid', '.json'):
+                    continue
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                size, last_used = entries.get(key, (0, 0))
+                entries[key] = (size + stat.st_size, max(last_used, stat.st_mtime))
+
+            total_size = sum(size for size, _ in entries.values())
+            for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+                if total_size <= self.max_bytes:
+                    break
+                for path in self._paths(key):
+                    if os.path.exists(path):
+                        os.remove(path)
+                total_size -= size
+                print(f"Evicted transcription cache entry {key}")
+
+
+_default_cache = None
+
+
+def get_cache():
+    """Returns the process-wide transcription cache."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = TranscriptionCache()
+    return _default_cache